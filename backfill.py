@@ -0,0 +1,107 @@
+'''
+    Resumable batched backfills of derived columns
+
+    run_backfill walks a model by primary key, hands every batch of rows to a
+    compute function and writes the values it returns with a single
+    UPDATE ... FROM (VALUES ...) per batch. The checkpoint in BackfillState
+    moves in the same transaction as the update, an interrupted job resumes
+    after the last written batch and a finished job starts over.
+
+    Jobs built on it: normalize.py (Video.normalized_tags) and
+    frequency_stats.py (Video.meta channel title), both accept
+    --batch-size N, --dry-run and --restart
+'''
+import logging
+from datetime import datetime
+from tqdm import tqdm
+from peewee import ValuesList, Value, Cast
+from models import BackfillState, postgres_database
+
+
+def _column_type(field):
+    '''Column type of field as written in its DDL, e.g. VARCHAR(255)[]
+    '''
+    ctx = postgres_database.get_sql_context()
+    return ctx.sql(field.ddl_datatype(ctx)).query()[0]
+
+def bulk_update_values(model, rows, fields):
+    '''UPDATE model SET field = new.field FROM (VALUES ...) AS new WHERE pk = new.pk
+
+        rows are (primary key, value of every field) tuples. Unlike
+        Model.bulk_update (a CASE per field over the whole batch) postgres
+        joins the VALUES list once. The VALUES columns are untyped so every
+        one is cast back to its column type
+    '''
+    if len(rows) == 0:
+        return 0
+    pk = model._meta.primary_key
+    columns = [pk] + list(fields)
+    # unpack=False keeps list values (ArrayField) a single parameter
+    values = ValuesList([ [ Value(field.db_value(value), unpack=False) for field, value in zip(columns, row) ]
+        for row in rows ], columns=[ field.column_name for field in columns ], alias='new')
+    update = { field: Cast(getattr(values.c, field.column_name), _column_type(field)) for field in fields }
+    query = model.update(update).from_(values).where(
+        pk == Cast(getattr(values.c, pk.column_name), _column_type(pk)))
+    return query.execute()
+
+
+def run_backfill(name, query, compute, fields, batch_size=1000, dry_run=False, restart=False):
+    '''Apply compute to every row of query (a ModelSelect which includes the
+        primary key) in primary key order.
+
+        compute gets a list of rows and returns the (primary key, field values)
+        tuples to write, rows left out are unchanged. dry_run computes every
+        batch without writing anything, checkpoint included.
+        Returns (rows scanned, rows changed)
+    '''
+    model = query.model
+    pk = model._meta.primary_key
+    state, _ = BackfillState.get_or_create(name=name)
+    if restart or state.last_id is None:
+        state.last_id, state.scanned, state.changed, state.finished = None, 0, 0, False
+    else:
+        logging.info('{}: resuming after {}, {} rows scanned so far'.format(name, state.last_id, state.scanned))
+    last_id = pk.adapt(state.last_id) if state.last_id is not None else None
+    scanned, changed = state.scanned, state.changed
+
+    query = query.order_by(pk)
+    with tqdm(desc=name) as pbar:
+        while True:
+            batch = query
+            if last_id is not None:
+                batch = batch.where(pk > last_id)
+            rows = list(batch.limit(batch_size))
+            if len(rows) == 0:
+                break
+            updates = compute(rows)
+            last_id = rows[-1]._pk
+            scanned += len(rows)
+            changed += len(updates)
+            pbar.update(len(rows))
+            if dry_run:
+                for row in updates[:3]:
+                    logging.debug('{}: would write {}'.format(name, row))
+                continue
+            with postgres_database.atomic():
+                bulk_update_values(model, updates, fields)
+                state.last_id = str(last_id)
+                state.scanned, state.changed = scanned, changed
+                state.updated = datetime.now()
+                state.save()
+
+    if dry_run:
+        logging.info('{}: dry run, {} of {} rows would change'.format(name, changed, scanned))
+        return scanned, changed
+    state.last_id, state.finished, state.updated = None, True, datetime.now()
+    state.save()
+    logging.info('{}: {} of {} rows changed'.format(name, changed, scanned))
+    return scanned, changed
+
+
+def add_arguments(parser, batch_size=1000):
+    '''Options shared by the backfill commands
+    '''
+    parser.add_argument('--batch-size', type=int, default=batch_size)
+    parser.add_argument('--dry-run', action='store_true', help='compute every batch, write nothing')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint of an interrupted run')
+    return parser
@@ -0,0 +1,16 @@
+'''
+    Offline benchmarks of the trending queries, tag helpers and endpoints
+
+    A synthetic dataset (tags seeded from test.txt and blacklist.txt) is loaded
+    into a scratch postgres database and a temporary cache.db, then every target
+    is timed over a number of rounds and its memory traced once. Run from the
+    repository root:
+
+    BENCH_DATABASE=yt_bench python -m benchmarks.run --scale 1 --output base.json
+    BENCH_DATABASE=yt_bench python -m benchmarks.run --skip-load --output head.json
+    python -m benchmarks.compare base.json head.json
+
+    BENCH_DATABASE names the scratch database, its tables are dropped and
+    recreated, BENCH_HOST / BENCH_PORT / BENCH_USER / BENCH_PASSWORD override
+    the connection settings of .env. It must differ from DATABASE.
+'''
@@ -0,0 +1,61 @@
+'''
+    python -m benchmarks.compare base.json head.json [--threshold 0.2] [--metric p50]
+
+    Print the relative change of every target between two benchmarks.run reports,
+    exits with 1 when a target got slower (or used more memory) than threshold
+'''
+import sys
+import json
+import argparse
+
+COLUMNS = ['p50', 'p90', 'p99', 'peak_kb', 'queries']
+
+
+def change(base, head):
+    if base is None or head is None or base == 0:
+        return None
+    return (head - base) / base
+
+def compare(base, head, threshold=0.2, metrics=('p50', 'peak_kb', 'queries')):
+    '''Rows of (target, {column: (base, head, change)}) and the regressed targets
+    '''
+    rows, regressions = [], []
+    for name in sorted(set(base['results']) | set(head['results'])):
+        before = base['results'].get(name, {})
+        after = head['results'].get(name, {})
+        columns = {}
+        for column in COLUMNS:
+            columns[column] = (before.get(column), after.get(column), change(before.get(column), after.get(column)))
+        rows.append((name, columns))
+        if any([ columns[m][2] is not None and columns[m][2] > threshold for m in metrics ]):
+            regressions.append(name)
+    return rows, regressions
+
+def _format(value, ratio):
+    if value is None:
+        return '{:>20s}'.format('-')
+    if ratio is None:
+        return '{:>20.2f}'.format(value)
+    return '{:>11.2f} {:>+7.1%}'.format(value, ratio)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare two benchmark reports')
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--metric', action='append', default=None, help='columns checked for regressions, p50, peak_kb and queries by default')
+    args = parser.parse_args()
+
+    base = json.load(open(args.base, 'r'))
+    head = json.load(open(args.head, 'r'))
+    rows, regressions = compare(base, head, args.threshold, args.metric or ('p50', 'peak_kb', 'queries'))
+
+    print('{} -> {}'.format(base['meta'].get('commit'), head['meta'].get('commit')))
+    print('{:40s}'.format('target') + ''.join([ '{:>20s}'.format(c) for c in COLUMNS ]))
+    for name, columns in rows:
+        print('{:40s}'.format(name) + ''.join([ _format(columns[c][1], columns[c][2]) for c in COLUMNS ]))
+
+    if len(regressions) > 0:
+        print('regressed over {:.0%}: {}'.format(args.threshold, ', '.join(regressions)))
+        sys.exit(1)
@@ -0,0 +1,173 @@
+'''
+    Synthetic Regions, Channels, Videos, Stats, DailyTrend and DataPoint rows
+
+    generate() only builds plain rows, load() writes them to the database the
+    models are bound to and runs the same maintenance jobs production runs
+    (normalize, rollup, tag series), the search vectors are filled
+    by the fn.sql triggers on insert.
+'''
+import random
+import logging
+from datetime import datetime, timedelta
+from tag_normalizer import load_samples
+
+CATEGORIES = [1, 2, 10, 17, 20, 22, 23, 24, 25, 26, 28]
+
+
+def load_vocabulary(samples_path='test.txt', blacklist_path='blacklist.txt', blacklist_size=500, seed=0):
+    '''Titles and tags of test.txt plus a slice of blacklisted tags, so the
+        normalizer has something to filter
+    '''
+    rng = random.Random(seed)
+    samples = load_samples(samples_path)
+    titles = [ title for _, title in samples if len(title) > 0 ] or ['untitled']
+    tags = list(dict.fromkeys([ tag for sample, _ in samples for tag in sample if len(tag) > 0 ]))
+    blacklist = [ line.strip() for line in open(blacklist_path, 'r') if len(line.strip()) > 0 ]
+    rng.shuffle(blacklist)
+    return titles, tags, blacklist[:blacklist_size]
+
+def _metrics(rng, rank=None):
+    view = rng.randint(1000, 5000000)
+    return {
+        'view': view,
+        'like': int(view * rng.uniform(0.005, 0.08)),
+        'dislike': int(view * rng.uniform(0.0005, 0.01)),
+        'comment': int(view * rng.uniform(0.0005, 0.02)),
+        'rank': rank if rank is not None else rng.randint(1, 100),
+    }
+
+def _isoformat(time):
+    return time.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def generate(scale=1, days=30, regions=8, seed=0, region_path='valid_region.txt'):
+    '''Rows of every table, sizes grow linearly with scale:
+        50 channels, 1000 videos, 200 trending videos and 150 daily tags per region,
+        300 tag series per region
+    '''
+    rng = random.Random(seed)
+    titles, tags, blacklist = load_vocabulary(seed=seed)
+    vocabulary = tags + blacklist
+
+    today = datetime.now()
+    today = datetime(year=today.year, month=today.month, day=today.day)
+    region_ids = [ line.strip() for line in open(region_path, 'r') if len(line.strip()) > 0 ][:regions]
+
+    data = {
+        'regions': [ {'region_id': r, 'name': r, 'lat': rng.uniform(-60, 60), 'lon': rng.uniform(-180, 180)}
+            for r in region_ids ],
+        'channels': [],
+        'videos': [],
+        'stats': [],
+        'daily_trends': [],
+        'datapoints': [],
+    }
+
+    for idx in range(50 * scale):
+        data['channels'].append({
+            'channel_id': 'UC{:022d}'.format(idx),
+            'title': '{} {}'.format(rng.choice(titles)[:48], idx)[:64],
+            'country': rng.choice(region_ids),
+            'description': ' '.join(rng.sample(vocabulary, 20)),
+            'thumbnails': {'default': {'url': 'https://example.com/{}.jpg'.format(idx)}},
+        })
+
+    for idx in range(1000 * scale):
+        channel = rng.choice(data['channels'])
+        video_tags = rng.sample(vocabulary, rng.randint(5, 25))
+        # some tags repeat the channel name, the normalizer drops those
+        if rng.random() < 0.3:
+            video_tags.append(channel['title'].lower())
+        data['videos'].append({
+            'id': 'v{:010d}'.format(idx),
+            'etag': '{:032x}'.format(rng.getrandbits(128)),
+            'published': today - timedelta(days=rng.uniform(0, days + 10)),
+            'title': rng.choice(titles)[:128],
+            'description': ' '.join(video_tags)[:6000],
+            'tags': video_tags,
+            'meta': {'channel': {'title': channel['title']}},
+            'category_id': rng.choice(CATEGORIES),
+            'duration': timedelta(seconds=rng.randint(30, 3600)),
+            'defintion': 'hd',
+            'projection': 'rectangular',
+            'dimension': '2d',
+            'channel': channel['channel_id'],
+        })
+
+    recent = [ v for v in data['videos'] if v['published'] >= today - timedelta(days=days) ]
+    now = datetime.now()
+    for region_id in region_ids:
+        for rank, video in enumerate(rng.sample(recent, min(len(recent), 200 * scale))):
+            # a point every 4 hours from publishing (at most 3 days back) until now
+            time = max(video['published'], now - timedelta(days=3))
+            points = []
+            while time <= now:
+                point = _metrics(rng, rank=rank % 100 + 1)
+                point['date'] = _isoformat(time)
+                points.append(point)
+                time += timedelta(hours=4)
+            data['stats'].append({'video': video['id'], 'trending_region': region_id, 'stats': {'data': points}})
+
+        for day in range(days, 0, -1):
+            metrics = []
+            for tag in rng.sample(vocabulary, min(len(vocabulary), 150 * scale)):
+                metrics.append({'tag': tag, 'stats': _metrics(rng), 'category': [rng.choice(CATEGORIES)]})
+            data['daily_trends'].append({'region': region_id, 'time': today - timedelta(days=day), 'metrics': metrics})
+
+        for tag in rng.sample(tags, min(len(tags), 300 * scale)):
+            points = []
+            for day in range(days, 0, -1):
+                if rng.random() < 0.5:
+                    # the layout the crawler writes, /tag/{tag} strips tag again
+                    point = _metrics(rng)
+                    point['tag'] = tag[:128]
+                    point['time'] = (today - timedelta(days=day)).strftime('%Y-%m-%d %H:%M:%S')
+                    points.append(point)
+            if len(points) == 0:
+                continue
+            data['datapoints'].append({'key': 'tag', 'value': tag[:128], 'metrics': points,
+                'time': today - timedelta(days=1), 'region': region_id, 'video': rng.choice(recent)['id']})
+    return data
+
+
+def _insert(model, rows, batch_size=500):
+    for idx in range(0, len(rows), batch_size):
+        model.insert_many(rows[idx:idx+batch_size]).execute()
+
+def load(data):
+    '''Recreate every table of the scratch database and fill it with data
+    '''
+    from models import (Region, Channel, Video, Stats, DailyTrend, DataPoint, Statistic, Activity,
+        TagRollup, RollupState, TagMetric, TrendTag, TrendPosting, TagFrequency, FrequencyState,
+        ChannelTag, ChannelTagState, BackfillState, postgres_database, create_table)
+
+    postgres_database.drop_tables([BackfillState, ChannelTagState, ChannelTag, FrequencyState, TagFrequency,
+        TrendPosting, TrendTag, TagMetric, RollupState, TagRollup, DataPoint,
+        Activity, Statistic, Stats, DailyTrend, Video, Channel, Region], cascade=True)
+    # create_table leaves Region to the region import
+    postgres_database.create_tables([Region])
+    create_table()
+    # triggers and search functions, the database user may lack the rights for the extension
+    postgres_database.execute_sql(open('fn.sql', 'r').read())
+    try:
+        postgres_database.execute_sql('CREATE EXTENSION IF NOT EXISTS fuzzystrmatch')
+    except Exception as e:
+        postgres_database.rollback()
+        logging.warning('fuzzystrmatch unavailable, cold suggestion fallbacks will fail: {}'.format(e))
+
+    with postgres_database.atomic():
+        _insert(Region, data['regions'])
+        region = { r.region_id: r.id for r in Region.select() }
+        _insert(Channel, [ dict(c, country=region[c['country']]) for c in data['channels'] ])
+        _insert(Video, data['videos'])
+        _insert(Stats, [ dict(s, trending_region=region[s['trending_region']]) for s in data['stats'] ], 100)
+        _insert(DailyTrend, [ dict(d, region=region[d['region']]) for d in data['daily_trends'] ], 50)
+        _insert(DataPoint, [ dict(d, region=region[d['region']]) for d in data['datapoints'] ])
+
+    import normalize
+    import rollup
+    import tag_series
+    normalize.renormalize(force=True)
+    rollup.refresh_rollups(rebuild=True)
+    tag_series.backfill()
+    logging.info('loaded {}'.format(', '.join([ '{} {}'.format(len(rows), name) for name, rows in data.items() ])))
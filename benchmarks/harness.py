@@ -0,0 +1,118 @@
+'''
+    Timing, memory tracing and in-process ASGI requests
+'''
+import time
+import asyncio
+import tracemalloc
+from urllib.parse import urlencode, quote
+
+
+def percentile(values, q):
+    '''Linear interpolation between the closest ranks of sorted values
+    '''
+    if len(values) == 0:
+        return None
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def summarize(timings):
+    '''Latency summary in milliseconds
+    '''
+    values = sorted([ t * 1000 for t in timings ])
+    return {
+        'rounds': len(values),
+        'min': values[0] if values else None,
+        'p50': percentile(values, 0.5),
+        'p90': percentile(values, 0.9),
+        'p99': percentile(values, 0.99),
+        'max': values[-1] if values else None,
+        'mean': sum(values) / len(values) if values else None,
+    }
+
+def measure(func, rounds=20, setup=None, query_threshold=None):
+    '''Time func over rounds calls, then trace one extra call with tracemalloc
+        and the query tracer so the tracing overhead stays out of the latencies.
+
+        setup runs before every call outside of the timed section,
+        e.g. to clear result caches
+    '''
+    from querytrace import start_trace, stop_trace, collect, QUERY_REPEAT_THRESHOLD
+    threshold = QUERY_REPEAT_THRESHOLD if query_threshold is None else query_threshold
+
+    timings, errors, first_error = [], 0, None
+    for _ in range(rounds):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            errors += 1
+            first_error = first_error or repr(e)
+        timings.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    # the endpoints trace their requests in the threadpool, collect merges them
+    trace = start_trace('benchmark')
+    tracemalloc.start()
+    try:
+        with collect(trace):
+            func()
+    except Exception:
+        pass
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stop_trace(trace, threshold, strict=False)
+
+    result = summarize(timings)
+    result.update(errors=errors, error=first_error, peak_kb=peak / 1024, retained_kb=current / 1024)
+    result.update(trace.summary(threshold))
+    return result
+
+
+class ASGIClient():
+    '''Issue GET requests straight to an ASGI app, no server or http client needed
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self.loop = asyncio.new_event_loop()
+
+    async def _request(self, path, params):
+        scope = {
+            'type': 'http',
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': quote(path).encode('ascii'),
+            'root_path': '',
+            'query_string': urlencode(params or {}).encode('ascii'),
+            'headers': [(b'host', b'benchmark')],
+            'client': ('127.0.0.1', 0),
+            'server': ('benchmark', 80),
+        }
+        response = {'status': None, 'body': b''}
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                response['body'] += message.get('body', b'')
+
+        await self.app(scope, receive, send)
+        return response
+
+    def get(self, path, params=None):
+        '''Returns (status, body bytes), raises on a non 200 status
+        '''
+        response = self.loop.run_until_complete(self._request(path, params))
+        if response['status'] != 200:
+            raise RuntimeError('GET {} returned {}'.format(path, response['status']))
+        return response['status'], response['body']
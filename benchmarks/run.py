@@ -0,0 +1,181 @@
+'''
+    python -m benchmarks.run [--scale 1] [--rounds 20] [--skip-load] [--warm] [--output result.json]
+        [--query-threshold 10] [--strict-queries]
+
+    see benchmarks/__init__.py for the database settings
+'''
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import subprocess
+
+
+def configure_database():
+    '''Point the models at the scratch database before they are imported,
+        load_dotenv never overrides variables that are already set
+    '''
+    from dotenv import load_dotenv
+    load_dotenv()
+    database = os.getenv('BENCH_DATABASE')
+    if not database:
+        sys.exit('BENCH_DATABASE is not set, refusing to touch the default database')
+    if database == os.getenv('DATABASE'):
+        sys.exit('BENCH_DATABASE must differ from DATABASE, its tables are dropped')
+    os.environ['DATABASE'] = database
+    for name, setting in [('BENCH_HOST', 'HOST'), ('BENCH_PORT', 'PORT'),
+            ('BENCH_USER', 'DB_USER'), ('BENCH_PASSWORD', 'PASSWORD')]:
+        if os.getenv(name):
+            os.environ[setting] = os.getenv(name)
+
+def configure_cache(directory):
+    '''Keep the LatestTrend and shared response tables in a temporary cache.db
+    '''
+    import cache
+    cache.sqlite_db.init(os.path.join(directory, 'cache.db'), pragmas={
+        'journal_mode': 'wal',
+        'cache_size': -1024 * 128})
+    cache.create_table()
+
+def clear_caches():
+    import cache
+    from memo import caches
+    for result_cache in caches:
+        result_cache.clear()
+    cache.MainCache.delete().execute()
+
+def commit_id():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def function_targets(seed=0):
+    '''Direct calls of the helpers behind the endpoints
+    '''
+    import utils
+    from models import Region, Video
+    from tag_index import tag_index
+
+    rng = random.Random(seed)
+    region_ids = [ region_id for region_id, in Region.select(Region.region_id).tuples() ]
+    region_id = region_ids[0]
+    region = Region.get(Region.region_id == region_id)
+    videos = list(Video.select(Video.id, Video.tags, Video.meta).limit(200))
+    tag_pair = [ (tag, rng.randint(1, 100)) for v in videos for tag in v.tags ]
+    prefix = videos[0].tags[0][:3]
+
+    return {
+        'trending_topic.day': lambda: utils.trending_topic(region_id, 'day'),
+        'trending_topic.week': lambda: utils.trending_topic(region_id, 'week'),
+        'trending_topics.all.day': lambda: utils.trending_topics(tuple(region_ids), 'day'),
+        'topic_filter.week': lambda: utils.topic_filter(region_id, 'week'),
+        'get_today_trend': lambda: utils.get_today_trend.__wrapped__(region),
+        'extract_video_unique_keyword.200': lambda: [ utils.extract_video_unique_keyword(v) for v in videos ],
+        'cluster_tags': lambda: utils.cluster_tags(tag_pair),
+        'tag_index.complete': lambda: tag_index.complete(prefix, 20),
+    }
+
+def endpoint_targets():
+    from models import Region, Video, Channel, DataPoint
+    region_id = Region.select(Region.region_id).scalar()
+    tag = DataPoint.select(DataPoint.value).where(DataPoint.key == 'tag').scalar()
+    channel_id = Channel.select(Channel.channel_id).scalar()
+    search = Video.select(Video.tags).scalar()[0]
+
+    return {
+        '/main?unit=day': ('/main', {'unit': 'day'}),
+        '/main?unit=week': ('/main', {'unit': 'week'}),
+        '/main/{region}?unit=week': ('/main/{}'.format(region_id), {'unit': 'week'}),
+        '/main?search': ('/main', {'unit': 'week', 'search': search}),
+        '/tag/{tag}': ('/tag/{}'.format(tag), {}),
+        '/tag/{tag}/similar': ('/tag/{}/similar'.format(tag), {}),
+        '/suggestion/{prefix}': ('/suggestion/{}'.format(tag[:3]), {}),
+        '/video': ('/video', {}),
+        '/video?search': ('/video', {'search': search}),
+        '/channel': ('/channel', {}),
+        '/channel/{id}': ('/channel/{}'.format(channel_id), {}),
+        '/channel/{id}/videos': ('/channel/{}/videos'.format(channel_id), {}),
+    }
+
+
+def run(args):
+    import tempfile
+    configure_database()
+    directory = tempfile.mkdtemp(prefix='yt_bench_')
+    configure_cache(directory)
+
+    from benchmarks import dataset
+    if not args.skip_load:
+        started = time.time()
+        dataset.load(dataset.generate(scale=args.scale, days=args.days, regions=args.regions, seed=args.seed))
+        logging.info('dataset loaded in {:.1f}s'.format(time.time() - started))
+
+    # today's LatestTrend lives in the temporary cache.db, recompute it every run
+    import cache
+    from models import Region
+    cache.cache_today_stats(processes=1, region_ids=[ r for r, in Region.select(Region.region_id).tuples() ])
+    from tag_index import tag_index
+    tag_index.refresh()
+    from main import app
+    from benchmarks.harness import measure, ASGIClient
+
+    setup = None if args.warm else clear_caches
+    results = {}
+    for name, func in function_targets(args.seed).items():
+        results[name] = measure(func, args.rounds, setup, args.query_threshold)
+        logging.info('{:40s} p50 {:8.2f}ms p90 {:8.2f}ms'.format(name, results[name]['p50'], results[name]['p90']))
+
+    client = ASGIClient(app)
+    for name, (path, params) in endpoint_targets().items():
+        results[name] = measure(lambda: client.get(path, params), args.rounds, setup, args.query_threshold)
+        logging.info('{:40s} p50 {:8.2f}ms p90 {:8.2f}ms'.format(name, results[name]['p50'], results[name]['p90']))
+
+    return {
+        'meta': {
+            'commit': commit_id(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'scale': args.scale,
+            'days': args.days,
+            'regions': args.regions,
+            'rounds': args.rounds,
+            'warm': args.warm,
+            'query_threshold': args.query_threshold,
+        },
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s : %(message)s')
+    parser = argparse.ArgumentParser(description='benchmark the trending backend on synthetic data')
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--regions', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--skip-load', action='store_true', help='reuse the dataset of the previous run')
+    parser.add_argument('--warm', action='store_true', help='keep result caches between rounds')
+    parser.add_argument('--output', default=None, help='write the json report here instead of stdout')
+    parser.add_argument('--query-threshold', type=int, default=None,
+        help='times one statement may run per call, QUERY_REPEAT_THRESHOLD by default')
+    parser.add_argument('--strict-queries', action='store_true',
+        help='exit with 1 when a target repeats a statement more than the threshold')
+    args = parser.parse_args()
+    report = run(args)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    repeated = [ name for name, result in report['results'].items() if len(result['repeated']) > 0 ]
+    if args.strict_queries and len(repeated) > 0:
+        sys.exit('repeated queries (likely N+1) in: {}'.format(', '.join(repeated)))
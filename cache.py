@@ -1,9 +1,27 @@
+'''
+    python cache.py             refresh LatestTrend once
+    python cache.py every 600   refresh LatestTrend every 600 seconds
+    python cache.py warm        fill the shared /main cache
+'''
+import os
+import sys
+import json
+import time
+import fcntl
+import logging
+import threading
+import multiprocessing as mp
+from datetime import datetime
 from peewee import *
 from playhouse.sqlite_ext import SqliteExtDatabase, JSONField
+from playhouse.migrate import SqliteMigrator, migrate
 from models import Video, DailyTrend,Activity, Region, Channel, Stats, postgres_database
-from utils import get_today_trend
-from tqdm import tqdm
-from main import all_region
+from utils import get_today_trend, all_region
+import memo
+from memo import invalidate_region
+from settings import SHARED_CACHE_BYTES, REFRESH_PROCESSES
+
+VERSION_POLL = 5 # seconds a process keeps using the RegionVersion rows it read
 
 sqlite_db = SqliteExtDatabase('cache.db', pragmas={
     'journal_mode': 'wal',
@@ -18,36 +36,273 @@ class LatestTrend(BaseModel):
 
     region_id = CharField(max_length=2, unique=True)
     metrics = JSONField(default={})
+    refreshed_at = DateTimeField(null=True)
+    duration = FloatField(null=True) # seconds spent computing metrics
+
+
+class RegionVersion(BaseModel):
+    '''
+        Generations of a region, live is bumped by every LatestTrend refresh
+        and trends whenever the refresher sees its DailyTrend rows change.
+        Memoized results compare them on lookup, shared /main keys include trends
+    '''
+    region_id = CharField(max_length=2, unique=True)
+    live = IntegerField(default=0)
+    trends = IntegerField(default=0)
+    trend_mark = TextField(default='') # DailyTrend row count and newest id, see trend_marks
 
 
-def cache_today_stats():
-    for region_id in tqdm(all_region):
+class MainCache(BaseModel):
+    '''
+        Serialized endpoint responses shared by every worker on this host
+    '''
+    key = TextField(unique=True)
+    regions = TextField(default='') # ,TW,US, so a region refresh can find its entries
+    payload = BlobField()
+    size = IntegerField(default=0)
+    accessed = FloatField()
+    expires = FloatField(null=True, index=True)
+
+
+def refresh_region(region_id):
+    '''Compute today's stats of one region, runs inside the refresh pool
+    '''
+    started = time.time()
+    refreshed_at = datetime.now()
+    try:
         region = Region.get(Region.region_id == region_id)
-        today_stats = get_today_trend(region)
-        if LatestTrend.select().where(LatestTrend.region_id == region_id).exists():
-            trend = LatestTrend.get(LatestTrend.region_id == region_id)
-            trend.metrics = today_stats
-            with postgres_database.atomic():
-                trend.save()
-        else:
-            LatestTrend.create(region_id=region_id,metrics=today_stats).save()
+        # bypass the memoized copy, the point is to recompute it
+        today_stats = get_today_trend.__wrapped__(region)
+    except Exception as e:
+        logging.exception(e)
+        return region_id, None, refreshed_at, time.time() - started
+    return region_id, today_stats, refreshed_at, time.time() - started
+
+def cache_today_stats(processes=REFRESH_PROCESSES, region_ids=None):
+    '''Refresh LatestTrend of every region (or only region_ids) on a process
+        pool and write all rows in one transaction
+    '''
+    started = time.time()
+    region_ids = all_region if region_ids is None else region_ids
+    # spawn so no worker inherits an open postgres connection
+    with mp.get_context('spawn').Pool(processes) as pool:
+        results = pool.map(refresh_region, region_ids)
+
+    rows = []
+    for region_id, today_stats, refreshed_at, duration in results:
+        if today_stats is None:
+            logging.warning('refresh {} failed after {:.2f}s'.format(region_id, duration))
+            continue
+        rows.append({
+            'region_id': region_id,
+            'metrics': today_stats,
+            'refreshed_at': refreshed_at,
+            'duration': duration,
+        })
+
+    if len(rows) > 0:
+        with sqlite_db.atomic():
+            LatestTrend.insert_many(rows).on_conflict(conflict_target=[LatestTrend.region_id],
+                preserve=[LatestTrend.metrics, LatestTrend.refreshed_at, LatestTrend.duration]).execute()
+            RegionVersion.insert_many([ {'region_id': row['region_id']} for row in rows ]).on_conflict(
+                conflict_target=[RegionVersion.region_id], update={RegionVersion.live: RegionVersion.live + 1}).execute()
+
+    for row in rows:
+        invalidate_region(row['region_id'])
+        invalidate_shared(row['region_id'])
+    for region_id in bump_trend_versions(trend_marks()):
+        invalidate_shared(region_id, live_only=False)
+    logging.info('refreshed {}/{} regions in {:.2f}s'.format(len(rows), len(results), time.time() - started))
+    return rows
+
+def refresher_lock():
+    '''Take the refresher lock file next to cache.db, None while another
+        process of this host holds it. The lock goes with the process
+    '''
+    path = os.path.join(os.path.dirname(os.path.abspath(sqlite_db.database)), 'refresh.lock')
+    handle = open(path, 'a')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return None
+    return handle
+
+def run_refresher(interval, processes=REFRESH_PROCESSES):
+    '''Refresh every interval seconds while holding the refresher lock, the
+        other processes of the host keep retrying and take over when it is freed
+    '''
+    lock = None
+    while True:
+        started = time.time()
+        if lock is None:
+            lock = refresher_lock()
+            if lock is not None:
+                logging.info('refresher lock taken by process {}'.format(os.getpid()))
+        if lock is not None:
+            try:
+                cache_today_stats(processes)
+            except Exception as e:
+                logging.exception(e)
+        time.sleep(max(0, interval - (time.time() - started)))
+
+def start_refresher(interval, processes=REFRESH_PROCESSES):
+    '''Keep LatestTrend fresh from inside the api process, only one worker
+        per host refreshes at a time
+    '''
+    thread = threading.Thread(target=run_refresher, args=(interval, processes), daemon=True)
+    thread.start()
+    return thread
 
+def trend_marks():
+    '''Row count and newest id of the DailyTrend rows of every region, a day
+        inserted late changes both
+    '''
+    with postgres_database.connection_context():
+        query = DailyTrend.select(Region.region_id, fn.COUNT(DailyTrend.id), fn.MAX(DailyTrend.id)).join(
+            Region).group_by(Region.region_id)
+        return { region_id: '{}:{}'.format(count, max_id) for region_id, count, max_id in query.tuples() }
 
-def get_main_cache(region_id, unit, start, end):
+def bump_trend_versions(marks):
+    '''Bump the trends generation of the regions whose mark changed,
+        returns their ids
+    '''
+    with sqlite_db.atomic():
+        known = dict(RegionVersion.select(RegionVersion.region_id, RegionVersion.trend_mark).tuples())
+        changed = [ region_id for region_id, mark in marks.items() if known.get(region_id) != mark ]
+        for region_id in changed:
+            RegionVersion.insert(region_id=region_id, trends=1, trend_mark=marks[region_id]).on_conflict(
+                conflict_target=[RegionVersion.region_id], update={
+                    RegionVersion.trends: RegionVersion.trends + 1,
+                    RegionVersion.trend_mark: marks[region_id]}).execute()
+    return changed
+
+_versions = {'read_at': 0, 'rows': {}}
+
+def region_versions():
+    '''(live, trends) generations of every region, read from cache.db at most
+        every VERSION_POLL seconds so a memoized lookup stays an in memory one
+    '''
+    now = time.time()
+    if now - _versions['read_at'] > VERSION_POLL:
+        try:
+            rows = { region_id: (live, trends) for region_id, live, trends in RegionVersion.select(
+                RegionVersion.region_id, RegionVersion.live, RegionVersion.trends).tuples() }
+        except DatabaseError as e:
+            logging.warning('region versions read failed: {}'.format(e))
+            rows = _versions['rows']
+        _versions.update(read_at=now, rows=rows)
+    return _versions['rows']
+
+memo.version_source = region_versions
+
+def trend_versions(region_ids):
+    '''trends generation of each region, part of the shared /main keys so a
+        late DailyTrend row is never answered from an entry without expiry
+    '''
+    versions = region_versions()
+    return [ versions.get(region_id, (0, 0))[1] for region_id in region_ids ]
+
+def latest_refreshed(region_ids):
+    '''When LatestTrend of each region was last refreshed
+    '''
+    query = LatestTrend.select(LatestTrend.region_id, LatestTrend.refreshed_at).where(
+        LatestTrend.region_id.in_(list(region_ids)))
+    return { region_id: refreshed_at for region_id, refreshed_at in query.tuples() }
+
+
+def cache_key(endpoint, **params):
+    '''Canonical key of an endpoint call, params must already be canonical
+        e.g. dates formatted as days
+    '''
+    return '{}?{}'.format(endpoint, json.dumps(params, sort_keys=True, default=str))
+
+def get_shared(key):
+    '''Cached payload bytes or None, a miss never raises
+    '''
     try:
-        query = MainCache.get(
-            (MainCache.region_id == region_id) & 
-            (MainCache.unit == unit)
-            # (MainCache.start == start) &
-            # (MainCache.end == end)
-        )
-        return query.data
-    except:
-        None
+        entry = MainCache.get(MainCache.key == key)
+    except MainCache.DoesNotExist:
+        return None
+    except DatabaseError as e:
+        logging.warning('shared cache read failed: {}'.format(e))
+        return None
+
+    now = time.time()
+    try:
+        if entry.expires is not None and entry.expires < now:
+            MainCache.delete().where(MainCache.id == entry.id).execute()
+            return None
+        # refresh the LRU position at most once a minute to keep reads cheap
+        if now - entry.accessed > 60:
+            MainCache.update(accessed=now).where(MainCache.id == entry.id).execute()
+    except DatabaseError as e:
+        logging.warning('shared cache update failed: {}'.format(e))
+    return bytes(entry.payload)
+
+def set_shared(key, payload, regions=(), ttl=None):
+    now = time.time()
+    try:
+        with sqlite_db.atomic():
+            MainCache.insert(key=key, regions=',{},'.format(','.join(regions)),
+                payload=payload, size=len(payload), accessed=now,
+                expires=now + ttl if ttl is not None else None).on_conflict_replace().execute()
+            evict_shared()
+    except DatabaseError as e:
+        logging.warning('shared cache write failed: {}'.format(e))
+
+def evict_shared(max_bytes=SHARED_CACHE_BYTES):
+    '''Drop expired entries then the least recently used ones until the
+        payloads fit in max_bytes
+    '''
+    MainCache.delete().where(MainCache.expires < time.time()).execute()
+    total = MainCache.select(fn.SUM(MainCache.size)).scalar() or 0
+    if total <= max_bytes:
+        return 0
+    excess, ids = total - max_bytes, []
+    for entry in MainCache.select(MainCache.id, MainCache.size).order_by(MainCache.accessed):
+        ids.append(entry.id)
+        excess -= entry.size
+        if excess <= 0:
+            break
+    return MainCache.delete().where(MainCache.id.in_(ids)).execute()
+
+def invalidate_shared(region_id, live_only=True):
+    '''Drop the entries built from today's data of a region, or every entry
+        of the region when its past days changed too
+    '''
+    query = MainCache.delete().where(MainCache.regions.contains(',{},'.format(region_id)))
+    if live_only:
+        query = query.where(MainCache.expires.is_null(False))
+    return query.execute()
+
+def warm_main_cache(units=('day', 'week', 'month')):
+    '''Fill the shared cache with the default /main views, run after a deploy
+    '''
+    from main import primary_view
+    for unit in units:
+        start = time.time()
+        primary_view(unit=unit)
+        logging.info('warmed /main unit={} in {:.2f}s'.format(unit, time.time() - start))
     
 
 def create_table():
-    sqlite_db.create_tables([LatestTrend])
+    sqlite_db.create_tables([LatestTrend, MainCache, RegionVersion])
+    migrator = SqliteMigrator(sqlite_db)
+    existing = [ c.name for c in sqlite_db.get_columns(LatestTrend._meta.table_name) ]
+    new_columns = [
+        ('refreshed_at', DateTimeField(null=True)),
+        ('duration', FloatField(null=True)),
+    ]
+    migrate(*[ migrator.add_column(LatestTrend._meta.table_name, name, field)
+        for name, field in new_columns if name not in existing ])
 
 if __name__ == '__main__':
-    cache_today_stats()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s : %(message)s')
+    create_table()
+    if len(sys.argv) > 1 and sys.argv[1] == 'warm':
+        warm_main_cache()
+    elif len(sys.argv) > 2 and sys.argv[1] == 'every':
+        run_refresher(int(sys.argv[2]))
+    else:
+        cache_today_stats()
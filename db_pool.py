@@ -0,0 +1,119 @@
+'''
+    Pooled postgres connections for the api workers
+
+    The connection state stays peewee's thread local one. Every sync endpoint
+    runs in one of starlette's threadpool threads from start to end and a thread
+    serves one request at a time, so the thread is the request while the handler
+    runs: request_scope wraps the endpoints, traces their queries and hands the
+    thread's connection back to the pool once the handler returns. A contextvar
+    would not do on python 3.6, the contextvars backport gives every asyncio
+    task the same context. Threads outside of a request (region executor, background
+    refreshers) borrow connections with connection_context.
+'''
+import time
+import functools
+import threading
+from playhouse.pool import PooledPostgresqlExtDatabase, MaxConnectionsExceeded
+from playhouse.postgres_ext import PostgresqlExtDatabase
+from querytrace import TracedDatabaseMixin, start_trace, stop_trace, current_trace, collecting
+from settings import QUERY_TRACE, QUERY_TRACE_STRICT
+
+
+def request_scope(database):
+    '''Decorator for sync endpoints, closes (returns to the pool) the
+        connection the handler's thread opened, the connection itself is only
+        opened by the first query. With QUERY_TRACE the handler's queries are
+        traced, in strict mode a repeated query fails the request
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = None
+            if (QUERY_TRACE or collecting()) and current_trace() is None:
+                trace = start_trace(func.__name__)
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                if not database.is_closed():
+                    database.close()
+                if trace is not None:
+                    # an exception raised by the handler wins over strict mode
+                    stop_trace(trace, strict=QUERY_TRACE_STRICT and not failed)
+        return wrapper
+    return decorator
+
+
+class TracedPostgresqlExtDatabase(TracedDatabaseMixin, PostgresqlExtDatabase):
+    pass
+
+
+class _OpenedCounter(PostgresqlExtDatabase):
+    '''Sits right after PooledDatabase in the MRO of StatsPooledPostgresqlDatabase,
+        PooledDatabase._connect only calls up to it when it opens a new
+        connection, never when it hands out an idle pooled one
+    '''
+
+    def _connect(self):
+        conn = super()._connect()
+        with self._stats_lock:
+            self._opened += 1
+        return conn
+
+
+class StatsPooledPostgresqlDatabase(TracedDatabaseMixin, PooledPostgresqlExtDatabase, _OpenedCounter):
+    '''
+        PooledPostgresqlExtDatabase counting how long callers wait for a connection
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._acquired = 0
+        self._opened = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._peak_in_use = 0
+
+    def connect(self, reuse_if_open=False):
+        start = time.time()
+        exhausted = self._max_connections is not None and len(self._in_use) >= self._max_connections
+        try:
+            result = super().connect(reuse_if_open)
+        except MaxConnectionsExceeded:
+            with self._stats_lock:
+                self._timeouts += 1
+            raise
+        elapsed = time.time() - start
+        with self._stats_lock:
+            self._acquired += 1
+            self._peak_in_use = max(self._peak_in_use, len(self._in_use))
+            if exhausted:
+                # only count callers that found every connection checked out
+                self._waits += 1
+                self._wait_total += elapsed
+                self._wait_max = max(self._wait_max, elapsed)
+        return result
+
+    def pool_stats(self):
+        in_use = len(self._in_use)
+        with self._stats_lock:
+            return {
+                'pooled': True,
+                'max_connections': self._max_connections,
+                'in_use': in_use,
+                'idle': len(self._connections),
+                'utilization': in_use / self._max_connections if self._max_connections else None,
+                'peak_in_use': self._peak_in_use,
+                'acquired': self._acquired,
+                'opened': self._opened,
+                'waits': self._waits,
+                'wait_total': self._wait_total,
+                'wait_max': self._wait_max,
+                'wait_mean': self._wait_total / self._waits if self._waits else 0.0,
+                'timeouts': self._timeouts,
+            }
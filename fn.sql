@@ -1,16 +1,3 @@
-CREATE FUNCTION to_tsvector_multilang(text) RETURNS tsvector AS $$
-SELECT to_tsvector('english', $1) || 
-       to_tsvector('simple', array_to_string(
-            to_chinese_bigram(
-                lower($1)
-            ), ' '::text
-        )) || 
-       to_tsvector('french', $1) || 
-       to_tsvector('simple', $1)
-$$ LANGUAGE sql IMMUTABLE;
-
-
-
 CREATE OR REPLACE FUNCTION
 to_chinese_bigram (input text)
 RETURNS text[]
@@ -44,4 +31,51 @@ $$
         END IF;
     END;
 $$
-LANGUAGE plpgsql;
\ No newline at end of file
+LANGUAGE plpgsql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION to_tsvector_multilang(text) RETURNS tsvector AS $$
+SELECT to_tsvector('english', $1) || 
+       to_tsvector('simple', coalesce(array_to_string(
+            to_chinese_bigram(
+                lower($1)
+            ), ' '::text
+        ), '')) || 
+       to_tsvector('french', $1) || 
+       to_tsvector('simple', $1)
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- query side of to_tsvector_multilang: matches on the english stem, the
+-- raw token or all the chinese bigrams of the query
+CREATE OR REPLACE FUNCTION to_tsquery_multilang(text) RETURNS tsquery AS $$
+SELECT plainto_tsquery('english', $1) ||
+       plainto_tsquery('simple', coalesce(array_to_string(
+            to_chinese_bigram(
+                lower($1)
+            ), ' '::text
+        ), '')) ||
+       plainto_tsquery('simple', $1)
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- keep video.search_vector / channel.search_vector current on write,
+-- rows written before the trigger existed are filled by `python search_index.py`
+CREATE OR REPLACE FUNCTION search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector_multilang(coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector_multilang(coalesce(NEW.description, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS video_search_vector_update ON video;
+CREATE TRIGGER video_search_vector_update
+    BEFORE INSERT OR UPDATE OF title, description ON video
+    FOR EACH ROW EXECUTE PROCEDURE search_vector_update();
+
+DROP TRIGGER IF EXISTS channel_search_vector_update ON channel;
+CREATE TRIGGER channel_search_vector_update
+    BEFORE INSERT OR UPDATE OF title, description ON channel
+    FOR EACH ROW EXECUTE PROCEDURE search_vector_update();
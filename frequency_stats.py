@@ -1,9 +1,25 @@
-from models import Video, Statistic, Activity, DataPoint, Region, Channel, postgres_database
+'''
+    python frequency_stats.py frequency TW [restart]   count the tags of TW's trending videos into TagFrequency
+    python frequency_stats.py blacklist [rebuild]      recount the channels with new videos and rewrite blacklist.txt
+    python frequency_stats.py [--dry-run]              copy the channel title into Video.meta, see backfill.py for the options
+'''
+from models import Video, Statistic, Activity, DataPoint, Region, Channel, TagFrequency, FrequencyState, ChannelTag, ChannelTagState, postgres_database
+import os
+import sys
 import json
+import argparse
 import re
-from collections import Counter, defaultdict
+import tempfile
+import logging
+import multiprocessing as mp
+from collections import Counter, defaultdict, deque
+from datetime import datetime
+from peewee import EXCLUDED, SQL, fn
 from tqdm import tqdm
-from utils import extract_video_unique_keyword
+from tag_normalizer import TagNormalizer, channel_title
+from utils import NORMALIZER_VERSION
+from settings import FREQUENCY_PROCESSES
+from backfill import run_backfill, add_arguments
 
 def isfloat(value):
   try:
@@ -16,82 +32,233 @@ def clean_tag(t):
     if isfloat(t):
         return None
     return re.sub(r"[#&'()]", '', t)
-    
-def extract_frequency(region):
-    stats = Statistic.select(Statistic.video).where(
-        Statistic.trending_region == region
-    ).group_by(Statistic.video) #.limit(10000)
 
-    unique_video = defaultdict()
 
-    for s in tqdm(stats):
-        if s.video.id not in unique_video:
-            unique_video[s.video.id] = s.video
+_normalizer = None
 
-    valid_tag = []
+def _init_worker(blacklist_path):
+    global _normalizer
+    _normalizer = TagNormalizer(blacklist_path)
 
-    print('videos {}'.format(len(unique_video)))
-    
-    for _, video in unique_video.items():
-        tags = extract_video_unique_keyword(video)
-        for tag in tags:
+def count_tags(items):
+    '''Pool worker, items are (normalized tags or None, raw tags, channel title),
+        only videos without current normalized tags are normalized here
+    '''
+    pending = iter(_normalizer.normalize_many([ (tags, title) for normalized, tags, title in items if normalized is None ]))
+    counter = Counter()
+    for normalized, tags, title in items:
+        if normalized is None:
+            normalized = next(pending)
+        for tag in normalized:
             _tag = clean_tag(tag)
             if _tag and len(_tag) > 1:
-                valid_tag.append(_tag)
-    print('total tag {}, videos {}'.format(len(valid_tag), len(unique_video)))
-
-    return Counter(valid_tag)
-
-
-def extract_blacklist():
-    # region = Region.get(Region.region_id == 'TW')
-    # channels = Channel.select().where(Channel.country == region)
-    channels = Channel.select()
-    blacklist_tags = []
-    for c in tqdm(channels):
-        videos = Video.select().where(Video.channel == c)
-        tags = []
-        count = 0
-        for v in videos:
-            tags += v.tags
-            count += 1
-        counter = Counter(tags)
-        for key, value in counter.items():
-            if value >= count*0.7 and count > 3:
-                blacklist_tags.append(key)
-    blacklist_tags = list(set(blacklist_tags))
-    with open('video_blacklist_tag_0.7.txt', 'w') as f:
-        for key in blacklist_tags:
-            f.write('{}\n'.format(key))
-
-
-def push_video():
-    videos = Video.select()
-    for v in tqdm(videos):
-        if 'channel' in v.meta:
-            continue
-        channel_title = v.channel.title
-        v.meta['channel'] = {
-            'title': channel_title
-        }
+                counter[_tag] += 1
+    return counter
+
+def _merge(region, state, counter, last_video, videos, batch_size=1000):
+    '''Add a chunk's counts to TagFrequency and move the checkpoint in the
+        same transaction, a resumed run never counts a chunk twice
+    '''
+    rows = [ {'region': region, 'tag': tag, 'frequency': count} for tag, count in counter.items() ]
+    with postgres_database.atomic():
+        for idx in range(0, len(rows), batch_size):
+            TagFrequency.insert_many(rows[idx:idx+batch_size]).on_conflict(
+                conflict_target=[TagFrequency.region, TagFrequency.tag],
+                update={TagFrequency.frequency: TagFrequency.frequency + EXCLUDED.frequency}).execute()
+        state.last_video = last_video
+        state.videos += videos
+        state.updated = datetime.now()
+        state.save()
+
+def video_chunks(region, last_video=None, chunk_size=2000):
+    '''Walk the region's trending videos by primary key.
+
+        Keyset chunks instead of a server side (named) cursor: every chunk is
+        committed with its checkpoint and a named cursor does not survive the
+        commit, each chunk is still a bounded index range read
+    '''
+    trending = Statistic.select(Statistic.video).where(Statistic.trending_region == region)
+    query = Video.select(Video.id, Video.tags, Video.meta, Video.normalized_tags, Video.normalizer_version).where(
+        Video.id.in_(trending)).order_by(Video.id)
+    while True:
+        chunk = query
+        if last_video is not None:
+            chunk = chunk.where(Video.id > last_video)
+        items, last = [], None
+        for video in chunk.limit(chunk_size):
+            normalized = video.normalized_tags if video.normalizer_version == NORMALIZER_VERSION else None
+            items.append((normalized, video.tags, channel_title(video)))
+            last = video.id
+        if len(items) == 0:
+            return
+        yield items, last
+        last_video = last
+
+def extract_frequency(region, chunk_size=2000, processes=FREQUENCY_PROCESSES, restart=False, blacklist_path='blacklist.txt'):
+    '''Count the normalized tags of every video that trended in region into
+        TagFrequency, resumable from FrequencyState after a crash
+
+        chunks are normalized on a process pool while the next ones are read,
+        at most 2 * processes chunks are in flight
+    '''
+    state, _ = FrequencyState.get_or_create(region=region)
+    if restart:
         with postgres_database.atomic():
-            v.save()
+            TagFrequency.delete().where(TagFrequency.region == region).execute()
+            state.last_video, state.videos, state.finished = None, 0, False
+            state.save()
+    if state.finished:
+        logging.info('{} already counted, pass restart to recount'.format(region.region_id))
+        return state.videos
 
+    pending = deque()
+    with mp.get_context('spawn').Pool(processes, initializer=_init_worker, initargs=(blacklist_path,)) as pool, tqdm() as pbar:
+        def drain(limit):
+            while len(pending) > limit:
+                result, last_video, videos = pending.popleft()
+                _merge(region, state, result.get(), last_video, videos)
+                pbar.update(videos)
 
-if __name__ == '__main__':
-    # region = Region.get(Region.region_id == 'TW')
-    # frequency_result = dict(extract_frequency(region))
-    # update_frequency = frequency_result
+        for items, last_video in video_chunks(region, state.last_video, chunk_size):
+            pending.append((pool.apply_async(count_tags, (items,)), last_video, len(items)))
+            drain(processes * 2)
+        drain(0)
+
+    state.finished = True
+    state.save()
+    logging.info('{}: counted tags of {} videos'.format(region.region_id, state.videos))
+    return state.videos
 
-    # for key, value in frequency_result.items():
-    #     update_frequency.append((key, value))
-    # update_frequency.sort(key=lambda x: x[1], reverse=True)
+def top_tags(region, limit=100):
+    query = TagFrequency.select(TagFrequency.tag, TagFrequency.frequency).where(
+        TagFrequency.region == region).order_by(TagFrequency.frequency.desc()).limit(limit)
+    return list(query.tuples())
 
 
-    # with open('tag_frequency_TW.txt', 'w') as f:
-    #     for pair in update_frequency:
-    #         f.write(str(pair)+'\n')
-    push_video()
+def _changed_channels():
+    '''Channels whose video count or newest published time differs from
+        ChannelTagState, and the channels left without any video
+    '''
+    current = {}
+    query = Video.select(Video.channel, fn.COUNT(Video.id), fn.MAX(Video.published)).group_by(Video.channel)
+    for channel_id, videos, last_published in query.tuples():
+        current[channel_id] = (videos, last_published)
+    counted = {}
+    for channel_id, videos, last_published in ChannelTagState.select(
+            ChannelTagState.channel, ChannelTagState.videos, ChannelTagState.last_published).tuples():
+        counted[channel_id] = (videos, last_published)
+    changed = { channel_id: value for channel_id, value in current.items() if counted.get(channel_id) != value }
+    removed = [ channel_id for channel_id in counted if channel_id not in current ]
+    return changed, removed
 
+def _count_channel_tags(changed):
+    '''Recount the tags of changed {channel_id: (videos, last_published)}
+        with a single unnest / group by, the rows never leave the database
+    '''
+    channel_ids = list(changed.keys())
+    video_tags = Video.select(Video.channel, fn.unnest(Video.tags).alias('tag')).where(
+        Video.channel.in_(channel_ids)).alias('video_tags')
+    counts = Video.select(video_tags.c.channel_id, video_tags.c.tag, fn.COUNT(SQL('*'))).from_(
+        video_tags).group_by(video_tags.c.channel_id, video_tags.c.tag)
+    states = [ {'channel': channel_id, 'videos': videos, 'last_published': last_published}
+        for channel_id, (videos, last_published) in changed.items() ]
+    with postgres_database.atomic():
+        ChannelTag.delete().where(ChannelTag.channel.in_(channel_ids)).execute()
+        ChannelTag.insert_from(counts, [ChannelTag.channel, ChannelTag.tag, ChannelTag.frequency]).execute()
+        ChannelTagState.insert_many(states).on_conflict(
+            conflict_target=[ChannelTagState.channel],
+            update={
+                ChannelTagState.videos: EXCLUDED.videos,
+                ChannelTagState.last_published: EXCLUDED.last_published,
+            }).execute()
 
+def update_channel_tags(rebuild=False, batch_size=500):
+    '''Bring ChannelTag up to date, only channels with new (or removed)
+        videos since the last run are recounted unless rebuild is set
+    '''
+    if rebuild:
+        with postgres_database.atomic():
+            ChannelTag.delete().execute()
+            ChannelTagState.delete().execute()
+    changed, removed = _changed_channels()
+    if len(removed) > 0:
+        with postgres_database.atomic():
+            ChannelTag.delete().where(ChannelTag.channel.in_(removed)).execute()
+            ChannelTagState.delete().where(ChannelTagState.channel.in_(removed)).execute()
+    channel_ids = list(changed.keys())
+    for idx in range(0, len(channel_ids), batch_size):
+        _count_channel_tags({ channel_id: changed[channel_id] for channel_id in channel_ids[idx:idx+batch_size] })
+    logging.info('recounted tags of {} channels, dropped {}'.format(len(channel_ids), len(removed)))
+    return len(channel_ids)
 
+def blacklist_tags(ratio=0.7, min_videos=3):
+    '''Tags found on at least ratio of the videos of a channel with more
+        than min_videos videos, usually the channel's name or slogan
+    '''
+    # a plain float would go through IntegerField.db_value and become 0
+    ratio = SQL('%s', [float(ratio)])
+    query = ChannelTag.select(ChannelTag.tag).join(ChannelTagState, on=(ChannelTag.channel == ChannelTagState.channel)).where(
+        ChannelTagState.videos > min_videos,
+        ChannelTag.frequency >= ChannelTagState.videos * ratio).distinct()
+    return sorted([ tag for tag, in query.tuples() ])
+
+def write_blacklist(tags, path='blacklist.txt'):
+    '''Replace path atomically, a TagNormalizer reloading it never reads
+        a half written file
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.blacklist.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for tag in tags:
+                f.write('{}\n'.format(tag))
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def extract_blacklist(path='blacklist.txt', rebuild=False, ratio=0.7, min_videos=3):
+    update_channel_tags(rebuild)
+    tags = blacklist_tags(ratio, min_videos)
+    write_blacklist(tags, path)
+    logging.info('wrote {} blacklist tags to {}'.format(len(tags), path))
+    return tags
+
+
+def channel_title_rows(videos):
+    rows = []
+    for v in videos:
+        meta = dict(v.meta)
+        meta['channel'] = {
+            'title': v.channel.title
+        }
+        rows.append((v.id, meta))
+    return rows
+
+def push_video(batch_size=1000, dry_run=False, restart=False):
+    '''Copy the channel title into Video.meta of the videos without one,
+        the channel is joined instead of loaded once per video
+    '''
+    query = Video.select(Video.id, Video.meta, Channel.channel_id, Channel.title).join(Channel).where(
+        fn.json_extract_path(Video.meta, 'channel').is_null())
+    return run_backfill('video_channel_title', query, channel_title_rows, [Video.meta],
+        batch_size=batch_size, dry_run=dry_run, restart=restart)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s : %(message)s')
+    if len(sys.argv) > 2 and sys.argv[1] == 'frequency':
+        region = Region.get(Region.region_id == sys.argv[2])
+        extract_frequency(region, restart=len(sys.argv) > 3 and sys.argv[3] == 'restart')
+        for tag, frequency in top_tags(region, 20):
+            logging.info('{} {}'.format(tag, frequency))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'blacklist':
+        extract_blacklist(rebuild=len(sys.argv) > 2 and sys.argv[2] == 'rebuild')
+    else:
+        parser = add_arguments(argparse.ArgumentParser(description='copy the channel title into Video.meta'))
+        args = parser.parse_args()
+        push_video(args.batch_size, args.dry_run, args.restart)
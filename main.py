@@ -1,17 +1,31 @@
 from fastapi import FastAPI
 from datetime import datetime
 from starlette.middleware.cors import CORSMiddleware
-from utils import topic_filter, topic_interest, unit_value, validate_daterange, trending_topic
+from starlette.responses import StreamingResponse, Response
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import logging
+from utils import topic_filter, topic_interest, unit_value, validate_daterange, trending_topic, trending_topics, all_region, load_regions
 from datetime import datetime
-import multiprocessing as mp
 import pandas as pd
-from models import DailyTrend, Region, Video, Channel, Stats, DataPoint
-from peewee import NodeList, SQL
-from custom_pool import CustomPool, NoDaemonProcess
+from models import DailyTrend, Region, Video, Channel, Stats, DataPoint, postgres_database, pool_stats
+from db_pool import request_scope
+from peewee import NodeList, SQL, Case, fn
 import dateparser
 from dateutil.relativedelta import relativedelta 
-from playhouse.postgres_ext import Match
 from playhouse.shortcuts import model_to_dict, dict_to_model
+from settings import MAIN_WORKERS, SHARED_CACHE_TTL, REFRESH_INTERVAL
+from tag_index import tag_index
+from tag_series import tag_series, has_series
+from memo import cache_stats, today
+from pagination import keyset_page, clamp_limit
+from search_index import search_match
+from responses import FastJSONResponse, fast_json, dumps
+from metrics import MetricsMiddleware
+import metrics
+import cache
+
 
 app = FastAPI(debug=False)
 app.add_middleware(
@@ -21,26 +35,69 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# outermost so the latency includes every other middleware
+app.add_middleware(MetricsMiddleware, routes=app.router.routes)
+
+
+@app.on_event('startup')
+def load_tag_index():
+    tag_index.refresh_async()
 
-all_region = [ r.strip() for r in open('valid_region.txt', 'r').readlines() ]
+@app.on_event('startup')
+def create_cache_table():
+    cache.create_table()
+    if REFRESH_INTERVAL > 0:
+        cache.start_refresher(REFRESH_INTERVAL)
 
-def pool_wrapper(function, params, queue, pool_size=1):
-    '''Wrap a pool inside a pool of size 1
+def shared_ttl(end):
+    '''Responses built from today's LatestTrend expire, older ranges never change
     '''
-    pool = CustomPool(pool_size)
-    p_results = pool.starmap(function, params)
-    pool.close()
-    results = []
-    for r in p_results:
-        if len(r['topic']) > 0:
-            results.append(r)
-    queue.put(results)
+    if end >= today():
+        return SHARED_CACHE_TTL
+    return None
+
+# every endpoint returns its thread's connection to the pool and traces
+# its queries with QUERY_TRACE, see db_pool.py
+db_request = request_scope(postgres_database)
+
+# bounded by the db connection budget, every region borrows a pooled connection
+region_executor = ThreadPoolExecutor(max_workers=MAIN_WORKERS)
+
+def unknown_region(region_ids):
+    return FastJSONResponse({
+        'status': 'error',
+        'msg': 'unknown region: {}'.format(','.join(region_ids))
+    }, status_code=404)
+
+def region_trend(param):
+    '''Run trending_topic for one region inside the region executor
+    '''
+    with postgres_database.connection_context():
+        return trending_topic(*param)
+
+
+async def stream_region_trend(params, header):
+    '''Yield one NDJSON line per region as soon as it finishes,
+        the first line carries the request status and date range
+    '''
+    loop = asyncio.get_event_loop()
+    yield dumps(header) + b'\n'
+    futures = [ loop.run_in_executor(region_executor, region_trend, param) for param in params ]
+    for future in asyncio.as_completed(futures):
+        try:
+            result = await future
+        except Exception as e:
+            logging.exception(e)
+            continue
+        yield dumps(result) + b'\n'
 
 @app.get("/main")
+@db_request
+@fast_json
 def primary_view(search: str=None, unit: str="day",
     region: str="all", start:str=None, end:str=None,
     lw: float=0, vw: float=0, cw: float=0, rw: float=1, dw: float=0,
-    top: int=5):
+    top: int=5, stream: bool=False):
 
     if unit not in ['week', 'day', 'month', 'year']:
         return {
@@ -54,6 +111,10 @@ def primary_view(search: str=None, unit: str="day",
         for r in region.split(','):
             if len(r) > 1:
                 target_regions.append(r)
+        known = load_regions(target_regions)
+        unknown = [ r for r in target_regions if r not in known ]
+        if len(unknown) > 0:
+            return unknown_region(unknown)
 
     params = []
     if start is not None:
@@ -70,23 +131,36 @@ def primary_view(search: str=None, unit: str="day",
                 'status': 'error',
                 'msg': "Invalid daterange, start date must be earlier than end date"
             }
-    results = []
     for r in target_regions:
         param = (r, unit, search, start, end, False, top, lw, vw, cw, rw, dw)
-        results.append(trending_topic(*param))
-        # params.append(param)
+        params.append(param)
 
-    return {
-        'status': 'ok',
-        'date': {
-            'start': start.strftime('%Y-%m-%d'), 
-            'end': end.strftime('%Y-%m-%d')
-        },
-        'results':  results
+    date_range = {
+        'start': start.strftime('%Y-%m-%d'), 
+        'end': end.strftime('%Y-%m-%d')
     }
+    if stream:
+        header = { 'status': 'ok', 'date': date_range }
+        return StreamingResponse(stream_region_trend(params, header),
+            media_type='application/x-ndjson')
+
+    key = cache.cache_key('/main', regions=target_regions, unit=unit, search=search,
+        date=date_range, weights=[lw, vw, cw, rw, dw], top=top, versions=cache.trend_versions(target_regions))
+    payload = cache.get_shared(key)
+    if payload is None:
+        results = trending_topics(tuple(target_regions), unit, search, start, end, False, top, lw, vw, cw, rw, dw)
+        payload = dumps({
+            'status': 'ok',
+            'date': date_range,
+            'results':  results
+        })
+        cache.set_shared(key, payload, regions=target_regions, ttl=shared_ttl(end))
+    return FastJSONResponse(payload)
 
 
 @app.get("/main/{region_id}")
+@db_request
+@fast_json
 def read_item(region_id:str, search: str="", unit: str="day",
     start:str=None, end:str=None,
     lw: float=0, vw: float=0, cw: float=0, rw: float=1, dw: float=0,
@@ -113,16 +187,43 @@ def read_item(region_id:str, search: str="", unit: str="day",
                 'msg': "Invalid daterange, start date must be earlier than end date"
             }
 
-    result = topic_filter(region_id, unit=unit, search=search,
-        start=start, end=end, topic_limit=top, lw=lw, vw=vw, cw=cw, rw=rw, dw=dw)
-    result['date'] = {
+    date_range = {
         'start': start.strftime('%Y-%m-%d'), 
         'end': end.strftime('%Y-%m-%d'),
     }
-    return result
+    key = cache.cache_key('/main/{region_id}', region_id=region_id, unit=unit, search=search,
+        date=date_range, weights=[lw, vw, cw, rw, dw], top=top, versions=cache.trend_versions([region_id]))
+    payload = cache.get_shared(key)
+    if payload is None:
+        try:
+            result = dict(topic_filter(region_id, unit=unit, search=search,
+                start=start, end=end, topic_limit=top, lw=lw, vw=vw, cw=cw, rw=rw, dw=dw))
+        except Region.DoesNotExist:
+            return unknown_region([region_id])
+        result['date'] = date_range
+        payload = dumps(result)
+        cache.set_shared(key, payload, regions=[region_id], ttl=shared_ttl(end))
+    return FastJSONResponse(payload)
+
+
+def datapoint_series(datapoint, start, end):
+    '''Points of a DataPoint row within the range, used until TagMetric is backfilled,
+        select the Region along with the DataPoint so region_id is not a query per row
+    '''
+    daily_metrics = []
+    for point in datapoint.metrics:
+        m = point
+        m.pop('tag')
+        m['region'] = datapoint.region.region_id
+        time = datetime.strptime(m['time'].split(' ')[0], "%Y-%m-%d")
+        if time >= start and time <= end:
+            daily_metrics.append(m)
+    return daily_metrics
 
 
 @app.get("/tag/{tag}")
+@db_request
+@fast_json
 def get_tags(tag:str,start:str=None, end:str=None,unit: str="day",):
     if unit not in ['week', 'day', 'month', 'year']:
         return {
@@ -144,17 +245,13 @@ def get_tags(tag:str,start:str=None, end:str=None,unit: str="day",):
                 'msg': "Invalid daterange, start date must be earlier than end date"
             }
 
-    daily_metrics = []
-    datapoints = DataPoint.select().where( (DataPoint.key == 'tag') & (DataPoint.value == tag))
-    if datapoints.exists():
+    daily_metrics = tag_series([tag], start, end)[tag]
+    if len(daily_metrics) == 0 and len(has_series([tag])) == 0:
+        # not backfilled into TagMetric yet
+        datapoints = DataPoint.select(DataPoint, Region).join(Region).where(
+            (DataPoint.key == 'tag') & (DataPoint.value == tag))
         for datapoint in datapoints:
-            for point in datapoint.metrics:
-                m = point
-                m.pop('tag')
-                m['region'] = datapoint.region.region_id
-                time = datetime.strptime(m['time'].split(' ')[0], "%Y-%m-%d")
-                if time >= start and time <= end:
-                    daily_metrics.append(m)
+            daily_metrics += datapoint_series(datapoint, start, end)
     return {
         'status': 'ok',
         'date': {
@@ -166,7 +263,9 @@ def get_tags(tag:str,start:str=None, end:str=None,unit: str="day",):
 
 
 @app.get("/tag/{tag}/similar")
-def get_tags(tag:str,start:str=None, end:str=None,unit: str="day", ratio:float=1, top:int=5):
+@db_request
+@fast_json
+def get_similar_tags(tag:str,start:str=None, end:str=None,unit: str="day", ratio:float=1, top:int=5):
     if unit not in ['week', 'day', 'month', 'year']:
         return {
             'status': 'error',
@@ -191,29 +290,34 @@ def get_tags(tag:str,start:str=None, end:str=None,unit: str="day", ratio:float=1
 
     edit = int(len(tag)*ratio)
 
-    exp = NodeList([
-            SQL("levenshtein("),
-            DataPoint.value,
-            SQL(", '{}') <= {}".format(tag, edit)),
-            SQL(" order by levenshtein("),
-            DataPoint.value,
-            SQL(", '{}')".format(tag))
-            ], glue='')
-    datapoints = DataPoint.select().where(exp)
-
-    if datapoints.exists():
+    similar_tags = tag_index.similar(tag, edit, top)
+    backfilled = False
+    if similar_tags is not None:
+        series = tag_series(similar_tags, start, end)
+        # an empty range is an answer too once the tags are in TagMetric
+        backfilled = any([ len(points) > 0 for points in series.values() ]) or len(has_series(similar_tags)) > 0
+
+    if backfilled:
+        for similar_tag in similar_tags:
+            daily_metrics.append({
+                'tag': similar_tag,
+                'data': series[similar_tag]
+            })
+    else:
+        # cold tag index or TagMetric not backfilled yet
+        if similar_tags is None:
+            distance = fn.levenshtein(DataPoint.value, tag)
+            datapoints = DataPoint.select(DataPoint, Region).join(Region).where(distance <= edit).order_by(distance)
+        else:
+            datapoints = DataPoint.select(DataPoint, Region).join(Region).where(DataPoint.value.in_(similar_tags))
+            if len(similar_tags) > 0:
+                order = Case(DataPoint.value, [ (t, idx) for idx, t in enumerate(similar_tags) ])
+                datapoints = datapoints.order_by(order)
+
         for datapoint in datapoints[:top]:
-            datapoint_metrics = []
-            for point in datapoint.metrics:
-                m = point
-                m.pop('tag')
-                m['region'] = datapoint.region.region_id
-                time = datetime.strptime(m['time'].split(' ')[0], "%Y-%m-%d")
-                if time >= start and time <= end:
-                    datapoint_metrics.append(m)
             daily_metrics.append({
                 'tag': datapoint.value,
-                'data': datapoint_metrics
+                'data': datapoint_series(datapoint, start, end)
             })
     return {
         'status': 'ok',
@@ -225,116 +329,253 @@ def get_tags(tag:str,start:str=None, end:str=None,unit: str="day", ratio:float=1
     }
 
 
+# internal search columns, never part of a response
+SEARCH_VECTORS = [Video.search_vector, Channel.search_vector]
+# columns added after the listing format was fixed, not selected by /video
+UNLISTED_VIDEO_FIELDS = SEARCH_VECTORS + [Video.normalized_tags, Video.normalizer_version]
+LISTED_CHANNEL_FIELDS = [ f for f in Channel._meta.sorted_fields if f is not Channel.search_vector ]
+
 @app.get("/video")
-def list_video(search: str="", start:str=None, end:str=None, offset=0):
-    videos_query = Video.select(Video.title, Video.published, Video.id, Video.tags, Video.category_id, Video.duration, Video.channel)
+@db_request
+@fast_json
+def list_video(search: str="", start:str=None, end:str=None, limit: int=12, cursor: str=None):
+    # the channel (and its country) the listing has always returned, joined
+    # instead of loaded per video, without the search vector
+    videos_query = (Video
+        .select(Video.title, Video.published, Video.id, Video.tags, Video.category_id, Video.duration, Video.channel,
+            *LISTED_CHANNEL_FIELDS, Region)
+        .join(Channel)
+        .join(Region))
     if start is not None:
         start = dateparser.parse(str(start))
         videos_query = videos_query.where(Video.published >= start)
     if end is not None:
         end = dateparser.parse(str(end))
         videos_query = videos_query.where(Video.published <= end)
-    if search is not None:
+    if search is not None and len(search) > 0:
         search = str(search)
-        videos_query = videos_query.where(Match(Video.title, search) | Match(Video.description, search))
-    
+        videos_query = videos_query.where(search_match(Video, search))
 
-    videos = []
-    for idx, v in enumerate(videos_query[offset:]):
-        json_data = model_to_dict(v)
-        videos.append(json_data)
-        if idx > 10:
-            break
+    try:
+        rows, next_token = keyset_page(videos_query, (Video.published, Video.id),
+            clamp_limit(limit), cursor, descending=True)
+    except ValueError:
+        return {
+            'status': 'error',
+            'msg': "Invalid cursor"
+        }
 
+    videos = [ model_to_dict(v, exclude=UNLISTED_VIDEO_FIELDS) for v in rows ]
     return {
         'count': len(videos),
-        'videos': videos
+        'videos': videos,
+        'next': next_token,
     }
 
 @app.get("/video/{video_id}")
+@db_request
+@fast_json
 def get_video(video_id: str):
     try:
-        print(video_id)
+        logging.debug('video {}'.format(video_id))
         video = Video.get(Video.id==video_id)
         video_stats = Stats.get(Stats.video==video) 
-        video_dict = model_to_dict(video)
-        video_stats_ = model_to_dict(video_stats)
+        video_dict = model_to_dict(video, exclude=SEARCH_VECTORS)
+        video_stats_ = model_to_dict(video_stats, exclude=SEARCH_VECTORS)
 
         video_dict['statistic'] = video_stats_
         video_dict['status'] = 'success'
         return video_dict
     except BaseException as e:
-        # print(e)
+        logging.debug(e)
         return {
             'status': 'not found',
         }
 
 
 @app.get("/channel/{channel_id}")
+@db_request
+@fast_json
 def get_channel(channel_id: str):
-
+    '''
+        Compact channel summary, the videos are listed by /channel/{channel_id}/videos
+    '''
     try:
-        channel = Channel.get(Channel.channel_id==channel_id)
-        channel_ = model_to_dict(channel)
-        videos = Video.select().where(Video.channel==channel) 
-        videos_ = []
-        for v in videos:
-            videos_.append(model_to_dict(v))
-        channel_['videos'] = videos_
-        channel_['status'] = 'success'
-        return channel_
-    except BaseException as e:
-        print(e)
+        channel = (Channel
+            .select(Channel.channel_id, Channel.title, Channel.description, Channel.thumbnails, Channel.country, Region)
+            .join(Region)
+            .where(Channel.channel_id == channel_id)
+            .get())
+    except Channel.DoesNotExist:
         return {
             'status': 'not found',
         }
 
+    video_count, latest_published = (Video
+        .select(fn.COUNT(Video.id), fn.MAX(Video.published))
+        .where(Video.channel == channel_id)
+        .tuples()
+        .get())
+
+    # number of this channel's videos that trended in each region
+    trending = (Stats
+        .select(Region.region_id, fn.COUNT(Stats.id))
+        .join(Video, on=(Stats.video == Video.id))
+        .switch(Stats)
+        .join(Region, on=(Stats.trending_region == Region.id))
+        .where(Video.channel == channel_id)
+        .group_by(Region.region_id)
+        .tuples())
+
+    return {
+        'status': 'success',
+        'channel_id': channel.channel_id,
+        'title': channel.title,
+        'description': channel.description,
+        'thumbnails': channel.thumbnails,
+        'country': channel.country.region_id,
+        'video_count': video_count,
+        'latest_published': latest_published,
+        'trending': { region_id: count for region_id, count in trending },
+    }
+
+
+CHANNEL_VIDEO_FIELDS = [Video.id, Video.title, Video.published, Video.tags, Video.category_id, Video.duration]
+# heavy columns, only loaded when requested with ?fields=
+CHANNEL_VIDEO_EXTRA_FIELDS = {
+    'description': Video.description,
+    'thumbnails': Video.thumbnails,
+    'topic_details': Video.topic_details,
+    'localization': Video.localization,
+    'meta': Video.meta,
+}
+
+@app.get("/channel/{channel_id}/videos")
+@db_request
+@fast_json
+def list_channel_videos(channel_id: str, fields: str=None, limit: int=12, cursor: str=None):
+    if not Channel.select().where(Channel.channel_id == channel_id).exists():
+        return {
+            'status': 'not found',
+        }
+
+    selected = list(CHANNEL_VIDEO_FIELDS)
+    if fields is not None:
+        for name in fields.split(','):
+            name = name.strip()
+            if len(name) == 0:
+                continue
+            if name not in CHANNEL_VIDEO_EXTRA_FIELDS:
+                return {
+                    'status': 'error',
+                    'msg': "fields should be : {}".format(', '.join(CHANNEL_VIDEO_EXTRA_FIELDS))
+                }
+            if CHANNEL_VIDEO_EXTRA_FIELDS[name] not in selected:
+                selected.append(CHANNEL_VIDEO_EXTRA_FIELDS[name])
+
+    videos_query = Video.select(*selected).where(Video.channel == channel_id)
+    try:
+        rows, next_token = keyset_page(videos_query, (Video.published, Video.id),
+            clamp_limit(limit), cursor, descending=True)
+    except ValueError:
+        return {
+            'status': 'error',
+            'msg': "Invalid cursor"
+        }
+
+    videos = [ model_to_dict(v, recurse=False, only=selected) for v in rows ]
+    return {
+        'status': 'success',
+        'count': len(videos),
+        'videos': videos,
+        'next': next_token,
+    }
+
 @app.get("/channel")
-def list_channel(search: str=None, country: str=None ,offset=0):
+@db_request
+@fast_json
+def list_channel(search: str=None, country: str=None, limit: int=12, cursor: str=None):
 
-    channel_query = Channel.select(Channel.channel_id, Channel.title, Channel.description, Channel.country)
+    channel_query = (Channel
+        .select(Channel.channel_id, Channel.title, Channel.description, Channel.country, Region)
+        .join(Region))
 
     if search is not None:
-        print(search)
         search = str(search)
-        channel_query = channel_query.where(Match(Channel.title, search) | Match(Channel.description, search))
+        channel_query = channel_query.where(search_match(Channel, search))
 
     if country is not None:
-        print('search country')
-        region = Region.get(Region.region_id==country)
-        channel_query = channel_query.where(Channel.country == region)
+        channel_query = channel_query.where(Region.region_id == country)
 
-    channels = []
-    for idx, c in enumerate(channel_query[offset:]):
-        json_data = model_to_dict(c)
-        channels.append(json_data)
-        if idx > 10:
-            break
+    try:
+        rows, next_token = keyset_page(channel_query, (Channel.title, Channel.channel_id),
+            clamp_limit(limit), cursor)
+    except ValueError:
+        return {
+            'status': 'error',
+            'msg': "Invalid cursor"
+        }
 
+    channels = [ model_to_dict(c, exclude=SEARCH_VECTORS) for c in rows ]
     return {
         'count': len(channels),
-        'channels': channels
+        'channels': channels,
+        'next': next_token,
     }
 
 
 @app.get("/suggestion/{search}")
-def suggestion(search:str, ratio=0.5, top=20):
+@db_request
+@fast_json
+def suggestion(search:str, ratio: float=0.5, top: int=20):
 
     edit = int(len(search)*ratio)
 
-    exp = NodeList([
-            SQL("levenshtein("),
-            DataPoint.value,
-            SQL(", '{}') <= {}".format(search, edit)),
-            SQL(" order by levenshtein("),
-            DataPoint.value,
-            SQL(", '{}')".format(search))
-            ], glue='')
-    datapoints = DataPoint.select().where(exp)
-    tags = []
-    if datapoints.exists():
-        for datapoint in datapoints[:top]:
-            tags.append(datapoint.value)
+    tags = tag_index.complete(search, top)
+    if tags is None:
+        distance = fn.levenshtein(DataPoint.value, search)
+        datapoints = DataPoint.select(DataPoint.value).where(distance <= edit).order_by(distance)
+        tags = [ datapoint.value for datapoint in datapoints[:top] ]
+    elif len(tags) < top:
+        # fill up with close spellings when few tags share the prefix
+        for tag in tag_index.similar(search, edit, top):
+            if len(tags) >= top:
+                break
+            if tag not in tags:
+                tags.append(tag)
     return {
         'tags': tags
     }
+
+
+@app.get("/stats/cache")
+@db_request
+@fast_json
+def get_cache_stats():
+    return {
+        'status': 'ok',
+        'caches': cache_stats()
+    }
+
+@app.get("/metrics")
+def get_metrics():
+    pool = pool_stats()
+    extra = []
+    if pool['pooled']:
+        extra = [
+            ('yt_db_pool_in_use', 'Pooled connections checked out', 'gauge', pool['in_use']),
+            ('yt_db_pool_idle', 'Pooled connections ready for reuse', 'gauge', pool['idle']),
+            ('yt_db_pool_max', 'Pool size limit', 'gauge', pool['max_connections']),
+            ('yt_db_pool_wait_seconds_total', 'Time spent waiting on an exhausted pool', 'counter', pool['wait_total']),
+            ('yt_db_pool_timeouts_total', 'Requests that found no free connection in time', 'counter', pool['timeouts']),
+        ]
+    return Response(content=metrics.render(extra), media_type='text/plain; version=0.0.4')
+
+@app.get("/stats/db")
+@db_request
+@fast_json
+def get_db_stats():
+    return {
+        'status': 'ok',
+        'pool': pool_stats()
+    }
@@ -0,0 +1,193 @@
+'''
+    In process result cache for the trending functions
+
+    arguments are canonicalized before they reach the cache and the function:
+    datetimes are truncated to the day, the finest unit DailyTrend has, and
+    models are keyed by their id so equivalent calls share one entry. Entries
+    whose range reaches today expire after a TTL and are dropped when
+    LatestTrend of their region is refreshed: right away in the refreshing
+    process, through the region generations in cache.db (see version_source)
+    in every other one. Every entry is dropped once DailyTrend of one of its
+    regions changed, e.g. a past day inserted late.
+'''
+import time
+import inspect
+import functools
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from peewee import Model
+
+REGION_ARGUMENTS = ['region_id', 'region_ids', 'region']
+
+caches = []
+# returns the (LatestTrend, DailyTrend) generations of every region, cache.py
+# points it at the RegionVersion rows so a refresh in another process reaches
+# this one too
+version_source = None
+
+
+class ResultCache():
+    '''LRU cache with an optional TTL per entry and hit/miss/eviction counters
+    '''
+
+    def __init__(self, name, maxsize=512):
+        self.name = name
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, versions=None):
+        '''Returns (found, value), an entry set under other region versions
+            than the given ones counts as invalidated (see outdated)
+        '''
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and entry['expires'] is not None and entry['expires'] < time.time():
+                del self.data[key]
+                self.expirations += 1
+                entry = None
+            if entry is not None and outdated(entry, versions):
+                del self.data[key]
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return True, entry['value']
+
+    def set(self, key, value, ttl=None, regions=(), versions=None):
+        with self.lock:
+            self.data[key] = {
+                'value': value,
+                'expires': time.time() + ttl if ttl is not None else None,
+                'regions': regions,
+                'versions': versions,
+            }
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, region_id=None):
+        '''Drop the entries with a TTL, only those of region_id when given
+        '''
+        with self.lock:
+            keys = [ key for key, entry in self.data.items() if entry['expires'] is not None
+                and (region_id is None or region_id in entry['regions']) ]
+            for key in keys:
+                del self.data[key]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+def today():
+    now = datetime.now()
+    return datetime(year=now.year, month=now.month, day=now.day)
+
+def truncate(value):
+    if isinstance(value, datetime):
+        return datetime(year=value.year, month=value.month, day=value.day)
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+def canonical(value):
+    if isinstance(value, Model):
+        return getattr(value, 'region_id', None) or value.get_id()
+    if isinstance(value, (list, tuple)):
+        return tuple([ canonical(v) for v in value ])
+    return value
+
+def region_versions(regions):
+    '''Current generation of each region, None without a version_source
+    '''
+    if version_source is None:
+        return None
+    versions = version_source()
+    return tuple([ versions.get(region) for region in regions ])
+
+def _trends(versions):
+    if versions is None:
+        return None
+    return tuple([ v[1] if v is not None else None for v in versions ])
+
+def outdated(entry, versions):
+    '''Entries with a TTL depend on both generations of their regions, the
+        others (ranges before today) on DailyTrend only
+    '''
+    if entry['versions'] == versions:
+        return False
+    return entry['expires'] is not None or _trends(entry['versions']) != _trends(versions)
+
+def reaches_today(arguments):
+    end = arguments.get('end')
+    return end is None or end >= today()
+
+def memoize(maxsize=512, ttl=300, live=reaches_today):
+    '''Cache a function on its canonical arguments, calls for which live
+        returns True (by default a range ending today) expire after ttl seconds
+    '''
+    def decorator(func):
+        cache = ResultCache(func.__name__, maxsize)
+        caches.append(cache)
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = OrderedDict([ (name, truncate(value)) for name, value in bound.arguments.items() ])
+            key = tuple([ canonical(value) for value in arguments.values() ])
+
+            regions = ()
+            for name in REGION_ARGUMENTS:
+                if name in arguments:
+                    region = canonical(arguments[name])
+                    regions = region if isinstance(region, tuple) else (region,)
+            # read before computing, a refresh meanwhile makes the entry stale
+            versions = region_versions(regions)
+
+            found, value = cache.get(key, versions)
+            if found:
+                return value
+            value = func(**arguments)
+            cache.set(key, value, ttl=ttl if live(arguments) else None, regions=regions, versions=versions)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+def invalidate_region(region_id):
+    '''Called once LatestTrend of a region changed, other processes notice
+        through version_source
+    '''
+    return sum([ cache.invalidate(region_id) for cache in caches ])
+
+def cache_stats():
+    return { cache.name: cache.stats() for cache in caches }
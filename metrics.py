@@ -0,0 +1,176 @@
+'''
+    In process request metrics exported in the Prometheus text format on /metrics
+
+    MetricsMiddleware records latency per route template and the requests in
+    flight, span() times the phases (fetch, aggregate, freshness, serialize) of the
+    trending queries. Every gunicorn worker keeps its own registry, scrape each worker or
+    sum them in the query.
+'''
+import time
+import threading
+from contextlib import contextmanager
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _labels(names, values):
+    if len(names) == 0:
+        return ''
+    pairs = [ '{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for n, v in zip(names, values) ]
+    return '{' + ','.join(pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [ (self.name, self.labels, labels, value) for labels, value in sorted(self.values.items()) ]
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value=0):
+        with self.lock:
+            self.values[labels] = value
+
+class Histogram():
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = entry = self.values[labels]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        names = self.labels + ('le',)
+        result = []
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, c in zip(self.buckets, counts):
+                    cumulative += c
+                    result.append((self.name + '_bucket', names, labels + (_number(bound),), cumulative))
+                result.append((self.name + '_sum', self.labels, labels, total))
+                result.append((self.name + '_count', self.labels, labels, count))
+        return result
+
+
+registry = []
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+def render(extra=()):
+    '''Prometheus text exposition of every registered metric, extra holds
+        already collected (name, help, kind, value) gauges
+    '''
+    lines = []
+    for metric in registry:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for name, label_names, label_values, value in metric.samples():
+            lines.append('{}{} {}'.format(name, _labels(label_names, label_values), _number(value)))
+    for name, help, kind, value in extra:
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append('{} {}'.format(name, _number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+request_latency = register(Histogram('yt_request_duration_seconds',
+    'Request latency per route template', ('method', 'route', 'status')))
+requests_in_flight = register(Gauge('yt_requests_in_flight',
+    'Requests currently being served per route template', ('route',)))
+phase_latency = register(Histogram('yt_phase_duration_seconds',
+    'Time spent in a phase (fetch, aggregate, freshness, serialize) of a query', ('function', 'phase')))
+# observed by querytrace.stop_trace for every traced request, see QUERY_TRACE
+request_queries = register(Histogram('yt_request_queries',
+    'Queries run by a traced request per endpoint function', ('function',), buckets=QUERY_BUCKETS))
+request_db_time = register(Histogram('yt_request_db_seconds',
+    'Time spent in execute_sql by a traced request per endpoint function', ('function',)))
+
+
+@contextmanager
+def span(function, phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_latency.observe(time.perf_counter() - start, function, phase)
+
+
+def route_template(routes, scope):
+    '''Path template of the route serving scope, raw paths would give a
+        series per tag / video id
+    '''
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+class MetricsMiddleware():
+
+    def __init__(self, app, routes=()):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        route = route_template(self.routes, scope)
+        status = {'code': 500}
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+            await send(message)
+
+        requests_in_flight.inc(route)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_latency.observe(time.perf_counter() - start, scope['method'], route, status['code'])
+            requests_in_flight.dec(route)
@@ -2,18 +2,36 @@ import asyncio
 import logging
 from peewee import *
 from playhouse.postgres_ext import PostgresqlExtDatabase, JSONField, ArrayField, IntervalField, TSVectorField, BinaryJSONField
-from settings import POSTGRESQL_SETTINGS
+from playhouse.migrate import PostgresqlMigrator, migrate
+from settings import POSTGRESQL_SETTINGS, DB_POOL, DB_MAX_CONNECTIONS, DB_STALE_TIMEOUT, DB_POOL_TIMEOUT
+from db_pool import StatsPooledPostgresqlDatabase, TracedPostgresqlExtDatabase
 
 
+if DB_POOL:
+    postgres_database = StatsPooledPostgresqlDatabase(POSTGRESQL_SETTINGS['DATABASE'],
+        user=POSTGRESQL_SETTINGS['USER'],
+        host=POSTGRESQL_SETTINGS['HOST'],
+        port=POSTGRESQL_SETTINGS['PORT'],
+        password=POSTGRESQL_SETTINGS['PASSWORD'],
+        register_hstore=False,
+        max_connections=DB_MAX_CONNECTIONS,
+        stale_timeout=DB_STALE_TIMEOUT,
+        timeout=DB_POOL_TIMEOUT,
+        )
+else:
+    postgres_database = TracedPostgresqlExtDatabase(POSTGRESQL_SETTINGS['DATABASE'],
+        user=POSTGRESQL_SETTINGS['USER'],
+        host=POSTGRESQL_SETTINGS['HOST'],
+        port=POSTGRESQL_SETTINGS['PORT'],
+        password=POSTGRESQL_SETTINGS['PASSWORD'],
+        register_hstore=False,
+        )
+
 
-postgres_database = PostgresqlExtDatabase(POSTGRESQL_SETTINGS['DATABASE'],
-    user=POSTGRESQL_SETTINGS['USER'],
-    host=POSTGRESQL_SETTINGS['HOST'],
-    port=POSTGRESQL_SETTINGS['PORT'],
-    password=POSTGRESQL_SETTINGS['PASSWORD'],
-    register_hstore=False,
-    # stale_timeout=300,
-    )
+def pool_stats():
+    if isinstance(postgres_database, StatsPooledPostgresqlDatabase):
+        return postgres_database.pool_stats()
+    return { 'pooled': False }
 
 
 class BaseModel(Model):
@@ -39,6 +57,14 @@ class Channel(BaseModel):
     thumbnails = JSONField(default={})
     content_details = JSONField(default={})
     meta = JSONField(default={})
+    # see Video.search_vector
+    search_vector = TSVectorField(null=True)
+
+    class Meta:
+        indexes = (
+            # keyset pagination order of /channel
+            (("title", "channel_id"), False),
+        )
 
 
 class Video(BaseModel):
@@ -54,11 +80,13 @@ class Video(BaseModel):
     meta = JSONField(default={})
 
     description = CharField(max_length=6000)
-    '''
-        search_description=fn.to_tsvector(description))
-    '''
-    # search_description = TSVectorField()
+    # to_tsvector_multilang of title (weight A) and description (weight B),
+    # maintained by the search_vector_update trigger in fn.sql
+    search_vector = TSVectorField(null=True)
     tags = ArrayField(CharField)
+    # tags cleaned by utils.extract_video_unique_keyword at ingestion time
+    normalized_tags = ArrayField(CharField, null=True)
+    normalizer_version = IntegerField(default=0)
     category_id = IntegerField(default=0)
     duration = IntervalField() # timedelta
     caption = BooleanField(default=False)
@@ -71,6 +99,13 @@ class Video(BaseModel):
 
     channel = ForeignKeyField(Channel, backref='videos')
 
+    class Meta:
+        indexes = (
+            # keyset pagination order of /video
+            (("published", "id"), False),
+            (("channel", "published", "id"), False),
+        )
+
 class Statistic(BaseModel):
 
     date = DateTimeField()
@@ -101,7 +136,7 @@ class DailyTrend(BaseModel):
     class Meta:
         indexes = (
             (("region", "time"), True),
-            (("region"), False),
+            (("region",), False),
         )
 
 
@@ -128,9 +163,173 @@ class DataPoint(BaseModel):
             (("key", "value", "time", "region"), True),
         )
 
+class TagRollup(BaseModel):
+    '''
+        Running totals of a tag's DailyTrend metrics in one region, the totals of
+        a time window are the last row inside it minus the last row before it
+    '''
+    region = ForeignKeyField(Region)
+    time = DateTimeField() # DailyTrend.time of the day rolled up
+    tag = TextField()
+    # double precision, a REAL running total drifts once views reach millions
+    rank = DoubleField(default=0)
+    view = DoubleField(default=0)
+    comment = DoubleField(default=0)
+    like = DoubleField(default=0)
+    dislike = DoubleField(default=0)
+    entries = IntegerField(default=0)
+    category = ArrayField(IntegerField, default=[]) # categories seen on this day only, windows union them
+
+    class Meta:
+        indexes = (
+            (("region", "tag", "time"), True),
+            (("region", "time"), False),
+        )
+
+class RollupState(BaseModel):
+    region = ForeignKeyField(Region, unique=True)
+    time = DateTimeField(null=True) # latest DailyTrend.time included in TagRollup
+    mark = TextField(null=True) # count:max id of the DailyTrend rows up to time, see rollup.daily_mark
+    posting_time = DateTimeField(null=True) # latest DailyTrend.time included in TrendPosting
+    posting_mark = TextField(null=True) # count:max id of the DailyTrend rows up to posting_time
+
+class TrendTag(BaseModel):
+    '''
+        Dictionary of every tag seen in DailyTrend metrics
+    '''
+    tag = TextField(unique=True)
+
+class TrendPosting(BaseModel):
+    '''
+        Inverted index of DailyTrend: the (region, day) rows a tag appears in
+    '''
+    tag = ForeignKeyField(TrendTag, backref='postings')
+    region = ForeignKeyField(Region)
+    time = DateTimeField()
+
+    class Meta:
+        indexes = (
+            (("tag", "region", "time"), True),
+        )
+
+class TagFrequency(BaseModel):
+    '''
+        How many of a region's trending videos carry a tag, see frequency_stats.py
+    '''
+    region = ForeignKeyField(Region)
+    tag = TextField()
+    frequency = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (("region", "tag"), True),
+            (("region", "frequency"), False),
+        )
+
+class FrequencyState(BaseModel):
+    region = ForeignKeyField(Region, unique=True)
+    last_video = CharField(max_length=32, null=True) # last Video.id counted into TagFrequency
+    videos = IntegerField(default=0)
+    finished = BooleanField(default=False)
+    updated = DateTimeField(null=True)
+
+class BackfillState(BaseModel):
+    '''
+        Checkpoint of a backfill.run_backfill job, cleared once the job finishes
+    '''
+    name = CharField(max_length=64, unique=True)
+    last_id = CharField(max_length=64, null=True) # primary key of the last written batch
+    scanned = IntegerField(default=0)
+    changed = IntegerField(default=0)
+    finished = BooleanField(default=False)
+    updated = DateTimeField(null=True)
+
+class ChannelTag(BaseModel):
+    '''
+        How often a tag appears over a channel's videos, input of the blacklist
+    '''
+    channel = ForeignKeyField(Channel)
+    tag = TextField()
+    frequency = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (("channel", "tag"), True),
+        )
+
+class ChannelTagState(BaseModel):
+    channel = ForeignKeyField(Channel, unique=True)
+    videos = IntegerField(default=0)
+    last_published = DateTimeField(null=True) # newest Video.published counted into ChannelTag
+
+class TagMetric(BaseModel):
+    '''
+        DataPoint metrics stored one row per point, a tag's time series is a range scan
+    '''
+    tag = CharField(max_length=128)
+    region = ForeignKeyField(Region)
+    time = DateTimeField()
+    view = BigIntegerField(default=0)
+    like = BigIntegerField(default=0)
+    dislike = BigIntegerField(default=0)
+    comment = BigIntegerField(default=0)
+    rank = BigIntegerField(default=0)
+    point = JSONField(null=True) # the DataPoint point as stored, without its tag, returned as is
+
+    class Meta:
+        indexes = (
+            (("tag", "time", "region"), True),
+        )
+
 
 def create_table():
-    postgres_database.create_tables([DailyTrend, DataPoint, Activity, Stats, Statistic, Video, Channel])
+    postgres_database.create_tables([DailyTrend, DataPoint, Activity, Stats, Statistic, Video, Channel,
+        TagRollup, RollupState, TagMetric, TrendTag, TrendPosting, TagFrequency, FrequencyState, ChannelTag, ChannelTagState, BackfillState])
+def migrate_tables():
+    '''Add the columns and indexes introduced after the tables were first created
+    '''
+    migrator = PostgresqlMigrator(postgres_database)
+    new_columns = [
+        (Video, 'normalized_tags', ArrayField(CharField, null=True)),
+        (Video, 'normalizer_version', IntegerField(default=0)),
+        # TSVectorField carries a GIN index which add_column creates as well
+        (Video, 'search_vector', TSVectorField(null=True)),
+        (Channel, 'search_vector', TSVectorField(null=True)),
+        (RollupState, 'posting_time', DateTimeField(null=True)),
+        # states without a mark are rolled up again from their first day
+        (RollupState, 'mark', TextField(null=True)),
+        (RollupState, 'posting_mark', TextField(null=True)),
+        (TagMetric, 'point', JSONField(null=True)),
+    ]
+    operations = []
+    for model, column_name, field in new_columns:
+        table = model._meta.table_name
+        existing = [ c.name for c in postgres_database.get_columns(table) ]
+        if column_name not in existing:
+            operations.append(migrator.add_column(table, column_name, field))
+    new_indexes = [
+        (Channel, ('title', 'channel_id'), False),
+        (Video, ('published', 'id'), False),
+        (Video, ('channel_id', 'published', 'id'), False),
+    ]
+    for model, columns, unique in new_indexes:
+        table = model._meta.table_name
+        # get_indexes does not keep the column order of the index
+        existing = [ sorted(i.columns) for i in postgres_database.get_indexes(table) ]
+        if sorted(columns) not in existing:
+            operations.append(migrator.add_index(table, columns, unique))
+    migrate(*operations)
+    # TagRollup totals used to be REAL, run python rollup.py rebuild afterwards
+    for column in postgres_database.get_columns(TagRollup._meta.table_name):
+        if column.data_type == 'real':
+            postgres_database.execute_sql('ALTER TABLE "{}" ALTER COLUMN "{}" TYPE double precision'.format(
+                TagRollup._meta.table_name, column.name))
+    # TagMetric counts used to be REAL, run python tag_series.py afterwards to fill in point
+    for column in postgres_database.get_columns(TagMetric._meta.table_name):
+        if column.data_type == 'real':
+            postgres_database.execute_sql('ALTER TABLE "{0}" ALTER COLUMN "{1}" TYPE bigint USING round("{1}")'.format(
+                TagMetric._meta.table_name, column.name))
 
 if __name__ == '__main__':
-    create_table()
\ No newline at end of file
+    create_table()
+    migrate_tables()
\ No newline at end of file
@@ -0,0 +1,51 @@
+'''
+    Store normalized tags on Video so request handlers never run the normalizer
+
+    python normalize.py         normalize videos stored by an older normalizer version
+    python normalize.py all     re-normalize every video, e.g. after blacklist.txt changed
+
+    both take the backfill options --batch-size N, --dry-run and --restart
+'''
+import argparse
+import logging
+from models import Video, postgres_database
+from utils import tag_normalizer, NORMALIZER_VERSION
+from backfill import run_backfill, bulk_update_values, add_arguments
+
+FIELDS = [Video.normalized_tags, Video.normalizer_version]
+
+
+def normalize_videos(videos):
+    '''Ingestion hook, normalize and save the tags of freshly crawled videos
+    '''
+    rows = normalized_rows(videos)
+    for video, (_, tags, version) in zip(videos, rows):
+        video.normalized_tags = tags
+        video.normalizer_version = version
+    with postgres_database.atomic():
+        bulk_update_values(Video, rows, FIELDS)
+    return len(videos)
+
+def normalized_rows(videos):
+    return [ (video.id, tags, NORMALIZER_VERSION)
+        for video, tags in zip(videos, tag_normalizer.normalize_videos(videos)) ]
+
+def renormalize(force=False, batch_size=500, dry_run=False, restart=False):
+    '''Normalize every outdated video, or every video when force is set
+    '''
+    query = Video.select(Video.id, Video.tags, Video.meta)
+    if not force:
+        query = query.where(Video.normalizer_version < NORMALIZER_VERSION)
+    # separate checkpoints, a forced run must not resume an outdated-only one
+    name = 'normalized_tags_all' if force else 'normalized_tags'
+    _, changed = run_backfill(name, query, normalized_rows, FIELDS,
+        batch_size=batch_size, dry_run=dry_run, restart=restart)
+    logging.info('normalized {} videos to version {}'.format(changed, NORMALIZER_VERSION))
+    return changed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='store normalized video tags')
+    parser.add_argument('mode', nargs='?', choices=['all'])
+    args = add_arguments(parser, batch_size=500).parse_args()
+    renormalize(force=args.mode == 'all', batch_size=args.batch_size, dry_run=args.dry_run, restart=args.restart)
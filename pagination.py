@@ -0,0 +1,85 @@
+'''
+    Keyset pagination helpers
+
+    Listings are ordered on a unique column tuple, e.g. (published, id) for
+    videos. A page resumes after the last row of the previous one with a
+    row-value comparison, so each page is a bounded index range scan
+    instead of an OFFSET that grows with depth.
+
+    The position is handed to clients as an opaque `next` token
+    (urlsafe base64 of a JSON list of the key values).
+'''
+import base64
+import json
+from datetime import datetime
+from peewee import Tuple
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+MAX_LIMIT = 100
+
+
+def clamp_limit(limit, default=12):
+    if limit is None:
+        return default
+    return max(1, min(int(limit), MAX_LIMIT))
+
+
+def _dump(value):
+    if isinstance(value, datetime):
+        return {'dt': value.strftime(DATETIME_FORMAT)}
+    return value
+
+
+def _load(value):
+    if isinstance(value, dict) and 'dt' in value:
+        return datetime.strptime(value['dt'], DATETIME_FORMAT)
+    return value
+
+
+def encode_cursor(values):
+    raw = json.dumps([_dump(v) for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, size):
+    '''
+        Raises ValueError for tokens that were not produced by encode_cursor
+    '''
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        values = [_load(v) for v in values]
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError('invalid cursor') from e
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('invalid cursor')
+    return values
+
+
+def keyset_page(query, keys, limit, cursor=None, descending=False):
+    '''
+        Fetch one page of query ordered on keys (a tuple of fields that is
+        unique together), starting after cursor.
+
+        Returns (rows, next_token); next_token is None on the last page
+    '''
+    if descending:
+        query = query.order_by(*[k.desc() for k in keys])
+    else:
+        query = query.order_by(*keys)
+
+    if cursor:
+        values = decode_cursor(cursor, len(keys))
+        if descending:
+            query = query.where(Tuple(*keys) < Tuple(*values))
+        else:
+            query = query.where(Tuple(*keys) > Tuple(*values))
+
+    # one extra row tells whether another page exists
+    rows = list(query.limit(limit + 1))
+    next_token = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_token = encode_cursor([getattr(last, k.name) for k in keys])
+    return rows, next_token
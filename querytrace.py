@@ -0,0 +1,147 @@
+'''
+    Per request query tracing for postgres_database
+
+    A QueryTrace is kept in a thread local, like the connection state: a sync
+    endpoint runs in one threadpool thread from start to end, db_pool's
+    request_scope starts and stops the trace of every request around the
+    handler. Statements are fingerprinted (literals and IN list
+    lengths removed) and a fingerprint executed more than QUERY_REPEAT_THRESHOLD
+    times in one request is reported, the usual shape of an N+1 lazy FK load.
+
+    The time is measured around execute_sql, rows fetched lazily afterwards
+    are not included. With QUERY_TRACE on every request logs its query count
+    and db time at info and feeds the yt_request_queries and
+    yt_request_db_seconds histograms of /metrics.
+'''
+import re
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from collections import Counter
+from settings import QUERY_TRACE, QUERY_REPEAT_THRESHOLD, QUERY_TRACE_STRICT
+from metrics import request_queries, request_db_time
+
+_local = threading.local()
+# traces fed by every stopped trace, see collect()
+_collectors = []
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAM_LIST = re.compile(r'%s(?:\s*,\s*%s)+')
+_SPACE = re.compile(r'\s+')
+
+
+class RepeatedQueryError(Exception):
+    pass
+
+
+def fingerprint(sql):
+    '''Statement shape shared by every execution of the same query
+    '''
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _PARAM_LIST.sub('%s, ...', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+class QueryTrace():
+
+    def __init__(self, name=''):
+        self.name = name
+        self.count = 0
+        self.time = 0.0
+        self.fingerprints = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, sql, elapsed):
+        key = fingerprint(sql)
+        with self.lock:
+            self.count += 1
+            self.time += elapsed
+            self.fingerprints[key] += 1
+
+    def merge(self, other):
+        with other.lock:
+            count, elapsed, fingerprints = other.count, other.time, Counter(other.fingerprints)
+        with self.lock:
+            self.count += count
+            self.time += elapsed
+            self.fingerprints.update(fingerprints)
+
+    def repeated(self, threshold=QUERY_REPEAT_THRESHOLD):
+        with self.lock:
+            return [ (key, count) for key, count in self.fingerprints.most_common() if count > threshold ]
+
+    def summary(self, threshold=QUERY_REPEAT_THRESHOLD):
+        with self.lock:
+            result = {
+                'queries': self.count,
+                'db_time': self.time,
+                'distinct': len(self.fingerprints),
+                'max_repeat': max(self.fingerprints.values()) if self.fingerprints else 0,
+            }
+        result['repeated'] = [ {'fingerprint': key, 'count': count} for key, count in self.repeated(threshold) ]
+        return result
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+def start_trace(name=''):
+    '''Trace the queries of the current thread until stop_trace
+    '''
+    trace = QueryTrace(name)
+    _local.trace = trace
+    return trace
+
+def collecting():
+    return len(_collectors) > 0
+
+@contextmanager
+def collect(trace):
+    '''Merge every trace stopped in any thread into trace while the block
+        runs, e.g. the request traces of the endpoints a benchmark calls
+    '''
+    _collectors.append(trace)
+    try:
+        yield trace
+    finally:
+        _collectors.remove(trace)
+
+def stop_trace(trace, threshold=QUERY_REPEAT_THRESHOLD, strict=QUERY_TRACE_STRICT):
+    '''Log the trace, raise RepeatedQueryError in strict mode when a
+        fingerprint ran more than threshold times
+    '''
+    if current_trace() is trace:
+        _local.trace = None
+    for collector in list(_collectors):
+        if collector is not trace:
+            collector.merge(trace)
+    request_queries.observe(trace.count, trace.name)
+    request_db_time.observe(trace.time, trace.name)
+    # traces only started for a collector (benchmarks) stay at debug
+    logging.log(logging.INFO if QUERY_TRACE else logging.DEBUG,
+        '{}: {} queries, {:.1f}ms db time'.format(trace.name, trace.count, trace.time * 1000))
+    repeated = trace.repeated(threshold)
+    for key, count in repeated:
+        logging.warning('{}: query ran {} times, likely N+1: {}'.format(trace.name, count, key[:300]))
+    if strict and len(repeated) > 0:
+        raise RepeatedQueryError('{}: {} statements repeated, worst {} times: {}'.format(
+            trace.name, len(repeated), repeated[0][1], repeated[0][0][:300]))
+    return trace
+
+
+class TracedDatabaseMixin():
+    '''Record every execute_sql of a peewee database in the active trace
+    '''
+
+    def execute_sql(self, sql, *args, **kwargs):
+        trace = current_trace()
+        if trace is None:
+            return super().execute_sql(sql, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            trace.record(sql, time.perf_counter() - start)
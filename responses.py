@@ -0,0 +1,93 @@
+'''
+    JSON encoding shared by the endpoints and the response caches
+
+    Uses orjson when it is installed and falls back to the stdlib json module.
+    Both decode to the same values: NaN / Infinity (e.g. weights divided by a
+    zero entry count) become null, datetimes are ISO 8601, timedeltas seconds
+    and numpy scalars and arrays go through the same float conversion. The
+    bytes may differ where JSON allows it, e.g. orjson writes 1e16 for 1e+16.
+'''
+import json
+import math
+import functools
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from uuid import UUID
+from starlette.responses import Response
+import numpy as np
+from metrics import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    '''Types neither encoder handles natively
+    '''
+    if isinstance(obj, timedelta):
+        return obj.total_seconds()
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, (Decimal, np.floating)):
+        return _finite(float(obj))
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.ndarray):
+        return _clean(obj.tolist())
+    if isinstance(obj, (set, frozenset)):
+        return _clean(list(obj))
+    if isinstance(obj, (UUID, bytes)):
+        return str(obj) if isinstance(obj, UUID) else obj.decode('utf-8')
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+def _finite(value):
+    return value if math.isfinite(value) else None
+
+def _clean(obj):
+    '''Replace non finite floats with None, only needed by the stdlib path
+    '''
+    if isinstance(obj, float):
+        return _finite(obj)
+    if isinstance(obj, dict):
+        return { k: _clean(v) for k, v in obj.items() }
+    if isinstance(obj, (list, tuple)):
+        return [ _clean(v) for v in obj ]
+    return obj
+
+def dumps(payload):
+    '''Serialize payload to utf-8 JSON bytes
+    '''
+    with span('dumps', 'serialize'):
+        if orjson is not None:
+            # orjson writes NaN / Infinity as null on its own. numpy is left to
+            # _default, orjson would print float32 in its own shorter form
+            return orjson.dumps(payload, default=_default, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(_clean(payload), default=_default, ensure_ascii=False,
+            allow_nan=False, separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONResponse(Response):
+    '''JSONResponse without the jsonable_encoder pass, accepts already
+        serialized bytes (e.g. a cache hit) as content
+    '''
+    media_type = 'application/json'
+
+    def render(self, content):
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+
+def fast_json(func):
+    '''Wrap a route so the returned dict is encoded by FastJSONResponse,
+        Response objects are passed through untouched
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        if isinstance(result, Response):
+            return result
+        return FastJSONResponse(result)
+    return wrapper
@@ -0,0 +1,307 @@
+'''
+    Maintain TagRollup, the running per tag totals of DailyTrend metrics.
+    week, month and year windows are answered by subtracting two rows per tag
+    instead of decoding every DailyTrend row of the window.
+
+    TagRollup only holds a row for the days a tag trended, so a window still
+    reads the (tag, day) rollup rows inside it, O(tag days in the window), to
+    find its tags and union their categories. What it saves is the decoding
+    and summing of every metric entry of every DailyTrend row, the per tag
+    totals themselves cost two index probes.
+
+    Also maintain TrendPosting, the tag -> (region, day) inverted index used to
+    load only the DailyTrend rows a search matches.
+
+    RollupState keeps the row count and newest id of the DailyTrend rows a
+    region was rolled up (and indexed) to. A day inserted late changes that
+    mark, the rollup then counts as behind and the next run redoes it from
+    that day on.
+
+    python rollup.py            extend every region with its new DailyTrend rows
+    python rollup.py rebuild    drop and recompute every region
+'''
+import sys
+import logging
+from collections import defaultdict
+import pandas as pd
+from peewee import fn, NodeList, SQL
+from models import DailyTrend, Region, TagRollup, RollupState, TrendTag, TrendPosting, postgres_database
+
+TREND_COLUMNS = ['rank', 'view', 'comment', 'like', 'dislike']
+
+ROLLUP_UNITS = ['week', 'month', 'year']
+
+# table, progress and mark of the TagRollup (False) and TrendPosting (True) states
+PROGRESS = {
+    False: (TagRollup, RollupState.time, RollupState.mark),
+    True: (TrendPosting, RollupState.posting_time, RollupState.posting_mark),
+}
+
+# w holds one row per (region, tag) seen in the window: its last rolled up day
+# and the union of the categories of every day in the window, the same set the
+# raw DailyTrend path collects. e is the running total of that last day and s
+# the last total before the window, two probes of the (region, tag, time) index
+WINDOW_SQL = '''
+select e.region_id, e.tag, {diff}, e.entries - coalesce(s.entries, 0), w.category
+from (
+    select r.region_id, r.tag, max(r.time) as time,
+        coalesce(array_agg(distinct c) filter (where c is not null), '{{}}') as category
+    from {table} r
+    left join lateral unnest(r.category) c on true
+    where r.region_id in %s and r.time >= %s and r.time <= %s
+    group by r.region_id, r.tag
+) w
+join {table} e on e.region_id = w.region_id and e.tag = w.tag and e.time = w.time
+left join lateral (
+    select * from {table} p
+    where p.region_id = w.region_id and p.tag = w.tag and p.time < %s
+    order by p.time desc limit 1
+) s on true
+'''.format(
+    table=TagRollup._meta.table_name,
+    diff=', '.join([ 'e."{0}" - coalesce(s."{0}", 0)'.format(c) for c in TREND_COLUMNS ])
+)
+
+
+def daily_mark(region, until):
+    '''Row count and newest id of the region's DailyTrend rows up to until,
+        the same count:max-id mark cache.trend_marks keeps per region
+    '''
+    count, max_id = DailyTrend.select(fn.COUNT(DailyTrend.id), fn.MAX(DailyTrend.id)).where(
+        (DailyTrend.region == region) & (DailyTrend.time <= until)).tuples().get()
+    return '{}:{}'.format(count, max_id or 0)
+
+def first_changed_day(region, until, mark):
+    '''Earliest day up to until inserted after mark was taken, None when
+        rows went missing (or there is no mark) and the region must start over
+    '''
+    if mark is None:
+        return None
+    count, max_id = [ int(value) for value in mark.split(':') ]
+    kept = DailyTrend.select().where((DailyTrend.region == region) & (DailyTrend.time <= until) &
+        (DailyTrend.id <= max_id)).count()
+    if kept != count:
+        return None
+    return DailyTrend.select(fn.MIN(DailyTrend.time)).where((DailyTrend.region == region) &
+        (DailyTrend.time <= until) & (DailyTrend.id > max_id)).scalar()
+
+def rollup_covers(regions, end, postings=False):
+    '''Check every DailyTrend row up to end has already been rolled up and no
+        day was inserted late before the rolled up one, postings checks the
+        TrendPosting state instead of the TagRollup one
+    '''
+    progress, mark = PROGRESS[postings][1:]
+    states = {}
+    for region_id, time, state_mark in RollupState.select(RollupState.region, progress, mark).where(
+            RollupState.region.in_(regions)).tuples():
+        states[region_id] = (time, state_mark)
+
+    latest = DailyTrend.select(DailyTrend.region, fn.MAX(DailyTrend.time)).where(
+        (DailyTrend.region.in_(regions)) & (DailyTrend.time <= end)).group_by(DailyTrend.region)
+    for region_id, time in latest.tuples():
+        if region_id not in states or states[region_id][0] is None or states[region_id][0] < time:
+            return False
+
+    # the mark of the rows up to each region's own progress
+    marks = (DailyTrend
+        .select(DailyTrend.region, fn.COUNT(DailyTrend.id), fn.MAX(DailyTrend.id))
+        .join(RollupState, on=(RollupState.region == DailyTrend.region))
+        .where((DailyTrend.region.in_(regions)) & (DailyTrend.time <= progress))
+        .group_by(DailyTrend.region))
+    for region_id, count, max_id in marks.tuples():
+        if states[region_id][1] != '{}:{}'.format(count, max_id):
+            return False
+    return True
+
+def window_sums(regions, start, end):
+    '''Per (region, tag) metric totals, entry counts and categories of the
+        DailyTrend rows between start and end, None when the rollup lags behind
+        DailyTrend. Reads every rollup row of the window, see the module docstring
+
+        regions is a dict of region_id to Region as returned by utils.load_regions
+    '''
+    if len(regions) == 0:
+        return None
+    region_ids = { region.id: region_id for region_id, region in regions.items() }
+    if not rollup_covers(list(region_ids), end):
+        return None
+
+    cursor = postgres_database.execute_sql(WINDOW_SQL, (tuple(region_ids), start, end, start))
+    index, rows = [], []
+    for row in cursor.fetchall():
+        index.append((region_ids[row[0]], row[1]))
+        rows.append(row[2:])
+
+    columns = TREND_COLUMNS + ['entries', 'category']
+    if len(rows) == 0:
+        return pd.DataFrame(columns=columns)
+    index = pd.MultiIndex.from_tuples(index, names=['region', 'tag'])
+    return pd.DataFrame(rows, columns=columns, index=index)
+
+
+def rewind(region, state, postings=False):
+    '''Drop the TagRollup (or TrendPosting) rows from the first day inserted
+        late on, the running totals after it are all off and a day replaced
+        since may have lost tags
+    '''
+    table, progress, mark = PROGRESS[postings]
+    day = first_changed_day(region, getattr(state, progress.name), getattr(state, mark.name))
+    with postgres_database.atomic():
+        query = table.delete().where(table.region == region)
+        if day is not None:
+            query = query.where(table.time >= day)
+        query.execute()
+        time = None
+        if day is not None:
+            time = table.select(fn.MAX(table.time)).where(table.region == region).scalar()
+        setattr(state, progress.name, time)
+        setattr(state, mark.name, daily_mark(region, time) if time is not None else None)
+        state.save(only=[progress, mark])
+    logging.info('{} {} redone from {}'.format(table.__name__, region.region_id, day or 'the first day'))
+
+def extend_rollup(region, batch_size=1000):
+    '''Append the DailyTrend rows newer than the region's RollupState,
+        every day is committed together with the state so a crash resumes cleanly.
+        A day inserted late before the state rewinds the rollup to that day first
+    '''
+    state, _ = RollupState.get_or_create(region=region)
+    if state.time is not None and state.mark != daily_mark(region, state.time):
+        rewind(region, state)
+    count, max_id = [ int(value) for value in (state.mark or '0:0').split(':') ]
+
+    totals = {}
+    if state.time is not None:
+        latest = TagRollup.select().where(TagRollup.region == region).order_by(
+            TagRollup.tag, TagRollup.time.desc()).distinct(TagRollup.tag)
+        for row in latest:
+            totals[row.tag] = [ getattr(row, c) for c in TREND_COLUMNS ] + [row.entries]
+
+    daily_trends = DailyTrend.select().where(DailyTrend.region == region).order_by(DailyTrend.time)
+    if state.time is not None:
+        daily_trends = daily_trends.where(DailyTrend.time > state.time)
+
+    days = 0
+    for trend in daily_trends.iterator():
+        day = defaultdict(lambda: [0] * (len(TREND_COLUMNS) + 1))
+        categories = defaultdict(set)
+        for metric in trend.metrics:
+            tag = metric['tag'].replace('#', '')
+            sums = day[tag]
+            for idx, c in enumerate(TREND_COLUMNS):
+                sums[idx] += float(metric['stats'][c])
+            sums[-1] += 1
+            categories[tag].update(metric.get('category', [-1]))
+
+        rows = []
+        for tag, sums in day.items():
+            total = [ a + b for a, b in zip(totals.get(tag, [0] * len(sums)), sums) ]
+            totals[tag] = total
+            row = dict(zip(TREND_COLUMNS, total[:-1]))
+            row.update(region=region, time=trend.time, tag=tag,
+                entries=total[-1], category=sorted(categories[tag]))
+            rows.append(row)
+
+        # one row per (region, day), the mark moves by one row at a time
+        count, max_id = count + 1, max(max_id, trend.id)
+        with postgres_database.atomic():
+            for idx in range(0, len(rows), batch_size):
+                TagRollup.insert_many(rows[idx:idx+batch_size]).execute()
+            state.time = trend.time
+            state.mark = '{}:{}'.format(count, max_id)
+            state.save(only=[RollupState.time, RollupState.mark])
+        days += 1
+    return days
+
+
+def _tag_ids(tags, known, batch_size=1000):
+    '''Map tags to TrendTag ids, adding the ones not in the dictionary yet
+    '''
+    missing = [ tag for tag in tags if tag not in known ]
+    for idx in range(0, len(missing), batch_size):
+        chunk = missing[idx:idx+batch_size]
+        TrendTag.insert_many([ {'tag': tag} for tag in chunk ]).on_conflict_ignore().execute()
+        for tag_id, tag in TrendTag.select(TrendTag.id, TrendTag.tag).where(TrendTag.tag.in_(chunk)).tuples():
+            known[tag] = tag_id
+    return [ known[tag] for tag in tags ]
+
+def extend_postings(region, batch_size=1000, known=None):
+    '''Index the DailyTrend rows newer than the region's posting_time,
+        committed per day together with the state like extend_rollup
+    '''
+    state, _ = RollupState.get_or_create(region=region)
+    if state.posting_time is not None and state.posting_mark != daily_mark(region, state.posting_time):
+        rewind(region, state, postings=True)
+    count, max_id = [ int(value) for value in (state.posting_mark or '0:0').split(':') ]
+    known = {} if known is None else known
+
+    daily_trends = DailyTrend.select(DailyTrend.id, DailyTrend.time, DailyTrend.metrics).where(
+        DailyTrend.region == region).order_by(DailyTrend.time)
+    if state.posting_time is not None:
+        daily_trends = daily_trends.where(DailyTrend.time > state.posting_time)
+
+    days = 0
+    for trend_id, time, metrics in daily_trends.tuples().iterator():
+        tags = sorted({ metric['tag'].replace('#', '') for metric in metrics })
+        count, max_id = count + 1, max(max_id, trend_id)
+        with postgres_database.atomic():
+            rows = [ {'tag': tag_id, 'region': region, 'time': time}
+                for tag_id in _tag_ids(tags, known, batch_size) ]
+            for idx in range(0, len(rows), batch_size):
+                TrendPosting.insert_many(rows[idx:idx+batch_size]).on_conflict_ignore().execute()
+            state.posting_time = time
+            state.posting_mark = '{}:{}'.format(count, max_id)
+            state.save(only=[RollupState.posting_time, RollupState.posting_mark])
+        days += 1
+    return days
+
+def tag_match(search):
+    '''DailyTrend rows holding a tag that contains search, the scan used while
+        the posting index lags behind. Tags are compared like extend_postings
+        stores them, without '#', so both paths return the same days
+    '''
+    return NodeList([
+        SQL("case when jsonb_typeof("), DailyTrend.metrics,
+        SQL(") = 'array' then exists (select 1 from jsonb_array_elements("), DailyTrend.metrics,
+        SQL(") m where strpos(replace(m->>'tag', '#', ''), %s) > 0) else false end", (search,)),
+        ], glue='')
+
+def posting_days(region_ids, start, end, search):
+    '''Subquery of the (region, time) DailyTrend keys holding a tag that contains
+        search, None when the posting index lags behind DailyTrend
+    '''
+    regions = [ r for r, in Region.select(Region.id).where(Region.region_id.in_(list(region_ids))).tuples() ]
+    if len(regions) == 0 or not rollup_covers(regions, end, postings=True):
+        return None
+
+    # substring match on the tag dictionary, the same test as tag_match
+    tags = TrendTag.select(TrendTag.id).where(fn.strpos(TrendTag.tag, search) > 0)
+    return (TrendPosting
+        .select(TrendPosting.region, TrendPosting.time)
+        .where(
+            TrendPosting.tag.in_(tags) &
+            TrendPosting.region.in_(regions) &
+            (TrendPosting.time >= start) & (TrendPosting.time <= end))
+        .distinct())
+
+
+def rebuild_rollup(region):
+    with postgres_database.atomic():
+        TagRollup.delete().where(TagRollup.region == region).execute()
+        TrendPosting.delete().where(TrendPosting.region == region).execute()
+        RollupState.delete().where(RollupState.region == region).execute()
+    return extend_rollup(region)
+
+def refresh_rollups(rebuild=False):
+    known = {}
+    for region in Region.select():
+        if rebuild:
+            count = rebuild_rollup(region)
+        else:
+            count = extend_rollup(region)
+        postings = extend_postings(region, known=known)
+        logging.info('rollup {} added {} days, indexed {} days'.format(region.region_id, count, postings))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s : %(message)s')
+    refresh_rollups(rebuild=len(sys.argv) > 1 and sys.argv[1] == 'rebuild')
@@ -0,0 +1,60 @@
+'''
+    Stored search vectors for video / channel search
+
+    Video.search_vector and Channel.search_vector hold to_tsvector_multilang of
+    title (weight A) and description (weight B) behind a GIN index. New writes
+    are covered by the search_vector_update trigger in fn.sql, this module
+    fills the rows written before it.
+
+    python search_index.py          fill rows with an empty search_vector
+    python search_index.py all      rebuild every row, e.g. after fn.sql changed
+'''
+import sys
+import logging
+from tqdm import tqdm
+from peewee import Expression, fn
+from models import Video, Channel, postgres_database
+
+
+def search_vector(model):
+    '''Same expression as the search_vector_update trigger
+    '''
+    return (fn.setweight(fn.to_tsvector_multilang(fn.coalesce(model.title, '')), 'A')
+        .concat(fn.setweight(fn.to_tsvector_multilang(fn.coalesce(model.description, '')), 'B')))
+
+def search_match(model, search):
+    '''model.search_vector @@ to_tsquery_multilang(search), served by the GIN index
+    '''
+    return Expression(model.search_vector, '@@', fn.to_tsquery_multilang(search))
+
+def backfill(model, force=False, batch_size=1000):
+    '''Walk model by primary key and compute search_vector in batches,
+        each batch is its own transaction so the table is never locked for long
+    '''
+    pk = model._meta.primary_key
+    query = model.select(pk).order_by(pk)
+    if not force:
+        query = query.where(model.search_vector.is_null())
+
+    last_id, total = None, 0
+    with tqdm(desc=model._meta.table_name) as pbar:
+        while True:
+            batch = query
+            if last_id is not None:
+                batch = batch.where(pk > last_id)
+            ids = [ row[0] for row in batch.limit(batch_size).tuples() ]
+            if len(ids) == 0:
+                break
+            with postgres_database.atomic():
+                model.update(search_vector=search_vector(model)).where(pk.in_(ids)).execute()
+            total += len(ids)
+            last_id = ids[-1]
+            pbar.update(len(ids))
+    logging.info('indexed {} {} rows'.format(total, model._meta.table_name))
+    return total
+
+
+if __name__ == '__main__':
+    force = len(sys.argv) > 1 and sys.argv[1] == 'all'
+    for model in (Channel, Video):
+        backfill(model, force=force)
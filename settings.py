@@ -3,7 +3,14 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
-DEBUG = True
+# QUERY_TRACE=1 counts the queries of every request and warns when one statement
+# runs more than QUERY_REPEAT_THRESHOLD times, QUERY_TRACE_STRICT=1 fails the request instead
+QUERY_TRACE = int(os.getenv('QUERY_TRACE', 0)) > 0
+QUERY_REPEAT_THRESHOLD = int(os.getenv('QUERY_REPEAT_THRESHOLD', 10))
+QUERY_TRACE_STRICT = int(os.getenv('QUERY_TRACE_STRICT', 0)) > 0
+
+# DEBUG=1 logs the per request details at debug level
+DEBUG = int(os.getenv('DEBUG', 0)) > 0
 
 POSTGRESQL_SETTINGS = {
     'DATABASE': os.getenv('DATABASE'),
@@ -13,3 +20,27 @@ POSTGRESQL_SETTINGS = {
     'PASSWORD': os.getenv('PASSWORD'),
 }
 
+# upper bound of postgres connections a single worker may hold, size it so
+# workers * DB_MAX_CONNECTIONS stays below postgres max_connections
+DB_MAX_CONNECTIONS = int(os.getenv('DB_MAX_CONNECTIONS', 20))
+# DB_POOL=0 falls back to one unpooled connection per thread
+DB_POOL = int(os.getenv('DB_POOL', 1)) > 0
+# pooled connections idle for longer than this many seconds are recycled
+DB_STALE_TIMEOUT = int(os.getenv('DB_STALE_TIMEOUT', 300))
+# seconds a request waits for a free pooled connection before failing
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 10))
+
+# threads used by /main to fetch regions concurrently, each holds one connection
+MAIN_WORKERS = int(os.getenv('MAIN_WORKERS', max(1, DB_MAX_CONNECTIONS // 2)))
+
+# cross worker result cache stored in cache.db
+SHARED_CACHE_BYTES = int(os.getenv('SHARED_CACHE_BYTES', 256 * 1024 * 1024))
+SHARED_CACHE_TTL = int(os.getenv('SHARED_CACHE_TTL', 300))
+
+# LatestTrend refresh, REFRESH_INTERVAL seconds between runs inside the api
+# process, 0 leaves it to python cache.py every <seconds>
+REFRESH_INTERVAL = int(os.getenv('REFRESH_INTERVAL', 0))
+REFRESH_PROCESSES = int(os.getenv('REFRESH_PROCESSES', 4))
+
+# processes counting tag frequencies in python frequency_stats.py frequency
+FREQUENCY_PROCESSES = int(os.getenv('FREQUENCY_PROCESSES', 4))
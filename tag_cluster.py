@@ -0,0 +1,149 @@
+'''
+    Tag clustering with candidate blocking
+
+    fuzz.ratio is 2 * LCS / (len(a) + len(b)), and the LCS of two tags is at most
+    the number of characters they share (counted with repeats). A pair can only
+    score above the threshold when that overlap reaches
+    ceil((threshold + 0.5) / 200 * (len(a) + len(b))), which also rules out tags
+    of very different lengths. Every tag is indexed by its numbered characters,
+    one bincount over the postings of a tag's characters gives its overlap with
+    every other tag, and only the pairs reaching the bound are scored. This
+    gives the same clusters as scoring every pair.
+
+    Short Latin tags share a common letter with most of the vocabulary, so
+    asking for a single shared character (or a prefix of rare characters, which
+    for them is every character) barely prunes anything. The bound grows with
+    the length of both tags and halves the scored pairs on the Latin tags of
+    test.txt.
+
+    python tag_cluster.py [test.txt]    benchmark against the pairwise version
+'''
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+import numpy as np
+from fuzzywuzzy import fuzz
+
+
+def _char_tokens(tag):
+    '''Characters of a tag as a set, repeated characters are numbered
+        so the set overlap equals the multiset overlap
+    '''
+    seen = Counter()
+    tokens = []
+    for ch in tag:
+        seen[ch] += 1
+        tokens.append((ch, seen[ch]))
+    return tokens
+
+
+class TagClusterer():
+    '''Cluster (tag, value) pairs, every not yet clustered tag gathers all tags
+        scoring above threshold, the longest one represents the cluster with
+        the averaged value
+    '''
+
+    def __init__(self, threshold=30):
+        self.threshold = threshold
+        # smallest 2 * LCS / (len(a) + len(b)) that rounds above threshold
+        self.half_ratio = (threshold + 0.5) / 200
+
+    def min_overlap(self, length, lengths):
+        '''Characters a tag of this length must share with tags of the given
+            lengths (numpy array) to score above threshold
+        '''
+        return np.ceil(self.half_ratio * (length + lengths) - 1e-9)
+
+    def candidates(self, tags):
+        '''Map every tag index to the indexes that may score above threshold
+        '''
+        tokens = [ _char_tokens(tag) for tag in tags ]
+        index = defaultdict(list)
+        for idx, t in enumerate(tokens):
+            for token in t:
+                index[token].append(idx)
+        index = { token: np.array(ids, dtype=np.int32) for token, ids in index.items() }
+        lengths = np.array([ len(tag) for tag in tags ])
+
+        def lookup(idx):
+            if len(tokens[idx]) == 0:
+                return []
+            overlap = np.bincount(np.concatenate([ index[token] for token in tokens[idx] ]),
+                minlength=len(tags))
+            return np.flatnonzero(overlap >= self.min_overlap(lengths[idx], lengths)).tolist()
+        return lookup
+
+    def cluster(self, tag_pair):
+        valid = [ (tag, value) for tag, value in tag_pair if len(tag) > 1 ]
+        tags = [ tag for tag, _ in valid ]
+        lookup = self.candidates(tags)
+
+        final_tag = []
+        added_tag = set()
+        for idx, (tag, _) in enumerate(valid):
+            if tag in added_tag:
+                continue
+
+            similar_tag = []
+            for j in lookup(idx):
+                match_score = fuzz.ratio(tag, tags[j])
+                if match_score > self.threshold:
+                    similar_tag.append((match_score, tags[j], valid[j][1]))
+
+            similar_tag.sort(key=lambda x: len(x[1]), reverse=True)
+            total_value = 0
+            for _, _tag, value in similar_tag:
+                total_value += value
+                added_tag.add(_tag)
+            final_tag.append((similar_tag[0][1], total_value/len(similar_tag) ))
+        return final_tag
+
+
+def pairwise_cluster(tag_pair, threshold=30):
+    '''Reference implementation scoring every pair
+    '''
+    final_tag = []
+    added_tag = set()
+    for tag, _ in tag_pair:
+        if tag in added_tag or len(tag) <= 1:
+            continue
+        similar_tag = [ (fuzz.ratio(tag, tag2), tag2, value) for tag2, value in tag_pair
+            if len(tag2) > 1 and fuzz.ratio(tag, tag2) > threshold ]
+        similar_tag.sort(key=lambda x: len(x[1]), reverse=True)
+        for _, _tag, _ in similar_tag:
+            added_tag.add(_tag)
+        final_tag.append((similar_tag[0][1], sum([ v for _, _, v in similar_tag ])/len(similar_tag)))
+    return final_tag
+
+def _benchmark(name, tags):
+    tag_pair = [ (tag, idx % 100) for idx, tag in enumerate(tags) ]
+
+    start = time.time()
+    expected = pairwise_cluster(tag_pair)
+    pairwise_time = time.time() - start
+
+    clusterer = TagClusterer()
+    start = time.time()
+    result = clusterer.cluster(tag_pair)
+    blocked_time = time.time() - start
+
+    # pairs each version would score if every tag started a cluster
+    valid = [ tag for tag in tags if len(tag) > 1 ]
+    lookup = clusterer.candidates(valid)
+    candidates = sum(len(lookup(idx)) for idx in range(len(valid)))
+    print('{}: {} tags, {} clusters, pairs {} -> {} candidates, pairwise {:.3f}s, blocked {:.3f}s, identical {}'.format(
+        name, len(tag_pair), len(result), len(valid) ** 2, candidates, pairwise_time, blocked_time, result == expected))
+
+def benchmark(path='test.txt'):
+    from tag_normalizer import load_samples
+    tags = []
+    for sample, _ in load_samples(path):
+        tags += sample
+    tags = list(dict.fromkeys(tags))
+    _benchmark('all', tags)
+    _benchmark('latin', [ tag for tag in tags if re.fullmatch(r'[\x20-\x7e]+', tag) ])
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else 'test.txt')
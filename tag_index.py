@@ -0,0 +1,287 @@
+'''
+    In memory indexes over the distinct DataPoint tag vocabulary, loaded in a
+    background thread at startup and refreshed incrementally by DataPoint.id.
+    Callers fall back to SQL while an index is still cold.
+'''
+import time
+import heapq
+import bisect
+import logging
+import threading
+import unicodedata
+import multiprocessing as mp
+import numpy as np
+import Levenshtein
+from peewee import fn, Case
+from models import DataPoint, postgres_database
+
+
+class BKTree():
+    '''Burkhard-Keller tree under the levenshtein distance, the same metric as
+        the fuzzystrmatch levenshtein function
+    '''
+
+    def __init__(self, distance=Levenshtein.distance):
+        self.distance = distance
+        self.root = None
+        self.size = 0
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            self.size += 1
+            return True
+        node = self.root
+        while True:
+            d = self.distance(word, node[0])
+            if d == 0:
+                return False
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = (word, {})
+                self.size += 1
+                return True
+            node = child
+
+    def nearest(self, word, radius, top):
+        '''Up to top (distance, word) pairs within radius, closest first,
+            the radius shrinks to the k-th best distance once top words are found
+        '''
+        if self.root is None or top <= 0:
+            return []
+        best = []
+        stack = [self.root]
+        while stack:
+            node_word, children = stack.pop()
+            d = self.distance(word, node_word)
+            if d <= radius:
+                heapq.heappush(best, (-d, node_word))
+                if len(best) > top:
+                    heapq.heappop(best)
+                if len(best) == top:
+                    radius = -best[0][0]
+            # push the farthest branches first so the closest are visited first
+            branches = [ (abs(k - d), child) for k, child in list(children.items()) if d - radius <= k <= d + radius ]
+            branches.sort(key=lambda x: x[0], reverse=True)
+            stack += [ child for _, child in branches ]
+        return sorted([ (-d, w) for d, w in best ])
+
+
+def normalize_key(text):
+    '''Lowercased NFKC form, full width latin and digits fold to ascii
+    '''
+    return unicodedata.normalize('NFKC', text).casefold().replace('#', '').strip()
+
+def is_cjk(ch):
+    '''Han, kana and CJK punctuation, scripts written without spaces
+    '''
+    code = ord(ch)
+    return (0x3000 <= code <= 0x30ff or 0x3400 <= code <= 0x4dbf or 0x4e00 <= code <= 0x9fff
+        or 0xf900 <= code <= 0xfaff or 0x20000 <= code <= 0x2fa1f)
+
+def completion_keys(tag, max_keys=16):
+    '''The normalized tag and its suffixes starting at every word, inside CJK
+        text every character may start a word
+    '''
+    key = normalize_key(tag)
+    keys = []
+    for idx, ch in enumerate(key):
+        if ch.isspace():
+            continue
+        if idx == 0 or key[idx-1].isspace() or is_cjk(ch) or not key[idx-1].isalnum():
+            keys.append(key[idx:])
+            if len(keys) >= max_keys:
+                break
+    return keys
+
+
+def sorted_entries(popularity):
+    '''Every completion key in key order as (tag id, offset into the
+        normalized tag) int arrays, with the tags, their normalized form and
+        the popularity of every entry. TagIndex.refresh runs it in a spawned
+        process so the sort never holds the GIL of an API worker, the result
+        is a few arrays and two lists of strings, cheap to send back
+    '''
+    tags = list(popularity)
+    normalized = [ normalize_key(tag) for tag in tags ]
+    entries = [ (key, tag_id, len(normalized[tag_id]) - len(key))
+        for tag_id, tag in enumerate(tags) for key in completion_keys(tag) ]
+    entries.sort(key=lambda x: x[0])
+    tag_ids = np.array([ e[1] for e in entries ], dtype=np.int32)
+    offsets = np.array([ e[2] for e in entries ], dtype=np.int32)
+    scores = np.array([ popularity[tag] for tag in tags ], dtype=np.int64)[tag_ids]
+    return tags, normalized, tag_ids, offsets, scores
+
+
+class CompletionKeys():
+    '''Read only sequence of the sorted completion keys for bisect, a key is
+        sliced from its normalized tag on access instead of being stored
+    '''
+
+    def __init__(self, normalized, tag_ids, offsets):
+        self.normalized = normalized
+        self.tag_ids = tag_ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.tag_ids)
+
+    def __getitem__(self, idx):
+        return self.normalized[self.tag_ids[idx]][self.offsets[idx]:]
+
+
+class PrefixIndex():
+    '''Sorted completion keys with a sparse table over the most popular entry
+        of every block of BLOCK entries
+
+        a prefix maps to one contiguous range found by binary search, the most
+        popular entries of the range are popped from a heap of sub ranges. An
+        argmax scans at most two partial blocks and looks up the sparse table
+        for the whole blocks between them, a lookup costs
+        O(log n + k (BLOCK + log k)). Building is a few numpy passes over the
+        scores, the table takes (n / BLOCK) log(n / BLOCK) ints
+    '''
+    BLOCK = 64
+
+    def __init__(self, tags, normalized, tag_ids, offsets, scores):
+        self.tags = tags
+        self.tag_ids = tag_ids
+        self.keys = CompletionKeys(normalized, tag_ids, offsets)
+        self.scores = scores
+
+        blocks = -(-len(scores) // self.BLOCK)
+        padded = np.full(blocks * self.BLOCK, -1, dtype=np.int64)
+        padded[:len(scores)] = scores
+        # sparse[j][i] is the index of the most popular entry in blocks [i, i + 2^j)
+        first = padded.reshape(blocks, self.BLOCK).argmax(axis=1) + np.arange(blocks) * self.BLOCK
+        self.sparse = [ first.astype(np.int32) ]
+        width = 1
+        while width * 2 <= blocks:
+            prev = self.sparse[-1]
+            a, b = prev[:len(prev) - width], prev[width:]
+            # ties go to the lower index, the first entry in key order
+            self.sparse.append(np.where(scores[a] >= scores[b], a, b))
+            width *= 2
+
+    @classmethod
+    def from_popularity(cls, popularity):
+        return cls(*sorted_entries(popularity))
+
+    def _scan(self, lo, hi):
+        return lo + int(self.scores[lo:hi].argmax())
+
+    def _argmax(self, lo, hi):
+        first, last = -(-lo // self.BLOCK), hi // self.BLOCK
+        if first >= last:
+            return self._scan(lo, hi)
+        level = (last - first).bit_length() - 1
+        table = self.sparse[level]
+        candidates = [ int(table[first]), int(table[last - (1 << level)]) ]
+        if lo < first * self.BLOCK:
+            candidates.append(self._scan(lo, first * self.BLOCK))
+        if last * self.BLOCK < hi:
+            candidates.append(self._scan(last * self.BLOCK, hi))
+        return min(candidates, key=lambda i: (-self.scores[i], i))
+
+    def complete(self, prefix, top):
+        prefix = normalize_key(prefix)
+        if len(prefix) == 0 or top <= 0:
+            return []
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_right(self.keys, prefix + chr(0x10ffff))
+
+        result = []
+        heap = []
+        if lo < hi:
+            best = self._argmax(lo, hi)
+            heap.append((-self.scores[best], best, lo, hi))
+        while heap and len(result) < top:
+            _, best, lo, hi = heapq.heappop(heap)
+            tag = self.tags[self.tag_ids[best]]
+            if tag not in result:
+                result.append(tag)
+            for sub_lo, sub_hi in ((lo, best), (best + 1, hi)):
+                if sub_lo < sub_hi:
+                    sub_best = self._argmax(sub_lo, sub_hi)
+                    heapq.heappush(heap, (-self.scores[sub_best], sub_best, sub_lo, sub_hi))
+        return result
+
+
+class TagIndex():
+
+    def __init__(self, refresh_interval=600):
+        self.refresh_interval = refresh_interval
+        self.tree = BKTree()
+        self.popularity = {}
+        self.prefix = None
+        self.last_id = 0
+        self.ready = False
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        '''Add the values of DataPoint rows created since the last refresh,
+            new rows change the popularity of their tags so the prefix index
+            is rebuilt whenever there are any
+        '''
+        with self.lock:
+            start = time.time()
+            with postgres_database.connection_context():
+                # popularity is the number of daily points a tag has trended for
+                points = Case(None, [ (fn.json_typeof(DataPoint.metrics) == 'array',
+                    fn.json_array_length(DataPoint.metrics)) ], 0)
+                query = DataPoint.select(DataPoint.value, fn.MAX(DataPoint.id), fn.SUM(points)).where(
+                    DataPoint.id > self.last_id).group_by(DataPoint.value)
+                rows = list(query.tuples())
+            last_id, added = self.last_id, 0
+            popularity = dict(self.popularity)
+            for value, max_id, count in rows:
+                if self.tree.add(value):
+                    added += 1
+                popularity[value] = popularity.get(value, 0) + int(count or 0)
+                last_id = max(last_id, max_id)
+            if len(rows) > 0 or self.prefix is None:
+                with mp.get_context('spawn').Pool(1) as pool:
+                    entries = pool.apply(sorted_entries, (popularity,))
+                self.prefix = PrefixIndex(*entries)
+            self.popularity = popularity
+            self.last_id = last_id
+            self.loaded_at = time.time()
+            self.ready = True
+            logging.info('tag index added {} tags, updated {}, {} total in {:.2f}s'.format(
+                added, len(rows), self.tree.size, self.loaded_at - start))
+
+    def refresh_async(self):
+        if self.lock.locked():
+            return
+        thread = threading.Thread(target=self._refresh, daemon=True)
+        thread.start()
+
+    def _refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logging.exception(e)
+
+    def maybe_refresh(self):
+        if self.loaded_at is not None and time.time() - self.loaded_at > self.refresh_interval:
+            self.refresh_async()
+
+    def similar(self, tag, edit, top):
+        '''Tags within edit distance closest first, None while the index is cold
+        '''
+        if not self.ready:
+            return None
+        self.maybe_refresh()
+        return [ word for _, word in self.tree.nearest(tag, edit, top) ]
+
+    def complete(self, prefix, top):
+        '''Most popular tags starting with prefix, None while the index is cold
+        '''
+        if not self.ready:
+            return None
+        self.maybe_refresh()
+        return self.prefix.complete(prefix, top)
+
+
+tag_index = TagIndex()
@@ -0,0 +1,161 @@
+'''
+    Compiled tag normalizer shared by the ingestion jobs
+
+    python tag_normalizer.py [test.txt] [rounds]    benchmark throughput in tags per second
+'''
+import os
+import re
+import sys
+import ast
+import time
+from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils as fuzz_utils
+
+SPLIT_PATTERN = re.compile(r',|、|，|】')
+
+
+def match_key(tag):
+    '''Key under which process.extractBests scores two tags 100,
+        tags written only in non ascii characters fall back to their unicode form
+    '''
+    key = fuzz_utils.full_process(tag, force_ascii=True)
+    if len(key) == 0:
+        key = fuzz_utils.full_process(tag)
+    return key
+
+def channel_title(video):
+    if 'channel' in video.meta and 'title' in video.meta['channel']:
+        return video.meta['channel']['title']
+    return ''
+
+
+class TagNormalizer():
+    '''Split, filter and deduplicate raw video tags
+
+        the blacklist is a frozenset so every lookup is a single hash probe,
+        the channel title similarity is scored once per distinct (tag, title)
+        pair within a batch and duplicates collapse on their match_key
+        instead of running extractBests against every other tag.
+
+        the blacklist file is reloaded when its mtime changes, checked at
+        most once every reload_interval seconds
+    '''
+
+    def __init__(self, blacklist_path='blacklist.txt', channel_threshold=30, reload_interval=30):
+        self.blacklist_path = blacklist_path
+        self.channel_threshold = channel_threshold
+        self.reload_interval = reload_interval
+        self.blacklist = frozenset()
+        self.mtime = None
+        self.checked = 0
+        self.load()
+
+    def load(self):
+        mtime = os.path.getmtime(self.blacklist_path)
+        with open(self.blacklist_path, 'r') as f:
+            self.blacklist = frozenset([ tag.strip() for tag in f ])
+        self.mtime = mtime
+        self.checked = time.time()
+
+    def reload_if_changed(self):
+        '''Reload the blacklist after frequency_stats.py blacklist replaced it
+        '''
+        now = time.time()
+        if now - self.checked < self.reload_interval:
+            return False
+        self.checked = now
+        try:
+            mtime = os.path.getmtime(self.blacklist_path)
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        self.load()
+        return True
+
+    def split(self, tags):
+        cleaned_tags = []
+        for tag in tags:
+            cleaned_tags += SPLIT_PATTERN.split(tag)
+        return cleaned_tags
+
+    def normalize(self, tags, title=''):
+        return self.normalize_many([(tags, title)])[0]
+
+    def normalize_videos(self, videos):
+        return self.normalize_many([ (video.tags, channel_title(video)) for video in videos ])
+
+    def normalize_many(self, items):
+        '''Normalize a batch of (raw tags, channel title) pairs,
+            returns one tag list per pair
+        '''
+        self.reload_if_changed()
+        scores = {}
+        results = []
+        for tags, title in items:
+            cleaned_tags = self.split(tags)
+
+            # the first tag of every key wins, same as extractBests on ties
+            canonical = {}
+            for tag in cleaned_tags:
+                key = match_key(tag)
+                if key not in canonical:
+                    canonical[key] = tag
+
+            result = set()
+            for tag in cleaned_tags:
+                if len(tag) <= 1:
+                    continue
+                if tag[:3] == 'sp:':
+                    continue
+                if tag in self.blacklist:
+                    continue
+                if len(title) != 0:
+                    pair = (tag, title)
+                    if pair not in scores:
+                        scores[pair] = fuzz.ratio(tag, title)
+                    if scores[pair] > self.channel_threshold:
+                        continue
+                result.add(canonical[match_key(tag)])
+            results.append(list(result))
+        return results
+
+
+def load_samples(path):
+    '''Tag lists of test.txt, every sample is a title line followed by a tag list
+    '''
+    samples = []
+    title = ''
+    for line in open(path, 'r'):
+        line = line.strip()
+        try:
+            tags = ast.literal_eval(line)
+        except (ValueError, SyntaxError):
+            tags = None
+        if isinstance(tags, list):
+            samples.append((tags, title))
+        elif len(line) > 0:
+            title = line
+    return samples
+
+def benchmark(path='test.txt', rounds=200):
+    start = time.time()
+    normalizer = TagNormalizer()
+    load_time = time.time() - start
+
+    samples = load_samples(path)
+    tag_count = sum([ len(tags) for tags, _ in samples ]) * rounds
+
+    start = time.time()
+    for _ in range(rounds):
+        normalizer.normalize_many(samples)
+    elapsed = time.time() - start
+    print('blacklist {} tags loaded in {:.3f}s'.format(len(normalizer.blacklist), load_time))
+    print('{} videos x {} rounds, {} tags in {:.3f}s, {:.0f} tags/s'.format(
+        len(samples), rounds, tag_count, elapsed, tag_count / elapsed))
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'test.txt'
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    benchmark(path, rounds)
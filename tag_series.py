@@ -0,0 +1,128 @@
+'''
+    Keep TagMetric, the columnar copy of DataPoint metrics, so /tag/{tag}
+    pushes the date range down to an index range scan
+
+    python tag_series.py              copy the tag DataPoint rows added since the last run
+    python tag_series.py --restart    copy every tag DataPoint again
+
+    The id of the last copied DataPoint is kept in BackfillState (tag_metric),
+    every run only reads the rows after it, run it after every crawl
+'''
+import logging
+import argparse
+from datetime import datetime, timedelta
+from dateutil import parser
+from peewee import fn
+from tqdm import tqdm
+from models import DataPoint, TagMetric, Region, BackfillState, postgres_database
+
+METRIC_COLUMNS = ['view', 'like', 'dislike', 'comment', 'rank']
+
+STATE_NAME = 'tag_metric'
+
+
+def point_rows(datapoint):
+    if not isinstance(datapoint.metrics, list):
+        return []
+    rows = []
+    for point in datapoint.metrics:
+        row = {
+            'tag': datapoint.value,
+            'region': datapoint.region_id,
+            'time': parser.parse(point['time']),
+            'point': { k: v for k, v in point.items() if k != 'tag' },
+        }
+        for c in METRIC_COLUMNS:
+            row[c] = int(float(point.get(c) or 0))
+        rows.append(row)
+    return rows
+
+def sync_datapoints(datapoints, batch_size=1000):
+    '''Write path hook, upsert the points of the given DataPoint rows
+    '''
+    rows = {}
+    for datapoint in datapoints:
+        for row in point_rows(datapoint):
+            rows[(row['tag'], row['time'], row['region'])] = row
+    rows = list(rows.values())
+    with postgres_database.atomic():
+        for idx in range(0, len(rows), batch_size):
+            TagMetric.insert_many(rows[idx:idx+batch_size]).on_conflict(
+                conflict_target=[TagMetric.tag, TagMetric.time, TagMetric.region],
+                preserve=[ getattr(TagMetric, c) for c in METRIC_COLUMNS + ['point'] ]).execute()
+    return len(rows)
+
+def backfill(batch_size=500, restart=False):
+    '''Upsert the points of the tag DataPoint rows after the checkpoint, which
+        moves in the same transaction as every batch. Unlike backfill.run_backfill
+        a finished run keeps its checkpoint, the next one picks up the new rows
+    '''
+    state, _ = BackfillState.get_or_create(name=STATE_NAME)
+    if restart or state.last_id is None:
+        state.last_id, state.scanned, state.changed = None, 0, 0
+    last_id = int(state.last_id or 0)
+
+    query = DataPoint.select().where(DataPoint.key == 'tag').order_by(DataPoint.id)
+    total = 0
+    with tqdm(desc=STATE_NAME) as pbar:
+        while True:
+            datapoints = list(query.where(DataPoint.id > last_id).limit(batch_size))
+            if len(datapoints) == 0:
+                break
+            last_id = datapoints[-1].id
+            with postgres_database.atomic():
+                stored = sync_datapoints(datapoints)
+                state.last_id = str(last_id)
+                state.scanned += len(datapoints)
+                state.changed += stored
+                state.updated = datetime.now()
+                state.save()
+            total += stored
+            pbar.update(len(datapoints))
+    logging.info('stored {} tag metric points, copied up to DataPoint {}'.format(total, last_id))
+    return total
+
+
+def tag_series(tags, start: datetime, end: datetime):
+    '''Points of every tag whose day falls between start and end, keyed by tag
+
+        the day bounds are turned into a half open time range so postgres can
+        use the (tag, time) index. A point is returned the way DataPoint stores
+        it plus its region, rows written before TagMetric kept the point are
+        rendered from their columns until the next backfill
+    '''
+    lower = datetime(year=start.year, month=start.month, day=start.day)
+    if lower < start:
+        lower += timedelta(days=1)
+    upper = datetime(year=end.year, month=end.month, day=end.day) + timedelta(days=1)
+
+    columns = [ getattr(TagMetric, c) for c in METRIC_COLUMNS ]
+    query = TagMetric.select(TagMetric.tag,
+            fn.to_char(TagMetric.time, 'YYYY-MM-DD HH24:MI:SS').alias('time'),
+            Region.region_id.alias('region'), *columns, TagMetric.point).join(Region).where(
+            (TagMetric.tag.in_(list(tags))) & (TagMetric.time >= lower) & (TagMetric.time < upper)
+        ).order_by(TagMetric.time)
+
+    series = { tag: [] for tag in tags }
+    for row in query.dicts():
+        tag, point = row.pop('tag'), row.pop('point')
+        if point is not None:
+            point['region'] = row['region']
+            row = point
+        series[tag].append(row)
+    return series
+
+def has_series(tags):
+    '''Tags of the given ones which have any TagMetric row
+    '''
+    query = TagMetric.select(TagMetric.tag).where(TagMetric.tag.in_(list(tags))).distinct()
+    return { tag for tag, in query.tuples() }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s : %(message)s')
+    parser = argparse.ArgumentParser(description='Copy tag DataPoint metrics into TagMetric')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--restart', action='store_true', help='copy every DataPoint again')
+    args = parser.parse_args()
+    backfill(batch_size=args.batch_size, restart=args.restart)
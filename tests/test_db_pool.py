@@ -0,0 +1,93 @@
+import os
+import json
+import asyncio
+import threading
+import pytest
+from fastapi import FastAPI
+from peewee import SqliteDatabase
+from db_pool import request_scope, StatsPooledPostgresqlDatabase
+
+
+async def asgi_get(app, path):
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('ascii'),
+        'root_path': '',
+        'query_string': query.encode('ascii'),
+        'headers': [(b'host', b'test')],
+        'client': ('127.0.0.1', 0),
+        'server': ('test', 80),
+    }
+    response = {'status': None, 'body': b''}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            response['body'] += message.get('body', b'')
+
+    await app(scope, receive, send)
+    return response['status'], json.loads(response['body'])
+
+
+def test_concurrent_requests_never_share_a_connection(tmp_path):
+    database = SqliteDatabase(str(tmp_path / 'test.db'))
+    db_request = request_scope(database)
+    # both handlers hold their connection at the same time
+    barrier = threading.Barrier(2, timeout=10)
+    connections = {}
+
+    app = FastAPI()
+
+    @app.get('/hold/{name}')
+    @db_request
+    def hold(name: str):
+        database.execute_sql('SELECT 1')
+        first = database.connection()
+        barrier.wait()
+        database.execute_sql('SELECT 2')
+        connections[name] = (first, database.connection())
+        return {'name': name}
+
+    async def run():
+        return await asyncio.gather(asgi_get(app, '/hold/a'), asgi_get(app, '/hold/b'))
+
+    loop = asyncio.new_event_loop()
+    try:
+        responses = loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+    assert [ status for status, _ in responses ] == [200, 200]
+    a_first, a_second = connections['a']
+    b_first, b_second = connections['b']
+    # a request keeps its connection and never sees the other one
+    assert a_first is a_second
+    assert b_first is b_second
+    assert a_first is not b_first
+    # and gives it back once the handler returned
+    for conn in (a_first, b_first):
+        with pytest.raises(Exception):
+            conn.execute('SELECT 1')
+
+
+@pytest.mark.skipif(not os.getenv('TEST_DATABASE'), reason='TEST_DATABASE names a scratch postgres database')
+def test_pool_counts_new_connections_only():
+    database = StatsPooledPostgresqlDatabase(os.getenv('TEST_DATABASE'),
+        host=os.getenv('TEST_HOST'), port=os.getenv('TEST_PORT'), user=os.getenv('TEST_USER'),
+        password=os.getenv('TEST_PASSWORD'), register_hstore=False, max_connections=4)
+    for _ in range(5):
+        with database.connection_context():
+            database.execute_sql('SELECT 1')
+    stats = database.pool_stats()
+    assert stats['acquired'] == 5
+    assert stats['opened'] == 1
+    database.close_all()
@@ -0,0 +1,107 @@
+from datetime import datetime
+import memo
+from memo import memoize
+
+
+def test_region_versions_drop_outdated_entries(monkeypatch):
+    versions = {'TW': (1, 1), 'US': (1, 1)}
+    monkeypatch.setattr(memo, 'version_source', lambda: versions)
+    calls = []
+
+    @memoize(ttl=300)
+    def trend(region_id, end=None):
+        calls.append(region_id)
+        return len(calls)
+
+    @memoize(ttl=300, live=lambda arguments: False)
+    def history(region_id):
+        calls.append(region_id)
+        return len(calls)
+
+    assert (trend('TW'), trend('TW'), trend('US'), history('TW')) == (1, 1, 2, 3)
+    # another process refreshed TW
+    versions['TW'] = (2, 1)
+    assert trend('TW') == 4
+    assert trend('US') == 2
+    # entries without a TTL never depend on today's data
+    assert history('TW') == 3
+    # but a past day of TW landed late
+    versions['TW'] = (2, 2)
+    assert (trend('TW'), history('TW'), trend('US')) == (5, 6, 2)
+    assert trend.cache.stats()['invalidations'] == 2
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_applies_to_ranges_reaching_today(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(memo.time, 'time', clock)
+    calls = []
+
+    @memoize(ttl=300)
+    def trend(region_id, end=None):
+        calls.append(end)
+        return len(calls)
+
+    past = datetime(2020, 1, 1)
+    assert (trend('TW'), trend('TW', end=past)) == (1, 2)
+    clock.now += 299
+    assert (trend('TW'), trend('TW', end=past)) == (1, 2)
+    clock.now += 2
+    # today's entry expired, the past range never does
+    assert (trend('TW'), trend('TW', end=past)) == (3, 2)
+    clock.now += 10 ** 6
+    assert trend('TW', end=past) == 2
+    assert trend.cache.stats()['expirations'] == 1
+
+
+def test_lru_evicts_the_least_recently_used():
+    @memoize(maxsize=2)
+    def square(x):
+        return x * x
+
+    square(1)
+    square(2)
+    square(1)
+    square(3)
+    stats = square.cache.stats()
+    assert (stats['size'], stats['evictions'], stats['hits'], stats['misses']) == (2, 1, 1, 3)
+    # 2 was evicted, 1 was touched after it
+    assert sorted(square.cache.data) == [(1,), (3,)]
+
+
+def test_equivalent_calls_share_an_entry():
+    calls = []
+
+    @memoize()
+    def topics(region_ids, start=None, end=None):
+        calls.append(region_ids)
+        return len(calls)
+
+    end = datetime(2020, 1, 2)
+    assert topics(['TW', 'US'], end=datetime(2020, 1, 2, 13, 45)) == 1
+    assert topics(('TW', 'US'), None, end) == 1
+    assert topics(region_ids=('TW', 'US'), end=end) == 1
+    assert topics(('US', 'TW'), end=end) == 2
+    # the function sees the canonical arguments too
+    assert calls == [('TW', 'US'), ('US', 'TW')]
+    # an ended range keeps its regions for invalidate_region
+    assert topics.cache.data[(('TW', 'US'), None, end)]['regions'] == ('TW', 'US')
+
+
+def test_invalidate_region_drops_live_entries_only():
+    @memoize(ttl=300)
+    def trend(region_id, end=None):
+        return region_id
+
+    trend('TW')
+    trend('US')
+    trend('TW', end=datetime(2020, 1, 1))
+    assert memo.invalidate_region('TW') >= 1
+    assert sorted(key[0] for key in trend.cache.data) == ['TW', 'US']
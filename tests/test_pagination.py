@@ -0,0 +1,69 @@
+import base64
+from datetime import datetime, timedelta
+import pytest
+from peewee import SqliteDatabase, Model, CharField, DateTimeField
+from pagination import encode_cursor, decode_cursor, keyset_page, clamp_limit
+
+database = SqliteDatabase(':memory:')
+
+
+class Item(Model):
+    published = DateTimeField()
+    name = CharField()
+
+    class Meta:
+        database = database
+
+
+@pytest.fixture
+def items():
+    database.connect()
+    database.create_tables([Item])
+    start = datetime(2020, 1, 1, 12, 30, 15, 250)
+    # repeated timestamps so the name breaks the ties
+    Item.insert_many([ {'published': start + timedelta(hours=idx // 3), 'name': 'item{:02d}'.format(idx)}
+        for idx in range(25) ]).execute()
+    yield
+    database.drop_tables([Item])
+    database.close()
+
+
+def test_cursor_round_trip():
+    values = [datetime(2020, 1, 2, 3, 4, 5, 678), 'UCxyz', 42, None, '台灣']
+    token = encode_cursor(values)
+    assert '=' not in token and '+' not in token and '/' not in token
+    assert decode_cursor(token, len(values)) == values
+
+
+@pytest.mark.parametrize('token', ['', 'not a cursor', '!!!!', base64.urlsafe_b64encode(b'{"a": 1}').decode('ascii'),
+    base64.urlsafe_b64encode(b'\xff\xfe').decode('ascii')])
+def test_decode_rejects_foreign_tokens(token):
+    with pytest.raises(ValueError):
+        decode_cursor(token, 2)
+
+
+def test_decode_rejects_other_sizes():
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(['a', 1]), 3)
+
+
+def test_clamp_limit():
+    assert clamp_limit(None) == 12
+    assert clamp_limit(0) == 1
+    assert clamp_limit('20') == 20
+    assert clamp_limit(10000) == 100
+
+
+@pytest.mark.parametrize('descending', [False, True])
+def test_pages_walk_every_row_once(items, descending):
+    keys = (Item.published, Item.name)
+    expected = sorted(Item.select(), key=lambda i: (i.published, i.name), reverse=descending)
+    seen, cursor, pages = [], None, 0
+    while True:
+        rows, cursor = keyset_page(Item.select(), keys, 4, cursor=cursor, descending=descending)
+        seen += rows
+        pages += 1
+        if cursor is None:
+            break
+    assert [ i.name for i in seen ] == [ i.name for i in expected ]
+    assert pages == 7
@@ -0,0 +1,92 @@
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from peewee import SqliteDatabase
+from querytrace import TracedDatabaseMixin, QueryTrace, fingerprint, current_trace, collect, RepeatedQueryError
+import db_pool
+import metrics
+
+
+class TracedSqliteDatabase(TracedDatabaseMixin, SqliteDatabase):
+    pass
+
+
+def test_fingerprint_drops_literals():
+    assert fingerprint("SELECT * FROM t WHERE a = 'x' AND b = 12") == fingerprint("SELECT * FROM t WHERE a = 'y''z' AND b = 3")
+    assert fingerprint('SELECT 1 WHERE a IN (%s, %s, %s)') == fingerprint('SELECT 1 WHERE a IN (%s, %s)')
+
+
+def test_interleaved_requests_keep_their_own_trace(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_pool, 'QUERY_TRACE', True)
+    database = TracedSqliteDatabase(str(tmp_path / 'trace.db'))
+    traces = {}
+    # a runs its first query, b runs all of its queries, then a finishes
+    a_started, b_done = threading.Event(), threading.Event()
+
+    @db_pool.request_scope(database)
+    def request_a():
+        traces['a'] = current_trace()
+        database.execute_sql('SELECT 1')
+        a_started.set()
+        assert b_done.wait(10)
+        database.execute_sql('SELECT 1')
+
+    @db_pool.request_scope(database)
+    def request_b():
+        assert a_started.wait(10)
+        traces['b'] = current_trace()
+        for _ in range(5):
+            database.execute_sql('SELECT 2')
+        b_done.set()
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for future in [ pool.submit(request_a), pool.submit(request_b) ]:
+            future.result()
+
+    a, b = traces['a'], traces['b']
+    assert a is not b
+    assert a.count == 2
+    assert list(a.fingerprints) == ['SELECT ?']
+    assert b.count == 5
+    assert b.fingerprints[fingerprint('SELECT 2')] == 5
+    assert current_trace() is None
+    # exported next to the phase histograms
+    counts, total, observed = metrics.request_queries.values[('request_b',)]
+    assert (total, observed) == (5, 1)
+    assert metrics.request_db_time.values[('request_b',)][2] == 1
+
+
+def test_request_scope_traces_into_collector(tmp_path, ):
+    database = TracedSqliteDatabase(str(tmp_path / 'trace.db'))
+
+    @db_pool.request_scope(database)
+    def handler(n):
+        for _ in range(n):
+            database.execute_sql('SELECT 1')
+        return n
+
+    collector = QueryTrace('collector')
+    with collect(collector):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            assert list(pool.map(handler, [2, 3])) == [2, 3]
+    assert collector.count == 5
+    # outside of collect the handlers are not traced
+    handler(1)
+    assert collector.count == 5
+
+
+def test_strict_mode_fails_the_request(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_pool, 'QUERY_TRACE', True)
+    monkeypatch.setattr(db_pool, 'QUERY_TRACE_STRICT', True)
+    database = TracedSqliteDatabase(str(tmp_path / 'trace.db'))
+
+    @db_pool.request_scope(database)
+    def handler(n):
+        for _ in range(n):
+            database.execute_sql('SELECT 1')
+        return n
+
+    assert handler(10) == 10
+    with pytest.raises(RepeatedQueryError):
+        handler(11)
+    assert database.is_closed()
@@ -0,0 +1,49 @@
+import json
+import math
+from uuid import UUID
+from decimal import Decimal
+from datetime import date, datetime, timedelta, timezone
+import numpy as np
+import pytest
+import responses
+
+PAYLOAD = {
+    'status': 'ok',
+    'date': {'start': date(2020, 1, 2), 'end': datetime(2020, 1, 3, 4, 5, 6, 789)},
+    'results': [
+        {'tag': '台灣 lofi', 'view': 12345678901, 'ratio': 0.1, 'big': 1e16, 'small': 1e-7, 'neg': -2.5,
+            'weight': float('nan'), 'score': float('inf'), 'rank': None, 'hot': True},
+        {'tag': 'np', 'view': np.int64(42), 'ratio': np.float32(0.1), 'score': np.float64(1 / 3),
+            'nan': np.float64('nan'), 'series': np.array([0.5, 0.1, np.nan], dtype=np.float32),
+            'counts': np.arange(3)},
+    ],
+    'meta': {1: 'int key', 'duration': timedelta(minutes=1, microseconds=5), 'total': Decimal('12.50'),
+        'tags': {'only'}, 'id': UUID(int=1), 'raw': b'bytes', 'pair': (1, 2),
+        'refreshed': datetime(2020, 1, 3, tzinfo=timezone.utc)},
+}
+
+
+def stdlib_dumps(payload, monkeypatch):
+    monkeypatch.setattr(responses, 'orjson', None)
+    return responses.dumps(payload)
+
+
+def test_stdlib_encoder(monkeypatch):
+    document = json.loads(stdlib_dumps(PAYLOAD, monkeypatch))
+    first, second = document['results']
+    assert first['weight'] is None and first['score'] is None
+    assert first['big'] == 1e16 and first['view'] == 12345678901
+    assert second['ratio'] == float(np.float32(0.1))
+    assert second['series'] == [0.5, float(np.float32(0.1)), None]
+    assert document['date'] == {'start': '2020-01-02', 'end': '2020-01-03T04:05:06.000789'}
+    assert document['meta']['1'] == 'int key'
+    assert document['meta']['duration'] == 60.000005
+    assert document['meta']['refreshed'] == '2020-01-03T00:00:00+00:00'
+
+
+def test_encoders_agree(monkeypatch):
+    pytest.importorskip('orjson')
+    fast = responses.dumps(PAYLOAD)
+    slow = stdlib_dumps(PAYLOAD, monkeypatch)
+    assert json.loads(fast) == json.loads(slow)
+    assert not any(isinstance(v, float) and not math.isfinite(v) for v in json.loads(fast)['results'][0].values())
@@ -0,0 +1,87 @@
+import os
+from datetime import datetime, timedelta
+import pytest
+from models import postgres_database, Region, DailyTrend, TagRollup, RollupState, TrendTag, TrendPosting
+from rollup import extend_rollup, extend_postings, rebuild_rollup, rollup_covers, window_sums, posting_days, tag_match
+
+pytestmark = pytest.mark.skipif(not os.getenv('TEST_DATABASE'), reason='TEST_DATABASE names a scratch postgres database')
+
+TABLES = [Region, DailyTrend, TagRollup, RollupState, TrendTag, TrendPosting]
+
+
+@pytest.fixture
+def region():
+    postgres_database.init(os.getenv('TEST_DATABASE'), host=os.getenv('TEST_HOST'), port=os.getenv('TEST_PORT'),
+        user=os.getenv('TEST_USER'), password=os.getenv('TEST_PASSWORD'))
+    postgres_database.create_tables(TABLES)
+    try:
+        yield Region.create(name='Taiwan', region_id='TW')
+    finally:
+        postgres_database.drop_tables(TABLES)
+        postgres_database.close()
+
+
+def day_metrics(n):
+    return [ {'tag': tag, 'category': [10], 'stats': {'rank': n, 'view': 100 * n, 'comment': n, 'like': n, 'dislike': 0}}
+        for tag in ('lofi', 'chill')[:1 + n % 2] ]
+
+
+def sums(region, start, end):
+    df = window_sums({region.region_id: region}, start, end)
+    return None if df is None else df.sort_index().to_dict()
+
+
+def test_late_day_is_rolled_up_again(region):
+    first = datetime(2020, 1, 1)
+    days = [ first + timedelta(days=n) for n in range(8) ]
+    for n, time in enumerate(days):
+        if n != 3:
+            DailyTrend.create(region=region, time=time, metrics=day_metrics(n))
+    assert extend_rollup(region) == 7
+    assert rollup_covers([region.id], days[-1])
+
+    # a past day crawled late is newer by id only
+    DailyTrend.create(region=region, time=days[3], metrics=day_metrics(3))
+    assert not rollup_covers([region.id], days[-1])
+    assert sums(region, days[1], days[-1]) is None
+
+    # redone from that day on, the days before it are kept
+    assert extend_rollup(region) == 5
+    assert rollup_covers([region.id], days[-1])
+    assert TagRollup.select().where(TagRollup.time < days[3]).count() == 4
+    extended = sums(region, days[1], days[-1])
+
+    rebuild_rollup(region)
+    assert sums(region, days[1], days[-1]) == extended
+
+
+def search_days(region, search, end):
+    days = posting_days([region.region_id], datetime(2020, 1, 1), end, search)
+    if days is None:
+        return None
+    return sorted(time for _, time in days.tuples())
+
+
+def test_late_day_is_indexed_again(region):
+    first = datetime(2020, 1, 1)
+    days = [ first + timedelta(days=n) for n in range(6) ]
+    for n, time in enumerate(days):
+        if n != 2:
+            DailyTrend.create(region=region, time=time, metrics=day_metrics(n))
+    assert extend_postings(region) == 5
+    assert search_days(region, 'hil', days[-1]) == [days[1], days[3], days[5]]
+
+    DailyTrend.create(region=region, time=days[2], metrics=day_metrics(1))
+    assert search_days(region, 'hil', days[-1]) is None
+    assert extend_postings(region) == 4
+    assert search_days(region, 'hil', days[-1]) == [days[1], days[2], days[3], days[5]]
+
+
+def test_scan_matches_the_posting_index(region):
+    time = datetime(2020, 1, 1)
+    metrics = [ {'tag': tag, 'stats': {}} for tag in ('#lo#fi', 'chill hop', 'study') ]
+    DailyTrend.create(region=region, time=time, metrics=metrics)
+    extend_postings(region)
+    for search in ('lofi', 'lo', 'l hop', 'hop', 'jazz', '#'):
+        scanned = [ t for t, in DailyTrend.select(DailyTrend.time).where(tag_match(search)).tuples() ]
+        assert scanned == search_days(region, search, time)
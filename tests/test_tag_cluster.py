@@ -0,0 +1,75 @@
+import os
+import random
+from fuzzywuzzy import fuzz
+from tag_cluster import TagClusterer, pairwise_cluster
+from tag_normalizer import load_samples
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+
+def cluster_tags(tag_pair):
+    '''The clustering as it was before TagClusterer
+    '''
+    final_tag = []
+    added_tag = []
+    for tag, value in tag_pair:
+        similar_tag = []
+        if tag in added_tag:
+            continue
+        if len(tag) <= 1:
+            continue
+        for tag2, value in tag_pair:
+            if len(tag2) <= 1:
+                continue
+            match_score = fuzz.ratio(tag, tag2)
+            if match_score > 30:
+                similar_tag.append((match_score, tag2, value))
+        similar_tag.sort(key=lambda x: len(x[1]), reverse=True)
+        total_value = 0
+        for _, _tag, value in similar_tag:
+            total_value += value
+            added_tag.append(_tag)
+        final_tag.append((similar_tag[0][1], total_value/len(similar_tag) ))
+    return final_tag
+
+
+def sample_pairs(count, seed):
+    tags = []
+    for sample, _ in load_samples(os.path.join(ROOT, 'test.txt')):
+        tags += sample
+    tags = list(dict.fromkeys(tags))
+    rng = random.Random(seed)
+    return [ (tag, rng.randint(0, 100)) for tag in rng.sample(tags, count) ]
+
+
+def test_same_clusters_as_the_original():
+    for seed in range(3):
+        tag_pair = sample_pairs(250, seed)
+        assert TagClusterer(threshold=30).cluster(tag_pair) == cluster_tags(tag_pair)
+
+
+def test_same_clusters_as_pairwise_at_other_thresholds():
+    tag_pair = sample_pairs(250, 7)
+    for threshold in (10, 50, 80):
+        assert TagClusterer(threshold=threshold).cluster(tag_pair) == pairwise_cluster(tag_pair, threshold)
+
+
+def test_short_tags_and_duplicates():
+    tag_pair = [('a', 1), ('lofi', 2), ('lofi', 4), ('lo-fi', 6), ('台灣', 3)]
+    assert TagClusterer().cluster(tag_pair) == cluster_tags(tag_pair)
+
+
+def test_short_latin_tags_are_pruned():
+    tags = [ tag for tag, _ in sample_pairs(400, 3) if all(ord(ch) < 128 for ch in tag) and len(tag) > 1 ]
+    clusterer = TagClusterer()
+    lookup = clusterer.candidates(tags)
+    candidates = 0
+    for idx, tag in enumerate(tags):
+        found = set(lookup(idx))
+        candidates += len(found)
+        # only pairs that cannot score above threshold are left out
+        for j, other in enumerate(tags):
+            if j not in found:
+                assert fuzz.ratio(tag, other) <= clusterer.threshold
+    # sharing a single letter would keep nearly every pair
+    assert candidates < 0.6 * len(tags) ** 2
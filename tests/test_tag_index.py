@@ -0,0 +1,70 @@
+import random
+import Levenshtein
+from tag_index import BKTree, PrefixIndex, completion_keys, normalize_key
+
+WORDS = ['lofi', 'lofi hip hop', 'lo-fi', 'loft', 'soft', 'jazz', 'jazzy', 'minecraft', 'mine craft',
+    '台灣', '台灣旅遊', '旅遊', 'ｌｏｆｉ', '#Lofi Beats', 'beats']
+
+
+def random_words(count, seed):
+    rng = random.Random(seed)
+    return list({ ''.join(rng.choice('abcde') for _ in range(rng.randint(1, 7))) for _ in range(count) })
+
+
+def test_bk_tree_matches_brute_force():
+    words = random_words(500, 1)
+    tree = BKTree()
+    for word in words:
+        assert tree.add(word)
+    assert not tree.add(words[0])
+    assert tree.size == len(words)
+    for query in random_words(40, 2):
+        for radius, top in ((0, 5), (1, 5), (2, 10), (3, 1000)):
+            found = tree.nearest(query, radius, top)
+            distances = sorted(Levenshtein.distance(query, w) for w in words)
+            expected = [ d for d in distances if d <= radius ][:top]
+            assert [ d for d, _ in found ] == expected
+            assert all(Levenshtein.distance(query, w) == d for d, w in found)
+
+
+def test_bk_tree_empty():
+    assert BKTree().nearest('lofi', 3, 5) == []
+
+
+def test_completion_keys():
+    assert completion_keys('Lofi Hip-Hop') == ['lofi hip-hop', 'hip-hop', 'hop']
+    assert completion_keys('台灣旅遊') == ['台灣旅遊', '灣旅遊', '旅遊', '遊']
+    assert completion_keys('ｌｏｆｉ') == ['lofi']
+    assert normalize_key(' #Lofi ') == 'lofi'
+
+
+def brute_force_complete(popularity, prefix, top):
+    prefix = normalize_key(prefix)
+    matches = [ tag for tag in popularity if any(k.startswith(prefix) for k in completion_keys(tag)) ]
+    return sorted(matches, key=lambda tag: -popularity[tag])[:top]
+
+
+def test_prefix_index_matches_brute_force():
+    rng = random.Random(3)
+    popularity = { word: rng.randint(1, 50) for word in WORDS + random_words(3000, 4) }
+    index = PrefixIndex.from_popularity(popularity)
+    keys = [ index.keys[i] for i in range(len(index.keys)) ]
+    assert keys == sorted(keys)
+    for prefix in ['l', 'lo', 'LOF', 'hip', '旅', '台灣', 'jazz', 'zzz', 'a', 'ab', 'b', 'cd', 'e']:
+        for top in (1, 5, 50):
+            result = index.complete(prefix, top)
+            expected = brute_force_complete(popularity, prefix, top)
+            # ties may come in another order, the scores may not
+            assert [ popularity[t] for t in result ] == [ popularity[t] for t in expected ]
+            assert len(set(result)) == len(result)
+            assert set(result) <= set(brute_force_complete(popularity, prefix, len(popularity)))
+
+
+def test_prefix_index_small():
+    index = PrefixIndex.from_popularity({'台灣旅遊': 3, '旅遊': 5, 'lofi': 1, 'ｌｏｆｉ beats': 2})
+    assert index.complete('旅', 5) == ['旅遊', '台灣旅遊']
+    assert index.complete('lofi', 5) == ['ｌｏｆｉ beats', 'lofi']
+    assert index.complete('beat', 5) == ['ｌｏｆｉ beats']
+    assert index.complete('', 5) == []
+    assert index.complete('lofi', 0) == []
+    assert PrefixIndex.from_popularity({}).complete('lofi', 5) == []
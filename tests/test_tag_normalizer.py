@@ -0,0 +1,59 @@
+import os
+import re
+import pytest
+from fuzzywuzzy import process, fuzz
+from tag_normalizer import TagNormalizer, load_samples
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+
+def extract_video_unique_keyword(tags, channel_title, black_list_tags):
+    '''The normalizer as it was before TagNormalizer, minus the save
+    '''
+    result = []
+    cleaned_tags = []
+    for tag in tags:
+        cleaned_tags += re.split(r',|、|，|】', tag)
+
+    for tag in cleaned_tags:
+        if len(tag) <= 1:
+            continue
+        if tag[:3] == 'sp:':
+            continue
+        if tag in black_list_tags:
+            continue
+        if len(channel_title) != 0:
+            title_similarity = fuzz.ratio(tag, channel_title)
+            if title_similarity > 30:
+                continue
+        match = process.extractBests(tag, cleaned_tags)
+        result.append(match[0][0])
+    return list(set(result))
+
+
+@pytest.fixture(scope='module')
+def normalizer():
+    return TagNormalizer(os.path.join(ROOT, 'blacklist.txt'))
+
+
+@pytest.fixture(scope='module')
+def samples():
+    return load_samples(os.path.join(ROOT, 'test.txt'))
+
+
+def test_matches_the_original_on_test_txt(normalizer, samples):
+    black_list_tags = list(normalizer.blacklist)
+    # the sample title stands in for the channel title, an empty one skips that filter
+    items = samples + [ (tags, '') for tags, _ in samples ]
+    results = normalizer.normalize_many(items)
+    assert len(results) == len(items)
+    for (tags, title), result in zip(items, results):
+        assert sorted(result) == sorted(extract_video_unique_keyword(tags, title, black_list_tags))
+
+
+def test_filters(normalizer):
+    assert 'study' in normalizer.blacklist
+    result = normalizer.normalize(['a', 'sp:sponsor', 'study', 'lofi,chill】jazz', 'Lofi'])
+    # Lofi scores 100 against lofi, the first spelling is kept
+    assert sorted(result) == ['chill', 'jazz', 'lofi']
+    assert normalizer.normalize(['lofi hip hop', 'jazz'], title='lofi hip hop radio') == ['jazz']
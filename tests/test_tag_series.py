@@ -0,0 +1,20 @@
+from datetime import datetime
+from models import DataPoint
+from tag_series import point_rows
+
+
+def test_point_rows_keep_the_stored_point():
+    datapoint = DataPoint(key='tag', value='lofi', region=3, metrics=[
+        {'tag': 'lofi', 'view': 123, 'like': '7', 'rank': 2.0, 'time': '2020-01-02 00:00:00', 'category': [10]},
+    ])
+    row, = point_rows(datapoint)
+    assert row['tag'] == 'lofi'
+    assert row['time'] == datetime(2020, 1, 2)
+    assert (row['view'], row['like'], row['dislike'], row['rank']) == (123, 7, 0, 2)
+    assert all(isinstance(row[c], int) for c in ('view', 'like', 'dislike', 'comment', 'rank'))
+    # returned as is, extra keys and the original time string included
+    assert row['point'] == {'view': 123, 'like': '7', 'rank': 2.0, 'time': '2020-01-02 00:00:00', 'category': [10]}
+
+
+def test_point_rows_skip_non_list_metrics():
+    assert point_rows(DataPoint(key='tag', value='lofi', region=3, metrics={})) == []
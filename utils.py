@@ -1,27 +1,40 @@
-from peewee import NodeList, SQL
+from peewee import NodeList, SQL, Tuple
 from models import Video, DailyTrend,Activity, Region, Channel, Stats, postgres_database
-from cachetools import LRUCache, cached
 from datetime import datetime, timedelta
 from collections import defaultdict
 from dateutil.relativedelta import relativedelta 
 from playhouse.shortcuts import model_to_dict, dict_to_model
 import pandas as pd
 import numpy as np
-from fuzzywuzzy import process, fuzz
-from tqdm import tqdm
+from fuzzywuzzy import fuzz
 import math
+import time
 import re
 import logging
 import multiprocessing as mp
 from custom_pool import CustomPool
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s : %(message)s')
+from memo import memoize
+from metrics import span
+from settings import DEBUG
+from rollup import TREND_COLUMNS, ROLLUP_UNITS, window_sums, posting_days, tag_match
+from tag_normalizer import TagNormalizer
+from tag_cluster import TagClusterer
+logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO, format='%(asctime)s - %(levelname)s : %(message)s')
 
-black_list_tags = list(set([ tag.strip() for tag in open('blacklist.txt', 'r').readlines() ]))
+tag_normalizer = TagNormalizer('blacklist.txt')
+tag_clusterer = TagClusterer(threshold=30)
+
+# bump whenever extract_video_unique_keyword or blacklist.txt changes,
+# then run python normalize.py to refresh the stored tags
+NORMALIZER_VERSION = 2
+
+all_region = [ r.strip() for r in open('valid_region.txt', 'r').readlines() ]
 
 unit_value = {
     'day': 1,
     'week': 7,
     'month': 30,
+    'year': 365,
 }
 
 
@@ -43,67 +56,25 @@ def get_unit_value(date, unit):
         return date.year
 
 def extract_video_unique_keyword(video):
-    tags = video.tags
-    result = []
-    cleaned_tags = []
-    for tag in tags:
-        cleaned_tags += re.split(r',|、|，|】', tag)
-
-    for tag in cleaned_tags:
-
-        if len(tag) <= 1:
-            continue
-        if tag[:3] == 'sp:':
-            continue
-        if tag in black_list_tags:
-            continue
-
-        if 'channel' in video.meta and 'title' in video.meta['channel']:
-            channel_title = video.meta['channel']['title']
-            if len(channel_title) != 0:
-                title_similarity = fuzz.ratio(tag, channel_title)
-                if title_similarity > 30:
-                    continue
-
-        match = process.extractBests(tag, cleaned_tags)
-        result.append(match[0][0])
-    f_tags = list(set(result))
-
-    with postgres_database.atomic():
-        video.tags = f_tags
-        video.save()
-
-    return f_tags
+    '''Clean and deduplicate the raw tags of a video, this is the
+        step normalize.py runs at ingestion time, request handlers should
+        call video_tags instead
+    '''
+    return tag_normalizer.normalize_videos([video])[0]
+
+def video_tags(video):
+    '''Normalized tags stored on the video, only computed in memory when the
+        video was not normalized by the current version, never writes
+    '''
+    if video.normalized_tags is not None and video.normalizer_version == NORMALIZER_VERSION:
+        return video.normalized_tags
+    return extract_video_unique_keyword(video)
 
 def cluster_tags(tag_pair):
-    final_tag = []
-    added_tag = []
-    for tag, value in tag_pair:
-        similar_tag = []
-
-        if tag in added_tag:
-            continue
-        if len(tag) <= 1:
-            continue
-
-        for tag2, value in tag_pair:
-            if len(tag2) <= 1:
-                continue
-            match_score = fuzz.ratio(tag, tag2)
-            if match_score > 30:
-                similar_tag.append((match_score, tag2, value))
-
-        if len(similar_tag) == 0:
-            final_tag.append((tag, value))
-            added_tag.append(tag)
-
-        similar_tag.sort(key=lambda x: len(x[1]), reverse=True)
-        total_value = 0
-        for _, _tag, value in similar_tag:
-            total_value += value
-            added_tag.append(_tag)
-        final_tag.append((similar_tag[0][1], total_value/len(similar_tag) ))
-    return final_tag
+    '''Merge similar tags (fuzz.ratio above 30) into the longest one with
+        their averaged value, see tag_cluster.py for the candidate blocking
+    '''
+    return tag_clusterer.cluster(tag_pair)
 
 
 def _extract_tag(df):
@@ -144,7 +115,7 @@ def cluster_stats_date(stats, unit):
 
     return tag_data
 
-@cached(cache=LRUCache(maxsize=512))
+@memoize(maxsize=512)
 def topic_interest(region_id, unit: str, search:str=None, start: datetime=None, end: datetime=None, 
     sum:bool=False, topic_limit=100, 
     lw: float=0, vw: float=0, cw: float=0, rw: float=1, dw: float=0):
@@ -169,10 +140,11 @@ def topic_interest(region_id, unit: str, search:str=None, start: datetime=None,
     if start is None:
         start = end-relativedelta(days=unit_value[unit]+2)
 
-    videos = Video.select().where((Video.published >= start) & (Video.published <= end))
-
-    # for v in videos:
-    statistic = Stats.select().where((Stats.trending_region == region) & Stats.video.in_(videos))
+    # the Video is selected along with its Stats so s.video is not a query per row
+    statistic = (Stats
+        .select(Stats, Video)
+        .join(Video)
+        .where((Stats.trending_region == region) & (Video.published >= start) & (Video.published <= end)))
     stats = []
     for s in statistic:
         v = s.video
@@ -180,7 +152,7 @@ def topic_interest(region_id, unit: str, search:str=None, start: datetime=None,
             continue
         sub_stats = s.stats['data']
         t = pd.DataFrame(sub_stats)
-        v.tags = extract_video_unique_keyword(v)
+        v.tags = video_tags(v)
         t['video'] = v
         stats.append(t)
 
@@ -212,24 +184,8 @@ def topic_interest(region_id, unit: str, search:str=None, start: datetime=None,
     result['topic'].sort(key=lambda x: x[1], reverse=True)
     return result
 
-@cached(cache=LRUCache(maxsize=512))
-def topic_filter(region_id:str, unit: str, search:str=None, start: datetime=None, end: datetime=None, 
-    topic_limit=100, sum:bool=False, 
-    lw: float=0, vw: float=0, cw: float=0, rw: float=1, dw: float=0):
-    if unit not in ['week', 'day', 'month', 'year']:
-        raise ValueError("Invalid unit value")
-    today = datetime.now()
-    today = datetime(year=today.year, month=today.month, day=today.day)
-    if end is None:
-        end = today
-    else:
-        end = datetime(year=end.year, month=end.month, day=end.day)
-    if start is None:
-        start = end-relativedelta(days=unit_value[unit]+2)
-
-    region = Region.get(Region.region_id == region_id)
-
-    result = {
+def _region_payload(region):
+    return {
         'id': region.region_id,
         'name': region.name,
         'topic': [],
@@ -238,247 +194,275 @@ def topic_filter(region_id:str, unit: str, search:str=None, start: datetime=None
             'lon': region.lon
         }
     }
-    daily_trends = DailyTrend.select().where(
-            (DailyTrend.time >= start) & (DailyTrend.time <= end) & (DailyTrend.region == region))
 
-    if search is not None and len(search) > 0:
-        exp = NodeList([
-            SQL("jsonb_message_to_tsvector("),
-            DailyTrend.metrics,
-            SQL(") @@ '{}'".format(search))
-            ], glue='')
-        daily_trends = daily_trends.where(exp)
-
-    daily_metrics = []
-    for trend in daily_trends:
-        stats = []
-        for metric in trend.metrics:
-            m_ = metric['stats']
-            m_['tag'] = metric['tag'].replace('#', '')
-            m_['date'] = trend.time
+def _metric_rows(region_id, metrics, date):
+    '''Flatten the metrics of a DailyTrend or LatestTrend row into dataframe rows
+    '''
+    rows = []
+    for metric in metrics:
+        m_ = metric['stats']
+        m_['region'] = region_id
+        m_['tag'] = metric['tag'].replace('#', '')
+        m_['date'] = date
+        if 'category' not in metric:
+            m_['category'] = [-1]
+        else:
             m_['category'] = metric['category']
-            stats.append(m_)
-        df = pd.DataFrame(stats)
-        # df['date'] = pd.to_datetime(df['date'])
-        daily_metrics.append(df)
+        rows.append(m_)
+    return rows
+
+def load_regions(region_ids):
+    '''Region rows keyed by region_id, unknown ids are logged and left out
+    '''
+    regions = {}
+    for region in Region.select().where(Region.region_id.in_(list(region_ids))):
+        regions[region.region_id] = region
+    missing = [ r for r in region_ids if r not in regions ]
+    if len(missing) > 0:
+        logging.warning('unknown region ids: {}'.format(','.join(missing)))
+    return regions
+
+def fetch_trend_metrics(regions, start: datetime, end: datetime, search:str=None, daily:bool=True):
+    '''Load DailyTrend rows of every region in a single query, plus the
+        LatestTrend rows when the range reaches today
+
+        returns one dataframe holding the metrics of every region,
+        daily=False only returns the LatestTrend rows
+    '''
+    today = datetime.now()
+    today = datetime(year=today.year, month=today.month, day=today.day)
+
+    rows = []
+    if daily:
+        daily_trends = DailyTrend.select(DailyTrend.metrics, DailyTrend.time, Region.region_id).join(Region).where(
+                (DailyTrend.time >= start) & (DailyTrend.time <= end) & (Region.region_id.in_(list(regions))))
+
+        if search is not None and len(search) > 0:
+            days = posting_days(regions, start, end, search)
+            if days is not None:
+                daily_trends = daily_trends.where(Tuple(DailyTrend.region, DailyTrend.time).in_(days))
+            else:
+                # posting index not caught up yet, scan the metrics
+                daily_trends = daily_trends.where(tag_match(search))
+
+        for metrics, time, region_id in daily_trends.tuples():
+            rows += _metric_rows(region_id, metrics, time)
 
     if end >= today:
         from cache import LatestTrend
-        try:
-            trend = LatestTrend.get(LatestTrend.region_id == region_id)
-            today_stats = trend.metrics
-        except:
-            today_stats = []
-        stats = []
-        for metric in today_stats:
-            m_ = metric['stats']
-            m_['date'] = today
-            m_['tag'] = metric['tag'].replace('#', '')
-            if 'category' not in metric:
-                m_['category'] = [-1]
-            else:
-                m_['category'] = metric['category']
-            stats.append(m_)
-        if len(stats):
-            df = pd.DataFrame(stats)
-            daily_metrics.append(df)
-
-    if len(daily_metrics) > 0:
-        df = pd.concat(daily_metrics, axis=0)
-        if search is not None and len(search) > 0:
-            df = df.loc[df['tag'].str.contains(search, regex=False)]
+        latest_trends = LatestTrend.select().where(LatestTrend.region_id.in_(list(regions)))
+        for trend in latest_trends:
+            rows += _metric_rows(trend.region_id, trend.metrics, today)
+
+    df = pd.DataFrame(rows)
+    if len(df) > 0 and search is not None and len(search) > 0:
+        df = df.loc[df['tag'].str.contains(search, regex=False)]
+    return df
+
+def add_freshness(results, end):
+    '''Report when today's LatestTrend rows of each region were computed
+    '''
+    today = datetime.now()
+    today = datetime(year=today.year, month=today.month, day=today.day)
+    if end < today:
+        return
+    from cache import latest_refreshed
+    refreshed = latest_refreshed(results)
+    for region_id, result in results.items():
+        refreshed_at = refreshed.get(region_id)
+        result['refreshed_at'] = refreshed_at.strftime('%Y-%m-%dT%H:%M:%S') if refreshed_at else None
+
+def _flatten(x):
+    return [z for y in x for z in y]
+
+def trend_sums(df):
+    '''Reduce metric rows to per (region, tag) totals and entry counts,
+        the same layout rollup.window_sums returns
+    '''
+    grouped = df.groupby(['region', 'tag'], sort=False)
+    sums = grouped[TREND_COLUMNS].sum()
+    sums['entries'] = grouped.size()
+    sums['category'] = grouped['category'].agg(_flatten)
+    return sums
+
+@memoize(maxsize=512)
+def topic_filters(region_ids: tuple, unit: str, search:str=None, start: datetime=None, end: datetime=None, 
+    topic_limit=100, sum:bool=False, 
+    lw: float=0, vw: float=0, cw: float=0, rw: float=1, dw: float=0):
+    '''Batched topic_filter, returns one payload per region in region_ids order
+    '''
+    if unit not in ['week', 'day', 'month', 'year']:
+        raise ValueError("Invalid unit value")
+    today = datetime.now()
+    today = datetime(year=today.year, month=today.month, day=today.day)
+    if end is None:
+        end = today
+    else:
+        end = datetime(year=end.year, month=end.month, day=end.day)
+    if start is None:
+        start = end-relativedelta(days=unit_value[unit]+2)
+
+    with span('topic_filters', 'fetch'):
+        regions = load_regions(region_ids)
+        df = fetch_trend_metrics(regions, start, end, search)
 
-        df.set_index('tag')
-        has_col = False
+    results = {}
+    for region_id, region in regions.items():
+        results[region_id] = _region_payload(region)
 
-        if 'category' in df.columns:
+    if len(df) > 0:
+        with span('topic_filters', 'aggregate'):
             df['category'] = [','.join(map(str, l)) for l in df['category']]
-            has_col = True
-            df = df.groupby(['tag', 'date', 'category']).mean()
-        else:
-            df = df.groupby(['tag', 'date']).mean()
-        df['weight'] = (101-df['rank'])*rw + ((df['view'])*vw + (df['comment'])*cw  + (df['like'])*lw - (df['dislike']*dw))/df['view']
-        df['tag'] = list([ r[0] for r in df.index] )
-        df['date'] = list([ r[1].strftime("%Y-%m-%dT%HH:%MM:%SS") for r in df.index] )
+            df = df.groupby(['region', 'tag', 'date', 'category']).mean()
+            df['weight'] = (101-df['rank'])*rw + ((df['view'])*vw + (df['comment'])*cw  + (df['like'])*lw - (df['dislike']*dw))/df['view']
+            df['tag'] = list([ r[1] for r in df.index] )
+            df['date'] = list([ r[2].strftime("%Y-%m-%dT%HH:%MM:%SS") for r in df.index] )
+            df['category'] = list( [ [ int(float(l)) for l in r[3].split(',')] for r in df.index] )
 
-        if has_col:
-            df['category'] = list( [ [ int(float(l)) for l in r[2].split(',')] for r in df.index] )
-        topics = df.to_dict(orient='records')
+            for region_id, region_df in df.groupby(level=0):
+                results[region_id]['topic'] = region_df.to_dict(orient='records')
 
-        result['topic'] = topics
-    return result
+    with span('topic_filters', 'freshness'):
+        add_freshness(results, end)
+    return [ results[r] for r in region_ids if r in results ]
+
+def topic_filter(region_id:str, unit: str, search:str=None, start: datetime=None, end: datetime=None, 
+    topic_limit=100, sum:bool=False, 
+    lw: float=0, vw: float=0, cw: float=0, rw: float=1, dw: float=0):
+    results = topic_filters((region_id,), unit, search=search, start=start, end=end,
+        topic_limit=topic_limit, sum=sum, lw=lw, vw=vw, cw=cw, rw=rw, dw=dw)
+    if len(results) == 0:
+        raise Region.DoesNotExist('region {} does not exist'.format(region_id))
+    return results[0]
 
-@cached(cache=LRUCache(maxsize=512))
+@memoize(maxsize=512, live=lambda arguments: True)
 def get_today_trend(region):
+    '''Per tag stats of today's trending videos in a region, averaged per
+        timestamp first and then over the day
+
+        today's points are filtered in SQL, the videos are loaded with one IN
+        query and the tag rows are built as flat columns for a single groupby.
+        Points are matched on the day prefix of their date string, never cast
+        in SQL, a malformed date is skipped instead of failing the region
+    '''
+    started = time.time()
     day_ = datetime.now()
     day = datetime(year=day_.year, month=day_.month, day=day_.day)
-    date = day.strftime("%Y-%m-%d")
-    end_of_day = day + timedelta(hours=23, minutes=23, seconds=23)
-    region_id = region.id
-    cursor = postgres_database.execute_sql("select m.id, m.video_id, m.trending_region_id, m.stats from stats as m, jsonb_array_elements(stats->'data') point where point->>'date' like '{}%%' and m.trending_region_id = {};".format(date, int(region_id)))
-    stats, count = [], 0
-    result = []
-
-    for row in tqdm(cursor.fetchall()):
-        stats_id, video_id, _, stat_ = row
-        v = Video.get(Video.id == video_id)
-        if 'data' not in stat_:
-            continue
-        sub_stats = stat_['data']
-
-        t = pd.DataFrame(sub_stats)
-        v.tags = extract_video_unique_keyword(v)
-        t['video'] = v
-
-        stats.append(t)
-        count += 1
-
-    if len(stats) == 0:
-        print('return early')
-        return result
-    df = pd.concat(stats, axis=0)
-    df['date'] = pd.to_datetime(df['date'])
-    df.set_index('date')
-    df = df[(df['date'] >= day) & (df['date'] <= end_of_day)]
-    numeric_columns = ["like", "rank", "view", "comment", "dislike", "favorite"]
-    df[numeric_columns] = df[numeric_columns].apply(pd.to_numeric)
-
-    tag_data = cluster_stats_date(df, 'day')
-
-    total_weight = 0
-
-    for key, data in tag_data.items():
-        if len(key) >= 3 and len(key) < 30:
-            df = pd.DataFrame(data)
-
-            df = df.groupby(['date']).mean()
-            df['norm_view'] = df['view']/df['view'].sum()
-            # df['weight'] =  (df['like'] + df['dislike'])/df['view'] + ((101-df['rank'])*1000)*df['norm_view']
-            df['weight'] = (101-df['rank']) + ((df['comment']) + (df['view']) + (df['like']) - (df['dislike']))/df['view']
+    with span('get_today_trend', 'fetch'):
+        cursor = postgres_database.execute_sql("select m.video_id, point from stats as m, jsonb_array_elements(m.stats->'data') point "
+            "where m.trending_region_id = %s and point->>'date' like %s",
+            (region.id, day.strftime('%Y-%m-%d') + '%'))
+        points = cursor.fetchall()
+
+        video_tag = {}
+        video_ids = list(set([ video_id for video_id, _ in points ]))
+        if len(video_ids) > 0:
+            videos = Video.select(Video.id, Video.tags, Video.meta, Video.normalized_tags, Video.normalizer_version).where(
+                Video.id.in_(video_ids))
+            for v in videos:
+                video_tag[v.id] = [ tag for tag in video_tags(v) if len(tag) >= 3 and len(tag) < 30 ]
+
+    numeric_columns = ["like", "rank", "view", "comment", "dislike"]
+    tags, dates = [], []
+    columns = { c: [] for c in numeric_columns }
+    for video_id, point in points:
+        for tag in video_tag.get(video_id, []):
+            tags.append(tag)
+            dates.append(point['date'])
+            for c in numeric_columns:
+                columns[c].append(point.get(c))
 
-            stats = df[['weight', 'like', 'dislike', 'comment', 'view', 'rank', 'norm_view']].mean(axis=0).to_dict()
+    result = []
+    if len(tags) > 0:
+        df = pd.DataFrame(columns).apply(pd.to_numeric, errors='coerce')
+        df['tag'] = tags
+        # NaT for a date like 2020-01-02garbage, groupby leaves those rows out
+        df['date'] = pd.to_datetime(dates, errors='coerce')
+
+        df = df.groupby(['tag', 'date']).mean()
+        df['norm_view'] = df['view']/df.groupby(level=0)['view'].transform('sum')
+        df['weight'] = (101-df['rank']) + ((df['comment']) + (df['view']) + (df['like']) - (df['dislike']))/df['view']
+        df = df[['weight', 'like', 'dislike', 'comment', 'view', 'rank', 'norm_view']].groupby(level=0).mean()
+
+        for tag, stats in zip(df.index, df.to_dict(orient='records')):
             result.append({
-                'tag': key,
+                'tag': tag,
                 'stats': stats
             })
+
+    logging.info('today trend {}: {} points, {} videos, {} tags in {:.2f}s'.format(
+        region.region_id, len(points), len(video_ids), len(result), time.time() - started))
     return result
 
-@cached(cache=LRUCache(maxsize=512))
-def trending_topic(region_id, unit: str, search:str=None, start: datetime=None, end: datetime=None, 
+@memoize(maxsize=512)
+def trending_topics(region_ids: tuple, unit: str, search:str=None, start: datetime=None, end: datetime=None, 
     sum:bool=False, topic_limit=100, 
     lw: float=1, vw: float=1, cw: float=1, rw: float=1, dw: float=1):
-
+    '''Batched trending_topic, every region is fetched and aggregated
+        together and one payload per region is returned in region_ids order
+    '''
     today = datetime.now()
     today = datetime(year=today.year, month=today.month, day=today.day)
     if end is None:
         end = today
     if start is None:
         start = end-relativedelta(days=unit_value[unit]+2)
-    print(start, end)
-    region = Region.get(Region.region_id == region_id)
-
-    result = {
-        'id': region.region_id,
-        'name': region.name,
-        'topic': [],
-        'geo': {
-            'lat': region.lat,
-            'lon': region.lon
-        }
-    }
-    daily_trends = DailyTrend.select().where(
-            (DailyTrend.time >= start) & (DailyTrend.time <= end) & (DailyTrend.region == region))
-
-    if search is not None and len(search) > 0:
-        exp = NodeList([
-            SQL("jsonb_message_to_tsvector("),
-            DailyTrend.metrics,
-            SQL(") @@ '{}'".format(search))
-            ], glue='')
-        daily_trends = daily_trends.where(exp)
-    print('size', len(daily_trends))
-    daily_metrics = []
-    for trend in daily_trends:
-        stats = []
-        for metric in trend.metrics:
-            m_ = metric['stats']
-            m_['tag'] = metric['tag'].replace('#', '')
-            m_['date'] = trend.time
-            if 'category' not in metric:
-                m_['category'] = [-1]
-            else:
-                m_['category'] = metric['category']
-
-            stats.append(m_)
 
-        df = pd.DataFrame(stats)
-        if len(df)> 0:
-            daily_metrics.append(df)
-
-    if end >= today:
-        from cache import LatestTrend
-        try:
-            trend = LatestTrend.get(LatestTrend.region_id == region_id)
-            today_stats = trend.metrics
-        except:
-            today_stats = []
-        stats = []
-        for metric in today_stats:
-            m_ = metric['stats']
-            m_['tag'] = metric['tag'].replace('#', '')
-            m_['date'] = today
-            if 'category' not in metric:
-                m_['category'] = [-1]
-            else:
-                m_['category'] = metric['category']
-            stats.append(m_)
-        if len(stats):
-            df = pd.DataFrame(stats)
-            if len(df)> 0:
-                daily_metrics.append(df)
-    print('m size', len(daily_metrics))
-    if len(daily_metrics) > 0:
-        df = pd.concat(daily_metrics, axis=0)
-        if search is not None and len(search) > 0:
-            df = df.loc[df['tag'].str.contains(search, regex=False)]
-
-        df.set_index('tag')
-        df = df.drop(columns=["date"])
-        if 'category' in df.columns:
-            # df['category'] = [','.join(map(str, l)) for l in df['category']]
-            # df = df.groupby(['tag', 'category'],as_index=False).mean()
-            f2 = lambda x: [z for y in x for z in y]
-            f1 = lambda x: ', '.join(x.dropna())
-            d = dict.fromkeys(df[['tag','category']].columns.difference(['tag','category']), f1)
-            d['category'] = f2
-            df1 = df.groupby('tag', as_index=False).agg(d)
-            df2 = df[['tag', 'rank', 'view', 'comment', 'like', 'dislike']].groupby(['tag'], as_index=False ).mean()
-            df = pd.concat([df1.set_index('tag'), df2.set_index('tag')], axis=1, join='inner').reset_index()
+    with span('trending_topics', 'fetch'):
+        regions = load_regions(region_ids)
 
+        frames = []
+        window = None
+        if unit in ROLLUP_UNITS and (search is None or len(search) == 0):
+            window = window_sums(regions, start, end)
+        if window is None:
+            df = fetch_trend_metrics(regions, start, end, search)
         else:
-            df = df.groupby(['tag'], as_index=False ).mean()
-        df['weight'] = (101-df['rank'])*rw + ((df['view'])*vw + (df['comment'])*cw  + (df['like'])*lw - (df['dislike']*dw))/df['view']
-        # df['tag'] = [ r[0] for r in df.index]
-        # df['category'] = [ r[1] for r in df.index]
-
-        topics = df.to_dict(orient='records')
-        topics.sort(key=lambda x: x['weight'], reverse=True)
-        result['topic'] = []
-        for t in topics[:topic_limit]:
-            e = {
-                'tag':t['tag'], 
-                'weight': t['weight'], 
-                'rank': t['rank'], 
-                'view': t['view'], 
-                'like': t['like'], 
-                'dislike': t['like'], 
-                'comment': t['comment']  
-            }
-            if 'category' in t:
-                e['category'] = list(set(t['category']))
-            result['topic'].append(e)
-    return result
+            frames.append(window)
+            df = fetch_trend_metrics(regions, start, end, daily=False)
+
+    results = {}
+    for region_id, region in regions.items():
+        results[region_id] = _region_payload(region)
+
+    with span('trending_topics', 'aggregate'):
+        if len(df) > 0:
+            frames.append(trend_sums(df))
+        frames = [ f for f in frames if len(f) > 0 ]
+
+        if len(frames) > 0:
+            sums = pd.concat(frames, axis=0)
+            grouped = sums.groupby(level=[0, 1], sort=False)
+            totals = grouped[TREND_COLUMNS + ['entries']].sum()
+            topics = totals[TREND_COLUMNS].div(totals['entries'], axis=0)
+            topics['category'] = grouped['category'].agg(_flatten)
+            topics['weight'] = (101-topics['rank'])*rw + ((topics['view'])*vw + (topics['comment'])*cw  + (topics['like'])*lw - (topics['dislike']*dw))/topics['view']
+            topics = topics.sort_values('weight', ascending=False).groupby(level=0).head(topic_limit)
+
+            for (region_id, tag), t in zip(topics.index, topics.to_dict(orient='records')):
+                results[region_id]['topic'].append({
+                    'tag': tag, 
+                    'weight': t['weight'], 
+                    'rank': t['rank'], 
+                    'view': t['view'], 
+                    'like': t['like'], 
+                    'dislike': t['dislike'], 
+                    'comment': t['comment'],
+                    'category': list(set(t['category']))
+                })
+
+    with span('trending_topics', 'freshness'):
+        add_freshness(results, end)
+    return [ results[r] for r in region_ids if r in results ]
 
+def trending_topic(region_id, unit: str, search:str=None, start: datetime=None, end: datetime=None, 
+    sum:bool=False, topic_limit=100, 
+    lw: float=1, vw: float=1, cw: float=1, rw: float=1, dw: float=1):
+    results = trending_topics((region_id,), unit, search=search, start=start, end=end,
+        sum=sum, topic_limit=topic_limit, lw=lw, vw=vw, cw=cw, rw=rw, dw=dw)
+    if len(results) == 0:
+        raise Region.DoesNotExist('region {} does not exist'.format(region_id))
+    return results[0]
 
 
 def test_query():
@@ -487,8 +471,8 @@ def test_query():
             SQL("->>'tag' in ('{}') ".format('阿努納奇'))
             ], glue='')
     daily_trends = DailyTrend.select().where( exp)
-    print(daily_trends.sql())
-    print(len(daily_trends))
+    logging.debug(daily_trends.sql())
+    logging.debug(len(daily_trends))
 
 
 if __name__ == '__main__':